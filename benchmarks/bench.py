@@ -0,0 +1,198 @@
+"""
+Benchmarks the download and archive hot paths against a local mock of
+the mangadex API (see mock_mangadex.py), so regressions show up before
+they ship.
+
+For each scenario, a `DownloadScheduler` loads and downloads a whole
+manga from a fresh mock server, then `FileSys.create_volumes` archives it.
+Every run happens in a new process, so peak memory is measured for that
+run alone. Reports pages/s, bytes/s, peak RSS and archive time.
+
+>>> python benchmarks/bench.py                          # every scenario
+>>> python benchmarks/bench.py -s latency -s errors --repeat 3
+>>> python benchmarks/bench.py --save baseline.json
+>>> python benchmarks/bench.py --compare baseline.json  # exits 1 on a regression
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set)
+
+# run from a checkout, without installing mangodl
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_mangadex import Settings, serve  # noqa: E402
+
+SCENARIOS: Dict[str, Settings] = {
+    'baseline': Settings(),
+    'latency': Settings(latency=0.05),
+    'bandwidth': Settings(bandwidth=2e6),  # 2 MB/s for each image
+    'errors': Settings(error_rate=0.05),
+    'throttled': Settings(max_rate=50),
+}
+
+# for --compare: metric -> True if bigger is better
+METRICS = {'pages_per_s': True, 'bytes_per_s': True, 'archive_s': False, 'peak_rss_mb': False}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def server_stats(port: int) -> Dict:
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats', timeout=5) as resp:
+        return json.load(resp)
+
+
+def wait_for_server(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            server_stats(port)
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_once(port: int, rate_limit: int, image_limit: int, archive_workers: int) -> Dict:
+    """Downloads and archives one manga from the mock server. Runs in a fresh process."""
+    sys.stderr = open(os.devnull, 'w')  # no progress bars
+    with tempfile.TemporaryDirectory() as tmp:
+        # point mangodl at the mock before anything reads the config
+        config = Path(tmp) / 'config.ini'
+        config.write_text(f'[links]\napi_base = http://127.0.0.1:{port}/v2/\n\n[user info]\n\n[settings]\n')
+        os.environ['MANGODL_CONFIG'] = str(config)
+        from mangodl.filesys import FileSys
+        from mangodl.scheduler import DownloadScheduler
+
+        with DownloadScheduler(rate_limit, image_limit=image_limit, use_cache=False) as scheduler:
+            manga, = scheduler.load_mangas([1])
+            (Path(tmp) / 'out').mkdir()
+            fs = FileSys(manga.title, Path(tmp) / 'out')
+            manga.stage_chapters('gb', no_prompt=True)
+            fs.setup_folders()
+
+            start = time.perf_counter()
+            scheduler.add(manga, fs, False)
+            scheduler.run()
+            download_s = time.perf_counter() - start
+
+        pages = [page for ch in manga.downloaded for page in fs.chapter_pages(ch.ch_path)]
+        size = sum(page.stat().st_size for page in pages)
+
+        manga._compile_volume_info(10)
+        start = time.perf_counter()
+        fs.create_volumes(manga.downloaded, archive_workers)
+        archive_s = time.perf_counter() - start
+
+    # kilobytes on linux, bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return {'pages': len(pages),
+            'bytes': size,
+            'download_s': download_s,
+            'pages_per_s': len(pages) / download_s,
+            'bytes_per_s': size / download_s,
+            'archive_s': archive_s,
+            'peak_rss_mb': peak_rss / 2 ** 20}
+
+
+def run_scenario(name: str, settings: Settings, args: argparse.Namespace) -> Dict:
+    """Runs a scenario `args.repeat` times and returns the median of each metric."""
+    ctx = multiprocessing.get_context('spawn')
+    runs = []
+    for i in range(args.repeat):
+        port = free_port()
+        server = ctx.Process(target=serve, args=(settings._replace(seed=settings.seed + i), port), daemon=True)
+        server.start()
+        try:
+            wait_for_server(port)
+            with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+                result = pool.submit(run_once, port, args.rate_limit, args.image_limit, args.archive_workers).result()
+            result.update(server_stats(port))
+            runs.append(result)
+        finally:
+            server.terminate()
+            server.join()
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict], tolerance: float) -> List[str]:
+    """Lists the metrics which got worse than `baseline` by more than `tolerance`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, bigger_is_better in METRICS.items():
+            old, new = baseline[name][metric], result[metric]
+            change = (new - old) / old if old else 0
+            if (-change if bigger_is_better else change) > tolerance:
+                regressions.append(f'{name}: {metric} {old:.4g} -> {new:.4g} ({change:+.0%})')
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark mangodl against a mock mangadex server.')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, may be repeated (defaults to all of them)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario - the median is reported')
+    parser.add_argument('--chapters', type=int, help='chapters per manga')
+    parser.add_argument('--pages', type=int, help='pages per chapter')
+    parser.add_argument('--page-size', type=int, help='bytes per page')
+    parser.add_argument('--rate-limit', type=int, default=30, help='starting rate of requests per second')
+    parser.add_argument('--image-limit', type=int, default=16, help='image downloads in flight per server')
+    parser.add_argument('--archive-workers', type=int, default=4, help='volume archives written at once')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as json')
+    parser.add_argument('--compare', metavar='FILE', help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='share by which a metric may get worse before --compare fails (defaults to %(default)s)')
+    args = parser.parse_args()
+
+    sizes = {key: value for key, value in (('chapters', args.chapters),
+                                           ('pages', args.pages),
+                                           ('page_size', args.page_size)) if value}
+    results = {}
+    print(f'{"scenario":<10} {"pages/s":>9} {"MB/s":>8} {"download s":>11} {"archive s":>10} '
+          f'{"peak MB":>8} {"429s":>6} {"errors":>7}')
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name, SCENARIOS[name]._replace(**sizes), args)
+        results[name] = result
+        print(f'{name:<10} {result["pages_per_s"]:>9.1f} {result["bytes_per_s"] / 2 ** 20:>8.1f} '
+              f'{result["download_s"]:>11.2f} {result["archive_s"]:>10.2f} {result["peak_rss_mb"]:>8.1f} '
+              f'{result["throttled"]:>6} {result["failed"]:>7}')
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f'regression - {line}')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
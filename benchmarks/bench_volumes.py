@@ -0,0 +1,62 @@
+"""
+Benchmarks volume assignment on long-running series, where most chapters
+have no volume number yet.
+
+>>> python benchmarks/bench_volumes.py
+>>> python benchmarks/bench_volumes.py --chapters 1000 --chapters 100000 --repeat 5
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set)
+
+# run from a checkout, without installing mangodl
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mangodl.volumes import assign_volumes  # noqa: E402
+
+
+def make_series(n_chapters: int, orphan_share: float, seed: int) -> List[SimpleNamespace]:
+    """A weekly series in volumes of about 10 chapters, newest first like the API lists them."""
+    rng = random.Random(seed)
+    chapters = []
+    for n in range(1, n_chapters + 1):
+        vol_num = (n - 1) // 10 + 1
+        orphan = rng.random() < orphan_share or n > n_chapters * 0.9  # the newest have no volume yet
+        chapters.append(SimpleNamespace(id=n, ch_num=n, vol_num='' if orphan else vol_num))
+    return chapters[::-1]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark volume assignment.')
+    parser.add_argument('--chapters', type=int, action='append',
+                        help='chapters in the series, may be repeated (defaults to 1000, 10000 and 100000)')
+    parser.add_argument('--orphans', type=float, default=0.5, help='share of chapters with no volume')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size - the best is reported')
+    args = parser.parse_args()
+
+    print(f'{"chapters":>9} {"best ms":>9} {"us/chapter":>11}')
+    for n in args.chapters or [1000, 10000, 100000]:
+        times = []
+        for i in range(args.repeat):
+            chapters = make_series(n, args.orphans, i)
+            start = time.perf_counter()
+            assign_volumes(chapters, 10)
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        print(f'{n:>9} {best * 1e3:>9.2f} {best / n * 1e6:>11.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""
+A local stand-in for the mangadex v2 API and its image servers, for
+benchmarks. Serves `manga/{id}`, `manga/{id}/chapters`, `chapter/{id}`
+and the page images, with configurable latency, bandwidth, errors and
+throttling. Everything random is seeded, so runs can be compared.
+
+Run on its own with:
+>>> python benchmarks/mock_mangadex.py --port 8765 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    NamedTuple)
+
+from aiohttp import web
+
+# bytes written per chunk when bandwidth is limited
+CHUNK_SIZE = 16 * 1024
+
+
+class Settings(NamedTuple):
+    """
+    How the mock server behaves.
+
+    Attributes
+    ----------
+    chapters : int, default 20
+        Chapters per manga. Chapters without a volume follow the first
+        half, which come in volumes of 5.
+    pages : int, default 20
+        Pages per chapter.
+    page_size : int, default 200000
+        Bytes per page.
+    latency : float, default 0
+        Seconds before each response starts.
+    bandwidth : float, default 0
+        Bytes per second for each image response. 0 is unlimited.
+    error_rate : float, default 0
+        Share of image requests answered with a 500.
+    max_rate : float, default 0
+        Requests per second per host before answering 429 with a
+        Retry-After header. 0 is unlimited.
+    retry_after : int, default 1
+        Seconds to ask for in the Retry-After header.
+    seed : int, default 0
+    """
+    chapters: int = 20
+    pages: int = 20
+    page_size: int = 200000
+    latency: float = 0.0
+    bandwidth: float = 0.0
+    error_rate: float = 0.0
+    max_rate: float = 0.0
+    retry_after: int = 1
+    seed: int = 0
+
+
+class MockMangaDex:
+    """
+    The aiohttp application, plus counters of what it served.
+
+    Parameters
+    ----------
+    settings : Settings
+    base_url : str
+        Where the server can be reached, used for the image server links.
+
+    Attributes
+    ----------
+    requests, throttled, failed : int
+        Requests received, answered with 429, and failed on purpose.
+    bytes_sent : int
+        Image bytes sent.
+    """
+
+    def __init__(self, settings: Settings, base_url: str):
+        self.settings = settings
+        self.base_url = base_url
+        self.rng = random.Random(settings.seed)
+        self.requests = 0
+        self.throttled = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self._windows: Dict[str, Tuple[int, int]] = {}  # host -> (second, requests in it)
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.add_routes([web.get('/v2/manga/{id}', self.manga),
+                             web.get('/v2/manga/{id}/chapters', self.chapters),
+                             web.get('/v2/chapter/{id}', self.chapter),
+                             web.get('/data/{hash}/{page}', self.page),
+                             web.get('/stats', self.stats)])
+
+    def _throttle(self, host: str) -> bool:
+        if not self.settings.max_rate:
+            return False
+        second = int(time.monotonic())
+        window, count = self._windows.get(host, (second, 0))
+        if window != second:
+            window, count = second, 0
+        self._windows[host] = (window, count + 1)
+        return count + 1 > self.settings.max_rate
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.path == '/stats':
+            return await handler(request)
+        self.requests += 1
+        if self.settings.latency:
+            await asyncio.sleep(self.settings.latency)
+        if self._throttle(request.host):
+            self.throttled += 1
+            return web.Response(status=429, headers={'Retry-After': str(self.settings.retry_after)})
+        return await handler(request)
+
+    def _chapter_info(self, manga_id: int, n: int) -> Dict:
+        half = self.settings.chapters // 2
+        return {'id': manga_id * 100000 + n,
+                'hash': hashlib.md5(f'{manga_id}-{n}'.encode()).hexdigest(),
+                'chapter': str(n),
+                'volume': str((n - 1) // 5 + 1) if n <= half else '',
+                'title': f'Chapter {n}',
+                'language': 'gb',
+                'groups': [1],
+                'timestamp': 1600000000 + n}
+
+    @staticmethod
+    def _split_id(ch_id: int) -> Tuple[int, int]:
+        return ch_id // 100000, ch_id % 100000
+
+    async def manga(self, request: web.Request) -> web.Response:
+        manga_id = int(request.match_info['id'])
+        return web.json_response({'data': {'id': manga_id, 'title': f'Bench {manga_id}'}})
+
+    async def chapters(self, request: web.Request) -> web.Response:
+        manga_id = int(request.match_info['id'])
+        # the api lists chapters from last to first
+        chs = [self._chapter_info(manga_id, n) for n in range(self.settings.chapters, 0, -1)]
+        return web.json_response({'data': {'chapters': chs, 'groups': []}})
+
+    async def chapter(self, request: web.Request) -> web.Response:
+        manga_id, n = self._split_id(int(request.match_info['id']))
+        data = self._chapter_info(manga_id, n)
+        data['server'] = self.base_url + '/data/'
+        data['pages'] = [f'p{i}-{hashlib.md5(self._page_seed(data["hash"], i)).hexdigest()}.png'
+                         for i in range(self.settings.pages)]
+        return web.json_response({'data': data})
+
+    @staticmethod
+    def _page_seed(ch_hash: str, i: int) -> bytes:
+        return f'{ch_hash}/{i}'.encode()
+
+    def _page_body(self, ch_hash: str, page: str) -> bytes:
+        # different for every page, so the page store can't share them
+        i = int(page[1:].split('-')[0])
+        seed = hashlib.sha256(self._page_seed(ch_hash, i)).digest()
+        return (seed * (self.settings.page_size // len(seed) + 1))[:self.settings.page_size]
+
+    async def page(self, request: web.Request) -> web.StreamResponse:
+        if self.settings.error_rate and self.rng.random() < self.settings.error_rate:
+            self.failed += 1
+            return web.Response(status=500)
+        body = self._page_body(request.match_info['hash'], request.match_info['page'])
+        if not self.settings.bandwidth:
+            self.bytes_sent += len(body)
+            return web.Response(body=body, content_type='image/png')
+
+        resp = web.StreamResponse(headers={'Content-Type': 'image/png', 'Content-Length': str(len(body))})
+        await resp.prepare(request)
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            await resp.write(chunk)
+            self.bytes_sent += len(chunk)
+            await asyncio.sleep(len(chunk) / self.settings.bandwidth)
+        await resp.write_eof()
+        return resp
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({'requests': self.requests,
+                                  'throttled': self.throttled,
+                                  'failed': self.failed,
+                                  'bytes_sent': self.bytes_sent})
+
+
+def serve(settings: Settings, port: int, host: str = '127.0.0.1') -> None:
+    """Runs the mock server until interrupted."""
+    mock = MockMangaDex(settings, f'http://{host}:{port}')
+    web.run_app(mock.app, host=host, port=port, print=None)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve a mock mangadex API for benchmarks.')
+    parser.add_argument('--port', type=int, default=8765)
+    for name, default in Settings._field_defaults.items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default)
+    args = vars(parser.parse_args())
+    port = args.pop('port')
+    serve(Settings(**args), port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Download manga from mangadex. Run `mangodl` for the command line app,
+or use `download` to download from Python code.
+"""
+
+import sys
+
+import logging
+# messages go nowhere unless the application configures logging
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+# where each name exported by the package lives
+_EXPORTS = {
+    'download': '.api',
+    'DownloadOptions': '.api',
+    'Result': '.api',
+    'Progress': '.scheduler',
+    'Metrics': '.metrics',
+}
+
+
+def __getattr__(name):
+    # importing the package (as the command line app does) shouldn't load
+    # aiohttp and the rest until the library API is actually used
+    if name in _EXPORTS:
+        from importlib import import_module
+        return getattr(import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ isn't supported - import everything up front
+    from .api import download, DownloadOptions, Result
+    from .scheduler import Progress
+    from .metrics import Metrics
@@ -0,0 +1,208 @@
+"""
+Downloads manga without the command line - no prompts, no progress bars
+and nothing printed. Progress comes back through a callback, and
+messages through the `mangodl` loggers.
+
+from mangodl import download, DownloadOptions
+
+result = download('12345', DownloadOptions(folder='/srv/manga', chapters='1-20'),
+                  on_progress=print)
+"""
+
+from pathlib import Path
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable,
+                    NamedTuple)
+
+from .client import ApiError
+from .filesys import FileSys
+from .metrics import Metrics
+from .scheduler import DownloadScheduler, Progress
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class DownloadOptions(NamedTuple):
+    """
+    Settings for `download`. Only `folder` is required - the rest default
+    to the same values as the command line options.
+
+    Attributes
+    ----------
+    folder : str or Path
+        Folder to download into. Each manga gets a folder inside it.
+    language : str, default 'gb'
+    chapters : str, optional
+        Chapters to download, like '1-20, 25'. Every chapter by default.
+    saver : bool, default False
+        Use low quality images.
+    volumes : bool, default True
+        Archive the chapters into volumes.
+    vol_len : int, default 10
+        Chapters per volume, for chapters mangadex did not assign a volume.
+    vol_strategy : str, default 'chapters'
+        How to place chapters without a volume - see `Manga.use_volume_strategy`.
+    vol_map : str or Path, optional
+        .json or .csv file mapping chapter numbers to volumes, which
+        overrides mangadex.
+    rate_limit : int, default 30
+        Requests per second to start at, for each server.
+    adaptive_rate : bool, default True
+        Adjust the rate from the server's responses.
+    metadata_limit, image_limit : int, optional
+        Maximum number of API requests, and image downloads per server,
+        in flight. (Defaults 4 and 16.)
+    archive_workers : int, default 4
+        Volume archives written at the same time.
+    use_cache : bool, default True
+        Reuse API responses stored by earlier runs.
+    verify : bool, default True
+        Check pages saved by earlier runs against their checksums before
+        skipping them, rather than only their size.
+    cache_path : str or Path, optional
+        File to store API responses in. Defaults to one in the user's
+        cache folder - see `cache.user_cache_dir`.
+    out_format : str, default 'cbz'
+        Format to write volumes in - one of `writers.FORMATS`.
+    level : int, default 0
+        Compression level of the volumes, from 0 (none) to 9.
+    direct : {'volume', 'chapter'}, optional
+        Write pages straight into a .cbz per volume (needs `volumes`) or
+        per chapter, and keep no raw files. Such downloads can't be
+        resumed. Only for the 'cbz' format.
+    """
+    folder: Union[str, Path]
+    language: str = 'gb'
+    chapters: Optional[str] = None
+    saver: bool = False
+    volumes: bool = True
+    vol_len: int = 10
+    vol_strategy: str = 'chapters'
+    vol_map: Union[str, Path, None] = None
+    rate_limit: int = 30
+    adaptive_rate: bool = True
+    metadata_limit: int = 4
+    image_limit: int = 16
+    archive_workers: int = 4
+    use_cache: bool = True
+    verify: bool = True
+    cache_path: Union[str, Path, None] = None
+    out_format: str = 'cbz'
+    level: int = 0
+    direct: Optional[str] = None
+
+    def check(self) -> None:
+        """Raises ValueError if a limit or count is not a positive number."""
+        for name in ('vol_len', 'rate_limit', 'metadata_limit', 'image_limit', 'archive_workers'):
+            value = getattr(self, name)
+            if not isinstance(value, int) or value < 1:
+                raise ValueError(f'{name} must be a positive whole number, not {value!r}')
+
+
+class Result(NamedTuple):
+    """
+    What `download` did for a manga.
+
+    Attributes
+    ----------
+    manga_id : str or int
+    title : str
+    path : Path
+        Folder holding the raw chapters and the volumes.
+    chapters : list
+        Numbers of the chapters saved, including those saved by earlier runs.
+    incomplete : list
+        Numbers of the chapters saved with pages missing.
+    failed : list
+        Numbers of the chapters which have no image server.
+    volumes : list
+        Paths of the volume archives written.
+    """
+    manga_id: Union[str, int]
+    title: str
+    path: Path
+    chapters: List[Union[int, float, str]]
+    incomplete: List[Union[int, float, str]]
+    failed: List[Union[int, float, str]]
+    volumes: List[Path]
+
+
+def download(manga_id: Union[str, int],
+             options: DownloadOptions,
+             on_progress: Optional[Callable[[Progress], None]] = None,
+             metrics: Optional[Metrics] = None) -> Result:
+    """
+    Downloads a manga from mangadex. Blocks until it is done.
+
+    Runs its own event loop, so from async code call it in a thread,
+    e.g. with `loop.run_in_executor`.
+
+    Parameters
+    ----------
+    manga_id : str or int
+        Mangadex id for the manga.
+    options : DownloadOptions
+    on_progress : callable, optional
+        Called with a `scheduler.Progress` tuple as pages, chapters and
+        volumes are done.
+    metrics : metrics.Metrics, optional
+        Collects timings and counts from the download. Serve them with
+        `metrics.serve_prometheus`, or give it a stream for JSON lines.
+
+    Returns
+    -------
+    Result
+
+    Raises
+    ------
+    ValueError
+        If `options` are out of range - see `DownloadOptions.check`.
+    client.ApiError
+        If the manga info could not be fetched.
+    """
+    options.check()
+    volumes: List[Path] = []
+
+    def report(event: Progress) -> None:
+        if event.kind == 'volume':
+            volumes.append(event.item)
+        if on_progress is not None:
+            on_progress(event)
+
+    with DownloadScheduler(options.rate_limit,
+                           options.metadata_limit,
+                           options.image_limit,
+                           options.use_cache,
+                           options.archive_workers,
+                           options.adaptive_rate,
+                           show_progress=False,
+                           on_progress=report,
+                           metrics=metrics,
+                           cache_path=options.cache_path) as scheduler:
+        mangas = scheduler.load_mangas([manga_id])
+        if not mangas:
+            raise ApiError(f'could not get info for manga {manga_id}')
+        manga = mangas[0]
+        fs = FileSys(manga.title, options.folder, options.out_format, options.level, options.verify)
+        if manga.stage_chapters(options.language, no_prompt=True, ranges=options.chapters):
+            fs.setup_folders(raw=not options.direct)
+            manga.use_volume_strategy(fs, options.vol_strategy, options.vol_map)
+            scheduler.add(manga, fs, options.saver, options.vol_len if options.volumes else None, options.direct)
+            scheduler.run()
+            manga.finish_download(not options.volumes, options.vol_len, options.direct)
+
+    return Result(manga_id,
+                  manga.title,
+                  fs.base_path,
+                  [ch.ch_num for ch in manga.downloaded],
+                  [ch.ch_num for ch in manga.downloaded if ch.failed_pages],
+                  manga.serverless,
+                  volumes)
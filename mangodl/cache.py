@@ -0,0 +1,176 @@
+"""Contains the ResponseCache class, an on-disk cache for API responses."""
+
+import os
+import re
+import sys
+import time
+import sqlite3
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    NamedTuple)
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+# name of the cache file in the user's cache folder
+CACHE_NAME = 'api_cache.sqlite3'
+
+# seconds a response is used without asking the API again, by endpoint
+# chapter info holds the image server, which can change - so don't keep it for too long
+TTLS = {'manga': 24 * 60 * 60,
+        'chapters': 15 * 60,
+        'chapter': 6 * 60 * 60}
+DEFAULT_TTL = 15 * 60
+
+_ENDPOINTS = [(re.compile(r'/manga/[^/]+/chapters'), 'chapters'),
+              (re.compile(r'/manga/[^/]+$'), 'manga'),
+              (re.compile(r'/chapter/[^/]+$'), 'chapter')]
+
+
+def user_cache_dir() -> Path:
+    """
+    The folder mangodl keeps its caches in, where the platform expects
+    them: %LOCALAPPDATA% on Windows, ~/Library/Caches on macOS, and
+    $XDG_CACHE_HOME (or ~/.cache) anywhere else.
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local'
+        return Path(base) / 'mangodl' / 'Cache'
+    if sys.platform == 'darwin':
+        return Path.home() / 'Library' / 'Caches' / 'mangodl'
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'mangodl'
+
+
+def endpoint_of(url: str) -> Optional[str]:
+    """
+    Finds which API endpoint a url belongs to.
+
+    endpoint_of('https://api.mangadex.org/v2/manga/1/chapters')
+    >>>'chapters'
+    """
+    path = url.split('?')[0]
+    for pattern, name in _ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return None
+
+
+class CacheEntry(NamedTuple):
+    """A stored response. `fresh` is False once its TTL has run out."""
+    body: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fresh: bool
+
+
+class ResponseCache:
+    """
+    Stores API responses in a SQLite file. Responses are used as they are
+    until their endpoint's TTL runs out; after that they are kept so the
+    request can be made conditional on their ETag or Last-Modified header.
+
+    When the stored bodies grow past `max_bytes`, the least recently used
+    ones are dropped.
+
+    Parameters
+    ----------
+    path : str or Path, optional
+        SQLite file to use. Defaults to `CACHE_NAME` in `user_cache_dir()`.
+        Missing folders are created.
+    max_bytes : int, default 64 MiB
+        Upper bound on the total size of stored bodies.
+    ttls : dict, optional
+        Overrides for `TTLS`, keyed by endpoint name.
+
+    Attributes
+    ----------
+    total_bytes : int
+        Current size of all stored bodies.
+    """
+
+    # commit after this many writes, rather than after each one
+    COMMIT_EVERY = 50
+
+    def __init__(self,
+                 path: Union[str, Path, None] = None,
+                 max_bytes: int = 64 * 1024 * 1024,
+                 ttls: Optional[Dict[str, int]] = None):
+        self.path = Path(path) if path is not None else user_cache_dir() / CACHE_NAME
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttls = dict(TTLS, **(ttls or {}))
+
+        self.db = sqlite3.connect(str(self.path))
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS responses (
+                               url TEXT PRIMARY KEY,
+                               body TEXT NOT NULL,
+                               etag TEXT,
+                               last_modified TEXT,
+                               stored_at REAL NOT NULL,
+                               accessed_at REAL NOT NULL,
+                               size INTEGER NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS lru ON responses (accessed_at)')
+        self.total_bytes = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self._writes = 0
+
+        logger.debug(f'opened response cache with {self.total_bytes} bytes <- {self.path}')
+
+    def lookup(self, url: str) -> Optional[CacheEntry]:
+        """Returns the stored response for `url`, or None if there is none."""
+        row = self.db.execute('SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?',
+                              (url,)).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, stored_at = row
+        now = time.time()
+        self._write('UPDATE responses SET accessed_at = ? WHERE url = ?', (now, url))
+        ttl = self.ttls.get(endpoint_of(url), DEFAULT_TTL)
+        return CacheEntry(body, etag, last_modified, now - stored_at < ttl)
+
+    def store(self, url: str, body: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        """Saves a response, replacing any stored before for the same url."""
+        size = len(body.encode('utf-8'))
+        old = self.db.execute('SELECT size FROM responses WHERE url = ?', (url,)).fetchone()
+        now = time.time()
+        self._write('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (url, body, etag, last_modified, now, now, size))
+        self.total_bytes += size - (old[0] if old else 0)
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def refresh(self, url: str) -> None:
+        """Restarts the TTL of a stored response, after the API said it is unchanged."""
+        now = time.time()
+        self._write('UPDATE responses SET stored_at = ?, accessed_at = ? WHERE url = ?', (now, now, url))
+
+    def _evict(self) -> None:
+        """Drops the least recently used responses until under `max_bytes`."""
+        evicted = 0
+        rows = self.db.execute('SELECT url, size FROM responses ORDER BY accessed_at').fetchall()
+        for url, size in rows:
+            if self.total_bytes <= self.max_bytes:
+                break
+            self._write('DELETE FROM responses WHERE url = ?', (url,))
+            self.total_bytes -= size
+            evicted += 1
+        logger.debug(f'evicted {evicted} response(s) from cache')
+
+    def _write(self, sql: str, params: Tuple) -> None:
+        self.db.execute(sql, params)
+        self._writes += 1
+        if self._writes >= self.COMMIT_EVERY:
+            self.db.commit()
+            self._writes = 0
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
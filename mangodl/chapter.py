@@ -1,12 +1,11 @@
 """Contains the Chapter class."""
 
+import os
+import time
+import hashlib
 import asyncio
-import aiohttp
 import aiofiles
-from aiohttp.client_exceptions import (ClientPayloadError,
-                                       ServerDisconnectedError,
-                                       ClientConnectorError)
-from tqdm import tqdm
+from contextlib import asynccontextmanager
 from typing import (Optional,
                     Union,
                     Dict,
@@ -14,22 +13,33 @@ from typing import (Optional,
                     Tuple,
                     Iterator,
                     Awaitable,
+                    AsyncIterator,
                     Set)
 from pathlib import Path
+from urllib.parse import urlsplit
 
-from .helpers import safe_mkdir, safe_to_int, RateLimitedSession
+from .helpers import safe_mkdir, safe_to_int
 from .config import mangodl_config
-from .cli import ARGS
+from .manifest import Manifest
+from .store import PageStore
+from .client import ApiClient, ApiError
+from .retry import RetryError, StatusError, check_status, RETRY_EXCEPTIONS
 
 import logging
 logger = logging.getLogger(__name__)
 
-# set up logging prefixes for use in tqdm.write
-WARNING_PREFIX = f'{__name__} | [WARNING]: '
-ERROR_PREFIX = f'{__name__} | [ERROR]: '
-CRITICAL_PREFIX = f'{__name__} | [CRITICAL]: '
+# bytes read from the network per write when saving a page
+CHUNK_SIZE = 64 * 1024
 
-API_BASE = mangodl_config.get_api_base()
+# times a chapter may move to another image server during one download
+MAX_SERVER_SWITCHES = 2
+
+# times to ask the API for a different server before giving up on a switch
+SERVER_ASKS = 3
+
+
+class ServerDown(Exception):
+    """Raised instead of sending a request to a server which is down, once the chapter has moved to another."""
 
 
 class Chapter:
@@ -49,90 +59,324 @@ class Chapter:
     id : str or int
     url : str
     hash : str
+    number, volume : str
+        Chapter and volume numbers as the API gives them.
     ch_num : int / float / str
     vol_num : int / float / str
     ch_title : str
+    pages : list
+        Name of each page on the image server.
     page_links : list
         Image URLs for each page.
     ch_path : str
         Absolute path to the chapter's folder on disk.
+    failed_pages : list
+        Pages which could not be saved by the last download.
     """
 
+    # thousands of these can be alive at once, and the chapter info they
+    # were loaded from is not kept
+    __slots__ = ('url', 'id', 'hash', 'number', 'volume', 'ch_num', 'vol_num', 'ch_title',
+                 'pages', 'page_links', 'ch_path', 'failed_pages', '_switching', '_no_switch')
+
     def __init__(self, id: Union[str, int], saver: bool):
+        api_base = mangodl_config.get_api_base()
         if saver:
-            self.url = API_BASE + f'chapter/{id}?saver=true'
+            self.url = api_base + f'chapter/{id}?saver=true'
         else:
-            self.url = API_BASE + f'chapter/{id}'
+            self.url = api_base + f'chapter/{id}'
         self.id = id
+        self.hash: Optional[str] = None
+        self.number: Optional[str] = None
+        self.volume: Optional[str] = None
+        self.ch_num: Union[int, float, str, None] = None
+        self.vol_num: Union[int, float, str, None] = None
+        self.ch_title: Optional[str] = None
+        self.pages: Optional[List[str]] = None
+        self.page_links: Optional[List[str]] = None
+        self.ch_path: Optional[Path] = None
+        self.failed_pages: List[str] = []
+        self._switching: Optional[asyncio.Lock] = None
+        self._no_switch: Set[str] = set()  # hosts we found no way around
+
+    @classmethod
+    def from_manifest(cls,
+                      id: Union[str, int],
+                      saver: bool,
+                      manifest: Manifest,
+                      raw_path: Path,
+                      verify: bool = True) -> Optional['Chapter']:
+        """
+        Rebuilds a chapter which an earlier run saved completely, without
+        any requests. Returns None unless every page recorded in `manifest`
+        is still on disk with the right size. Without `verify`, the pages
+        aren't checked against their checksums.
+        """
+        entry = manifest.completed_chapter(id)
+        if not entry:
+            return None
+        ch_path = raw_path / entry['folder']
+        for page, page_entry in entry['pages'].items():
+            if not manifest.page_is_done(id, page, ch_path / page_entry['file'], verify):
+                return None
 
-    async def load(self, session: RateLimitedSession) -> Awaitable:
-        """Sends GET request to collect chapter info. Compiles page links at the end."""
+        chapter = cls(id, saver)
+        chapter.number, chapter.volume = entry['chapter'], entry['volume']
+        chapter.ch_num = safe_to_int(entry['chapter'])
+        chapter.vol_num = safe_to_int(entry['volume'])
+        chapter.ch_title = entry['title']
+        chapter.ch_path = ch_path
+        chapter.page_links = [page_entry['url'] for page_entry in entry['pages'].values()]
+        return chapter
 
-        tqdm.write(f'sending GET request to {self.url}')
+    async def load(self, client: ApiClient, fresh: bool = False) -> Awaitable:
+        """
+        Sends GET request to collect chapter info. Compiles page links at the end.
+        Raises client.ApiError if the chapter info could not be fetched.
+        With `fresh`, cached chapter info is not used.
+        """
 
-        # 'async with await' is used instead of 'async await' because
-        # of the way RateLimitedSession is defined
-        async with await session.get(self.url) as resp:
-            self.data = await resp.json(content_type=None)
+        logger.debug(f'sending GET request to {self.url}')
 
-        self.data = self.data['data']
-        data = self.data  # make local reference
+        data = await client.get(self.url, fresh)
         self.hash = data['hash']
+        self.number, self.volume = data['chapter'], data['volume']
         self.ch_num = safe_to_int(data['chapter'])
         self.vol_num = safe_to_int(data['volume'])
         self.ch_title = data['title']
 
-        tqdm.write(f'info loaded for chapter {self.ch_num} (id {self.id})')
+        logger.info(f'info loaded for chapter {self.ch_num} (id {self.id})')
 
-        self._get_page_links()
+        self._get_page_links(data)
 
-    def _get_page_links(self) -> None:
+    def _get_page_links(self, data: Dict) -> None:
         """
         Checks if chapter has a valid server. 
         If server info is found, stores them in `self.page_links`.
         """
         try:
-            server_base = self.data['server'] + f'{self.hash}/'
-            self.page_links = [server_base + page for page in self.data['pages']]
-            tqdm.write(f'server OK for chapter {self.ch_num} with {len(self.page_links)} pages')
+            server_base = data['server'] + f'{self.hash}/'
+            self.pages = data['pages']
+            self.page_links = [server_base + page for page in self.pages]
+            logger.info(f'server OK for chapter {self.ch_num} with {len(self.page_links)} pages')
         except KeyError as e:
-            tqdm.write(f'{ERROR_PREFIX}chapter {self.ch_num}\n{repr(e)}')
-            tqdm.write(f'{WARNING_PREFIX}no image servers for chapter id {self.id} (chapter {self.ch_num})')
+            logger.error(f'chapter {self.ch_num}\n{repr(e)}')
+            logger.warning(f'no image servers for chapter id {self.id} (chapter {self.ch_num})')
             self.page_links = None
 
-    async def download(self, session, raw_path: Path) -> Awaitable:
+    async def download(self,
+                       client: ApiClient,
+                       raw_path: Optional[Path],
+                       progress=None,
+                       manifest: Optional[Manifest] = None,
+                       store: Optional[PageStore] = None,
+                       archive=None) -> Awaitable:
         """
         Creates a folder for this chapter inside `raw_path` and saves
-        all images into the new folder.
+        all images into the new folder. Images are fetched through
+        `client.image_session`, each page taking its own slot in the pool
+        of its image server, and tick `progress` once done.
+
+        Failed pages are retried according to `client.retry`. If a page
+        still fails, the chapter info is fetched again for a different
+        server, and the remaining attempts go there. Requests to a server
+        which `client.health` shows is down go to a different server the
+        same way if there is one, and otherwise wait for it to come back.
+        Pages which still fail are listed in `self.failed_pages`, and the
+        chapter is left unfinished in the manifest so a later run picks
+        them up.
+
+        If a `manifest` is given, pages it lists as saved are skipped and
+        every newly saved page is recorded in it.
+
+        If a `store` is given, pages are saved into it and linked into the
+        chapter folder, and pages it already holds are not downloaded.
+
+        If an `archive` (a filesys.StreamingArchive) is given, pages go
+        straight into it rather than into a folder, and `raw_path`,
+        `manifest` and `store` are unused.
+
+        If `client.metrics` is set, pages are counted by outcome there,
+        along with the bytes downloaded and the time spent reading each
+        response body.
         """
+        session, pool, retry, health = client.image_session, client.pool, client.retry, client.health
+        metrics = client.metrics
+
         folder_name = f'ch {self.ch_num} ({self.ch_title})' if self.ch_title else f'ch {self.ch_num}'
-        self.ch_path = raw_path / folder_name
-        safe_mkdir(self.ch_path)
+        self.failed_pages = []
+        if archive is not None:
+            # nothing is written outside the archive
+            self.ch_path, manifest, store = None, None, None
+        else:
+            self.ch_path = raw_path / folder_name
+            safe_mkdir(self.ch_path)
+        if manifest is not None:
+            manifest.add_chapter(self.id, self.number, self.volume, self.ch_title, folder_name)
+
+        def record(page: str, url: str, page_path: Path, size: int, digest: str) -> None:
+            if manifest is not None:
+                manifest.add_page(self.id, page, url, page_path.name, size, digest)
+
+        @asynccontextmanager
+        async def image_slot(url: str) -> AsyncIterator[bool]:
+            # yields whether the request is the probe of a server which was down
+            async with pool.images_for(url):
+                # checked once the slot is ours, as the server may have gone down while we queued
+                if health.is_down(url) and await self._switch_server(client, url):
+                    # the chapter is on a server which is up now - go there rather than wait
+                    raise ServerDown(f'{urlsplit(url).netloc} is down')
+                # otherwise wait for the server to cool down, or to answer a probe
+                yield await health.wait(url)
 
-        async def download_one(session, url: str, page_path: Path) -> Awaitable:
+        async def fetch_one(page: str, url: str, page_path: Path, first_try: bool) -> Awaitable:
+            if archive is not None:
+                await fetch_into_archive(url, page_path, first_try)
+                return
+            # stream into a partial file, and only give it the real name once complete
+            if store is not None:
+                part_path = store.new_temp_path()
+            else:
+                part_path = page_path.with_name(page_path.name + '.part')
+            checksum = hashlib.sha256()
+            size = 0
+            probe = False
             try:
-                async with await session.get(url) as resp:
-                    data = await resp.read()
-                    async with aiofiles.open(page_path, 'wb') as out_file:
-                        await out_file.write(data)
-                        tqdm.write(f'saved -> {page_path}')
-            except (ServerDisconnectedError, ClientPayloadError, ClientConnectorError) as e:
-                tqdm.write(f'{ERROR_PREFIX}chapter {self.ch_num}\n{repr(e)}')
-                # just wait once second and try again
-                asyncio.sleep(1)
-                return await download_one(session, url, page_path)
-
-        async def download_all(session, urls: str) -> Awaitable:
-            tasks = []
-            for i, url in enumerate(urls):
-                page_name = f'{i+1}{url.split(".")[-1]}'
-                page_path = self.ch_path / page_name
-                tasks.append(download_one(session, url, page_path))
-            return [await task for task in tqdm(asyncio.as_completed(tasks),
-                                                total=len(tasks),
-                                                desc=f'Chapter {self.ch_num}',
-                                                bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}',
-                                                ncols=80,
-                                                leave=False)]
-
-        await download_all(session, self.page_links)
+                async with image_slot(url) as probe:
+                    async with await session.get(url) as resp:
+                        check_status(resp)
+                        start = time.perf_counter()
+                        async with aiofiles.open(part_path, 'wb') as out_file:
+                            async for data in resp.content.iter_chunked(CHUNK_SIZE):
+                                checksum.update(data)
+                                size += len(data)
+                                await out_file.write(data)
+                        if metrics is not None:
+                            host = urlsplit(url).netloc
+                            metrics.observe('transfer', time.perf_counter() - start, host=host)
+                            metrics.inc('page_bytes', size, host=host)
+            except BaseException as e:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                # retries of one bad page shouldn't make the whole server look down
+                if (first_try or probe) and isinstance(e, (StatusError,) + RETRY_EXCEPTIONS):
+                    health.record(url, False)
+                raise
+            health.record(url, True)
+            digest = checksum.hexdigest()
+            if store is not None:
+                if store.commit(part_path, digest, page_path):
+                    logger.debug(f'already stored, linked -> {page_path}')
+            else:
+                os.replace(part_path, page_path)
+            record(page, url, page_path, size, digest)
+            logger.debug(f'saved -> {page_path}')
+
+        async def fetch_into_archive(url: str, page_path: Path, first_try: bool) -> Awaitable:
+            # a page is held in memory until complete, so a failed try leaves nothing behind
+            body = bytearray()
+            probe = False
+            try:
+                async with image_slot(url) as probe:
+                    async with await session.get(url) as resp:
+                        check_status(resp)
+                        start = time.perf_counter()
+                        async for data in resp.content.iter_chunked(CHUNK_SIZE):
+                            body += data
+                        if metrics is not None:
+                            host = urlsplit(url).netloc
+                            metrics.observe('transfer', time.perf_counter() - start, host=host)
+                            metrics.inc('page_bytes', len(body), host=host)
+            except BaseException as e:
+                if (first_try or probe) and isinstance(e, (StatusError,) + RETRY_EXCEPTIONS):
+                    health.record(url, False)
+                raise
+            health.record(url, True)
+            # the buffer itself, not a copy - nothing touches it after this
+            await asyncio.get_running_loop().run_in_executor(None, archive.add, self.ch_num, page_path.name, body)
+            logger.debug(f'saved -> {archive.tmp_path.name}:{page_path.name}')
+
+        async def download_one(i: int, page: str, page_path: Path) -> Awaitable:
+            digest = store.find(page) if store is not None else None
+            result = 'downloaded'
+            if manifest is not None and manifest.page_is_done(self.id, page, page_path):
+                logger.debug(f'already saved -> {page_path}')
+                result = 'skipped'
+            elif digest:
+                store.link(digest, page_path)
+                record(page, self.page_links[i], page_path, os.path.getsize(page_path), digest)
+                logger.debug(f'already stored, linked -> {page_path}')
+                result = 'linked'
+            else:
+                for switch in range(MAX_SERVER_SWITCHES + 1):
+                    # another page may have moved the chapter to a new server already
+                    url = self.page_links[i]
+                    tries = 0
+
+                    async def attempt() -> Awaitable:
+                        nonlocal tries
+                        tries += 1
+                        await fetch_one(page, url, page_path, tries == 1)
+
+                    try:
+                        # the image slot is only held while a request is in flight, not while backing off
+                        await retry.call(attempt, f'page {page_path.name} of chapter {self.ch_num}')
+                        break
+                    except (RetryError, StatusError, ServerDown) as e:
+                        error = e
+                    if switch == MAX_SERVER_SWITCHES or not await self._switch_server(client, url):
+                        logger.error(f'could not save page {page_path.name} of chapter {self.ch_num} - {error}')
+                        self.failed_pages.append(page)
+                        result = 'failed'
+                        break
+            if metrics is not None:
+                metrics.inc('pages', result=result)
+            if progress is not None:
+                progress.update()
+
+        tasks = []
+        for i, (page, url) in enumerate(zip(self.pages, self.page_links)):
+            page_name = f'{i+1}.{url.split(".")[-1]}'
+            page_path = self.ch_path / page_name if archive is None else Path(page_name)
+            tasks.append(download_one(i, page, page_path))
+        await asyncio.gather(*tasks)
+        if self.failed_pages:
+            logger.error(f'chapter {self.ch_num} is missing {len(self.failed_pages)} page(s)')
+            return
+        if manifest is not None:
+            manifest.finish_chapter(self.id)
+        logger.info(f'chapter {self.ch_num} saved -> {self.ch_path or archive.tmp_path}')
+
+    async def _switch_server(self, client: ApiClient, failed_url: str) -> bool:
+        """
+        Asks the API again for this chapter's info, which may name a
+        different image server, after a page failed at `failed_url`.
+        Returns True if the pages now point at a different server.
+        """
+        if self._switching is None:
+            self._switching = asyncio.Lock()
+        # one page asks, the rest wait and reuse the answer
+        async with self._switching:
+            failed_host = urlsplit(failed_url).netloc
+            if urlsplit(self.page_links[0]).netloc != failed_host:
+                return True
+            if failed_host in self._no_switch:
+                return False
+            logger.warning(f'{failed_host} is failing chapter {self.ch_num} - looking for another server')
+            before = (self.hash, self.pages, self.page_links)
+            for _ in range(SERVER_ASKS):
+                try:
+                    await self.load(client, fresh=True)
+                except ApiError as e:
+                    logger.error(f'could not reload chapter {self.ch_num} - {e}')
+                    break
+                if not self.page_links or self.pages != before[1]:
+                    # no server, or the pages changed - can't mix them with the ones we have
+                    break
+                new_host = urlsplit(self.page_links[0]).netloc
+                if new_host != failed_host and not client.health.is_down(self.page_links[0]):
+                    logger.info(f'chapter {self.ch_num} moved from {failed_host} to {new_host}')
+                    return True
+            self.hash, self.pages, self.page_links = before
+            self._no_switch.add(failed_host)
+            return False
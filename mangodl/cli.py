@@ -1,20 +1,20 @@
 """
-This is the first line of code to run (after logging configuration).
 Manages command line args and other required variables.
+Nothing happens on import - the app calls parse_args() when it starts.
 
 Interfaces with config.mangodl.ini.
 """
 
 import argparse
 import os
+from typing import Optional, List
 from .config import mangodl_config
+from .volumes import STRATEGIES
+from .writers import FORMATS
 
 import logging
 logger = logging.getLogger(__name__)
 
-# welcome line
-print('****** (ﾉ◕ヮ◕)ﾉ*:･ﾟ✧ Welcome to Mango Downloads! (◠‿◠✿) ******')
-
 _desc = """
         Download manga from the command line through the mangadex API. 
 
@@ -25,62 +25,140 @@ _desc = """
         If you wish to suppress this, run mangodl --url <url_to_manga> 
         to download directly without login.
 
+        To fetch only the chapters released since your last download,
+        run mangodl sync <manga_id> [<manga_id> ...].
+
         All arguments are optional - the app will prompt you for 
         anything it needs but doesn't have.
         """
 
-argparser = argparse.ArgumentParser(prog='mangodl',
-                                    usage='%(prog)s [options]',
-                                    description=_desc,
-                                    formatter_class=argparse.RawTextHelpFormatter)
-
-# manga title
-argparser.add_argument('-m', '--manga', metavar='MANGA', action='store', type=str,
-                       help='name of the manga to download')
-
-# root directory for downloads
-argparser.add_argument('-f', '--folder', metavar='DOWNLOAD_DIRECTORY', action='store', type=str,
-                       default=mangodl_config.get_root_dir(),
-                       help='absolute path to download folder')
-
-# username
-argparser.add_argument('-u', '--username', metavar='USERNAME', action='store', type=str,
-                       help='mangadex username')
-
-# password
-argparser.add_argument('-p', '--password', metavar='PASSWORD', action='store', type=str,
-                       help='mangadex password')
-
-# archive to volumes or not
-argparser.add_argument('--novolume', action='store_true',
-                       help='don\'t automatically compile into volumes')
-
-# default chapters per volume
-argparser.add_argument('--vollen', metavar='VOLUME_LENGTH', action='store', type=int, default=10,
-                       help='number of chapters per volume to default to, if mangadex did not assign (defaults to %(default)s)')
-
-# language
-argparser.add_argument('-l', '--language', metavar='LANGUAGE', action='store', type=str,
-                       default='gb', help='select manga language (defaults to english)')
-
-# use low quality images
-argparser.add_argument('-s', '--saver', action='store_true',
-                       help='use low quality images')
-
-# rate limit when downloading images
-argparser.add_argument('--ratelimit', metavar='LIMIT', action='store', type=int, default=30,
-                       help='limit number of requests per second (defaults to %(default)s)')
-
-# download by url
-argparser.add_argument('--url', metavar='URL', action='store', type=str, nargs='+',
-                       help='url to the manga on mangadex - using this will download directly without logging into mangadex')
-
-# download all chapters, don't prompt
-argparser.add_argument('--all', action='store_true',
-                       help='don\'t prompt to ask which chapters to download, just download every chapter found')
-
 
-ARGS = argparser.parse_args()
+def positive_int(value: str) -> int:
+    """Argument type for limits and counts, which must be 1 or more."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value!r} is not a whole number') from None
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {number}')
+    return number
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Builds the parser for the command line options."""
+    argparser = argparse.ArgumentParser(prog='mangodl',
+                                        usage='%(prog)s [options] [sync MANGA_ID [MANGA_ID ...]]',
+                                        description=_desc,
+                                        formatter_class=argparse.RawTextHelpFormatter)
+
+    # manga title
+    argparser.add_argument('-m', '--manga', metavar='MANGA', action='store', type=str,
+                           help='name of the manga to download')
+
+    # root directory for downloads
+    argparser.add_argument('-f', '--folder', metavar='DOWNLOAD_DIRECTORY', action='store', type=str,
+                           default=mangodl_config.get_root_dir(),
+                           help='absolute path to download folder')
+
+    # username
+    argparser.add_argument('-u', '--username', metavar='USERNAME', action='store', type=str,
+                           help='mangadex username')
+
+    # password
+    argparser.add_argument('-p', '--password', metavar='PASSWORD', action='store', type=str,
+                           help='mangadex password')
+
+    # archive to volumes or not
+    argparser.add_argument('--novolume', action='store_true',
+                           help='don\'t automatically compile into volumes')
+
+    # default chapters per volume
+    argparser.add_argument('--vollen', metavar='VOLUME_LENGTH', action='store', type=positive_int, default=10,
+                           help='number of chapters per volume to default to, if mangadex did not assign (defaults to %(default)s)')
+
+    # how to place chapters without a volume
+    argparser.add_argument('--volstrategy', metavar='STRATEGY', action='store', type=str, default='chapters',
+                           choices=STRATEGIES,
+                           help='how to place chapters mangadex did not assign a volume - \'chapters\' fits them around the chapters which have one, '
+                                '\'timestamps\' also places new chapters by how often volumes came out so far (defaults to %(default)s)')
+    argparser.add_argument('--volmap', metavar='FILE', action='store', type=str,
+                           help='.json or .csv file mapping chapter numbers to volumes, which overrides mangadex')
+
+    # language
+    argparser.add_argument('-l', '--language', metavar='LANGUAGE', action='store', type=str,
+                           default='gb', help='select manga language (defaults to english)')
+
+    # use low quality images
+    argparser.add_argument('-s', '--saver', action='store_true',
+                           help='use low quality images')
+
+    # rate limit when downloading images
+    argparser.add_argument('--ratelimit', metavar='LIMIT', action='store', type=positive_int, default=30,
+                           help='number of requests per second to start at - adjusted from the server\'s responses (defaults to %(default)s)')
+    argparser.add_argument('--fixedrate', action='store_true',
+                           help='keep to --ratelimit instead of adjusting it, though still wait when the server asks to')
+
+    # concurrency limits
+    argparser.add_argument('--metalimit', metavar='LIMIT', action='store', type=positive_int, default=4,
+                           help='limit number of chapter info requests in flight (defaults to %(default)s)')
+    argparser.add_argument('--imagelimit', metavar='LIMIT', action='store', type=positive_int, default=16,
+                           help='limit number of images downloading at once from each image server, across all chapters (defaults to %(default)s)')
+
+    # write several volume archives at once
+    argparser.add_argument('--archiveworkers', metavar='WORKERS', action='store', type=positive_int, default=4,
+                           help='number of volume archives written at the same time (defaults to %(default)s)')
+
+    # what to write volumes as
+    argparser.add_argument('--format', metavar='FORMAT', action='store', type=str, default='cbz', choices=FORMATS,
+                           help=f'format to write volumes in - one of {", ".join(FORMATS)} (defaults to %(default)s)')
+    argparser.add_argument('--level', metavar='LEVEL', action='store', type=int, default=0, choices=range(10),
+                           help='compression level of volumes from 0 to 9 - pages are compressed already, '
+                                'so 0 is fastest and barely bigger (defaults to %(default)s)')
+
+    # skip the raw folder
+    argparser.add_argument('--direct', metavar='ARCHIVE', action='store', type=str, choices=('volume', 'chapter'),
+                           help='write pages straight into a .cbz per volume or per chapter, without keeping raw files - '
+                                'downloads can\'t be resumed or synced later')
+
+    # don't reuse API responses from earlier runs
+    argparser.add_argument('--nocache', action='store_true',
+                           help='always ask the API for fresh manga and chapter info, instead of using what was stored by earlier runs')
+    argparser.add_argument('--cachepath', metavar='FILE', action='store', type=str,
+                           help='file to store manga and chapter info in (defaults to one in your user cache folder)')
+
+    # trust the size of pages saved before
+    argparser.add_argument('--noverify', action='store_true',
+                           help='skip pages saved by earlier runs if their size is right, without checking their checksums - '
+                                'faster for large collections, but damaged pages are kept')
+
+    # metrics for the download pipeline
+    argparser.add_argument('--metrics', metavar='FILE', action='store', type=str,
+                           help='append timings and counts from downloads to FILE, one json object per line')
+    argparser.add_argument('--metricsport', metavar='PORT', action='store', type=int,
+                           help='serve timings and counts from downloads for prometheus at http://127.0.0.1:PORT/metrics')
+
+    # download by url
+    argparser.add_argument('--url', metavar='URL', action='store', type=str, nargs='+',
+                           help='url to the manga on mangadex - using this will download directly without logging into mangadex')
+
+    # download all chapters, don't prompt
+    argparser.add_argument('--all', action='store_true',
+                           help='don\'t prompt to ask which chapters to download, just download every chapter found')
+
+    # sync subcommand
+    subparsers = argparser.add_subparsers(dest='command', metavar='COMMAND')
+    sync_parser = subparsers.add_parser('sync',
+                                        help='download only chapters which are new since the last download',
+                                        description='Download only chapters which are new since the last download, '
+                                                    'and rebuild only the volumes they fall into. Never prompts.')
+    sync_parser.add_argument('ids', metavar='MANGA_ID', nargs='+',
+                             help='mangadex id of a manga downloaded before')
+
+    return argparser
+
+
+# parsed options - set by parse_args()
+ARGS: Optional[argparse.Namespace] = None
 
 
 def check_title() -> None:
@@ -148,9 +226,33 @@ def check_password() -> None:
         mangodl_config.set_password(ARGS.password)
 
 
-# run checks
-check_folder()
-if not ARGS.url:
-    check_title()
-    check_username()
-    check_password()
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    Greets the user, parses `argv` (by default, the command line) into
+    `ARGS` and prompts for anything still missing.
+    """
+    global ARGS
+
+    # welcome line
+    print('****** (ﾉ◕ヮ◕)ﾉ*:･ﾟ✧ Welcome to Mango Downloads! (◠‿◠✿) ******')
+
+    argparser = make_parser()
+    ARGS = argparser.parse_args(argv)
+    if ARGS.direct == 'volume' and ARGS.novolume:
+        argparser.error('--direct volume archives into volumes, so it can\'t go with --novolume')
+    if ARGS.direct and ARGS.format != 'cbz':
+        argparser.error('--direct only writes cbz archives')
+    if ARGS.direct and ARGS.command == 'sync':
+        argparser.error('sync needs the raw files, so it can\'t go with --direct')
+
+    # run checks
+    check_folder()
+    if not ARGS.url and not ARGS.command:
+        check_title()
+        check_username()
+        check_password()
+
+    # write whatever the checks changed in one go
+    mangodl_config.save()
+
+    return ARGS
@@ -0,0 +1,150 @@
+"""Contains the ApiClient class, which talks to the mangadex API asynchronously."""
+
+import json
+import asyncio
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set)
+
+from .cache import ResponseCache
+from .health import ServerHealth
+from .config import mangodl_config
+from .helpers import ConcurrencyPool
+from .metrics import Metrics
+from .ratelimit import RateLimitedSession
+from .retry import RetryPolicy, RetryError, StatusError, RETRY_EXCEPTIONS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ApiError(Exception):
+    """Raised when the API cannot give us the data we asked for."""
+
+
+class ApiClient:
+    """
+    Sends requests to the mangadex API through a shared session, so
+    keep-alive connections are reused across every manga and chapter.
+
+    Parameters
+    ----------
+    session : RateLimitedSession
+    pool : ConcurrencyPool
+        Every API request takes a slot from `pool.metadata`.
+    api_base : str, optional
+        Defaults to the API base in the config file.
+    retry : RetryPolicy, optional
+        How failed requests are retried before raising ApiError.
+    cache : ResponseCache, optional
+        If given, fresh responses are served from it, and stale ones are
+        revalidated with a conditional request.
+    image_session : RateLimitedSession, optional
+        Session for image downloads, with its own connections. Defaults
+        to `session`.
+    metrics : Metrics, optional
+        Where this client, and callers using it, record what they do.
+
+    Attributes
+    ----------
+    session : RateLimitedSession
+    pool : ConcurrencyPool
+        Also used by callers for image downloads.
+    image_session : RateLimitedSession
+        Used by callers for image downloads, so images never take the
+        connections meant for API calls.
+    retry : RetryPolicy
+        Also used by callers for image downloads, so they share its budget.
+    health : ServerHealth
+        Scoreboard of the image servers, filled in by callers.
+    metrics : Metrics or None
+    """
+
+    def __init__(self,
+                 session: RateLimitedSession,
+                 pool: ConcurrencyPool,
+                 api_base: Optional[str] = None,
+                 retry: Optional[RetryPolicy] = None,
+                 cache: Optional[ResponseCache] = None,
+                 image_session: Optional[RateLimitedSession] = None,
+                 metrics: Optional[Metrics] = None):
+        self.session = session
+        self.image_session = image_session if image_session is not None else session
+        self.pool = pool
+        self.api_base = api_base if api_base is not None else mangodl_config.get_api_base()
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.health = ServerHealth()
+        self.cache = cache
+        self.metrics = metrics
+
+    async def get(self, url: str, fresh: bool = False) -> Dict:
+        """
+        Sends a GET request to an API url, and returns the 'data' section
+        of the JSON response. Raises ApiError if every attempt fails.
+        With `fresh`, the cache is not consulted - though the response
+        still goes into it.
+        """
+        entry = self.cache.lookup(url) if self.cache and not fresh else None
+        if entry and entry.fresh:
+            logger.debug(f'using cached response for {url}')
+            if self.metrics is not None:
+                self.metrics.inc('api_cache', result='hit')
+            return json.loads(entry.body)['data']
+
+        # ask the API to answer 304 if our stored copy is still good
+        headers = {}
+        if entry and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        async def attempt() -> Dict:
+            async with self.pool.metadata:
+                async with await self.session.get(url, headers=headers) as resp:
+                    if resp.status == 304 and entry:
+                        logger.debug(f'cached response for {url} is still valid')
+                        if self.metrics is not None:
+                            self.metrics.inc('api_cache', result='revalidated')
+                        self.cache.refresh(url)
+                        return json.loads(entry.body)['data']
+                    if resp.status in self.retry.retry_statuses:
+                        raise StatusError(resp.status, resp.headers.get('Retry-After'))
+                    text = await resp.text()
+                    body = json.loads(text)
+                    if 'data' not in body:
+                        raise ApiError(f'no data in response from {url} (status {resp.status})')
+                    if self.metrics is not None:
+                        self.metrics.inc('api_cache', result='miss' if self.cache else 'off')
+                    if self.cache and resp.status == 200:
+                        self.cache.store(url, text, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+                    return body['data']
+
+        try:
+            # a garbled body is worth asking for again too
+            return await self.retry.call(attempt, url, RETRY_EXCEPTIONS + (ValueError,))
+        except RetryError as e:
+            raise ApiError(str(e)) from e
+
+    async def get_manga(self, id: Union[str, int]) -> Tuple[Dict, List[Dict]]:
+        """Fetches a manga's info and its chapter list at the same time."""
+        url = self.api_base + f'manga/{id}'
+        data, chs = await asyncio.gather(self.get(url), self.get(url + '/chapters'))
+        return data, chs['chapters']
+
+    async def get_mangas(self, ids: List[Union[str, int]]) -> List[Optional[Tuple[Dict, List[Dict]]]]:
+        """
+        Fetches several manga at once. Manga which could not be fetched
+        are logged and come back as None.
+        """
+        results = await asyncio.gather(*(self.get_manga(id) for id in ids), return_exceptions=True)
+        for id, res in zip(ids, results):
+            if isinstance(res, ApiError):
+                logger.error(f'could not get info for manga {id} - {res}')
+            elif isinstance(res, BaseException):
+                raise res
+        return [None if isinstance(res, BaseException) else res for res in results]
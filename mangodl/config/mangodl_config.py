@@ -1,91 +1,134 @@
 """
-Initializes config file if it doesn't already exist, and 
-defines functions to interface with the config file.
+Defines functions to interface with the config file.
+
+The file is read once, on first use, and kept in memory. Changes are
+only written by `save()` - once, however many settings were changed -
+and at exit if anything is still unsaved. A missing config file is
+not created until a setting is changed, so just using the defaults
+writes nothing.
+
+Set the MANGODL_CONFIG environment variable to use another config file.
 """
 
+import atexit
 import configparser
+import os
 from pathlib import Path
+from typing import Optional
 import logging
 logger = logging.getLogger(__name__)
 
-CONFIG_FILE = Path(__file__).parent / 'mangodl_config.ini'
-config = configparser.ConfigParser()
-# check if config file exists
-if not CONFIG_FILE.exists():
-    config['links'] = {}
-    config['links']['api_base'] = 'https://api.mangadex.org/v2/'
-    config['links']['search_url'] = 'https://mangadex.org/search?tag_mode_exc=any&tag_mode_inc=all&title='
-    config['links']['login_url'] = 'https://mangadex.org/ajax/actions.ajax.php?function=login&nojs=1'
-    config['user info'] = {}
-    config['settings'] = {}
-    with open(CONFIG_FILE, 'w') as f:
-        config.write(f)
+CONFIG_FILE = Path(os.environ.get('MANGODL_CONFIG') or Path(__file__).parent / 'mangodl_config.ini')
+
+DEFAULTS = {
+    'links': {
+        'api_base': 'https://api.mangadex.org/v2/',
+        'search_url': 'https://mangadex.org/search?tag_mode_exc=any&tag_mode_inc=all&title=',
+        'login_url': 'https://mangadex.org/ajax/actions.ajax.php?function=login&nojs=1',
+    },
+    'user info': {},
+    'settings': {},
+}
+
+
+class Config:
+    """
+    The config file, cached in memory.
+
+    Parameters
+    ----------
+    path : Path
+        INI file to read from and save to.
+
+    Attributes
+    ----------
+    dirty : bool
+        True if there are changes which haven't been saved.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.dirty = False
+        self._parser: Optional[configparser.ConfigParser] = None
+
+    @property
+    def parser(self) -> configparser.ConfigParser:
+        if self._parser is None:
+            self._parser = configparser.ConfigParser()
+            if self.path.exists():
+                self._parser.read(self.path)
+            else:
+                # no config file yet - start from the defaults, which are written along with the first change
+                self._parser.read_dict(DEFAULTS)
+            logger.debug(f'loaded config <- {self.path}')
+        return self._parser
+
+    def get(self, section: str, key: str) -> Optional[str]:
+        try:
+            return self.parser[section][key]
+        except KeyError:
+            return None
+
+    def set(self, section: str, key: str, value: str) -> None:
+        if self.get(section, key) == value:
+            return
+        if not self.parser.has_section(section):
+            self.parser.add_section(section)
+        self.parser[section][key] = value
+        self.dirty = True
+
+    def save(self) -> None:
+        """Writes the config file, if anything changed since it was last read or saved."""
+        if not self.dirty:
+            return
+        tmp_path = self.path.with_name(self.path.name + '.part')
+        with open(tmp_path, 'w') as f:
+            self.parser.write(f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+        logger.debug(f'saved config -> {self.path}')
+
+
+config = Config(CONFIG_FILE)
+# don't lose settings changed after the last explicit save
+atexit.register(config.save)
+
+
+def save() -> None:
+    config.save()
 
 
 def get_username() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['user info']['username']
-    except KeyError:
-        pass
+    return config.get('user info', 'username')
 
 
 def set_username(new_username: str):
-    config.read(CONFIG_FILE)
-    config['user info']['username'] = new_username
-    with open(CONFIG_FILE, 'w') as f:
-        config.write(f)
+    config.set('user info', 'username', new_username)
 
 
 def get_password() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['user info']['password']
-    except KeyError:
-        pass
+    return config.get('user info', 'password')
 
 
 def set_password(new_password: str):
-    config.read(CONFIG_FILE)
-    config['user info']['password'] = new_password
-    with open(CONFIG_FILE, 'w') as f:
-        config.write(f)
+    config.set('user info', 'password', new_password)
 
 
 def get_api_base() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['links']['api_base']
-    except KeyError:
-        return None
+    return config.get('links', 'api_base')
 
 
 def get_search_url() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['links']['search_url']
-    except KeyError:
-        return None
+    return config.get('links', 'search_url')
 
 
 def get_login_url() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['links']['login_url']
-    except KeyError:
-        return None
+    return config.get('links', 'login_url')
 
 
 def get_root_dir() -> str:
-    config.read(CONFIG_FILE)
-    try:
-        return config['settings']['root_dir']
-    except KeyError:
-        return None
+    return config.get('settings', 'root_dir')
 
 
 def set_root_dir(p: str):
-    config.read(CONFIG_FILE)
-    config['settings']['root_dir'] = p
-    with open(CONFIG_FILE, 'w') as f:
-        config.write(f)
+    config.set('settings', 'root_dir', p)
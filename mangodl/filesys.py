@@ -1,9 +1,10 @@
 """Contains the FileSys class for file operations."""
 
 import os
-import shutil
-from distutils.dir_util import copy_tree
-from tqdm import tqdm
+import threading
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import (Optional,
                     Union,
                     Dict,
@@ -17,17 +18,21 @@ from pathlib import Path
 from .config import mangodl_config
 from .helpers import safe_mkdir
 from .chapter import Chapter
+from .manifest import Manifest
+from .store import PageStore
+from .writers import open_writer, zip_options, FORMATS
 
 import logging
 logger = logging.getLogger(__name__)
 
-# set up from config
-ROOT_DIR: Path = mangodl_config.get_root_dir()
+# lives in the manga's base folder and lists what has been saved to raw/
+MANIFEST_NAME = 'manifest.jsonl'
 
-# set up logging prefixes for use in tqdm.tqdm.write
-WARNING_PREFIX = f'{__name__} | [WARNING]: '
-ERROR_PREFIX = f'{__name__} | [ERROR]: '
-CRITICAL_PREFIX = f'{__name__} | [CRITICAL]: '
+# lives in the manga's base folder and maps each chapter to its volume
+VOLUME_MAP_NAME = 'volumes.json'
+
+# lives in the root directory and holds the page images of every manga
+STORE_NAME = '.mangodl-store'
 
 
 class FileSys:
@@ -40,107 +45,263 @@ class FileSys:
     manga_title : str
         Title of manga downloaded. This will be used in naming the directories
         and files.
+    root_dir : str or Path, optional
+        Folder to download into. Defaults to the root directory in the
+        config file.
+    out_format : str, default 'cbz'
+        Format volumes are written in - one of `writers.FORMATS`.
+    level : int, default 0
+        Compression level of the volumes, from 0 (none) to 9.
+    verify : bool, default True
+        Check saved pages against their checksums in the manifest before
+        reusing them - see `Manifest`.
 
     Attributes
     ----------
     base_path : Path
         Absolute path to base directory for this manga. This is inside the 
-        root directory specified by the user and stored as the global `ROOT_DIR`.
+        root directory specified by the user.
     raw_path : Path
         Folder within `base_path` to contain raw chapters.
+    vols_path : Path
+        Folder within `base_path` to contain volume archives.
+    manifest : Manifest
+        Record of the chapters and pages saved inside `raw_path`.
+    volume_map_path : Path
+        Where the volume of each chapter is saved, so later runs give
+        chapters the same volumes.
+    store : PageStore
+        Holds the one copy of each page image, shared by every manga in
+        the root directory. Pages in `raw_path` are hardlinks into it.
 
     Methods
     -------
-        create_volumes(downloaded)
+        create_volumes(downloaded, workers=1)
             Archives chapters into respective volumes.
-        to_cbz(dir_to_zip, destination)
-            Creates a .cbz archive for a folder.
+        archive_volume(chapters)
+            Archives the chapters of a single volume.
+        chapter_pages(ch_path)
+            Lists the pages in a chapter folder, in order.
+        write_archive(entries, name)
+            Writes one volume from a list of files, in `out_format`.
     """
 
-    def __init__(self, manga_title: str):
+    def __init__(self,
+                 manga_title: str,
+                 root_dir: Union[str, Path, None] = None,
+                 out_format: str = 'cbz',
+                 level: int = 0,
+                 verify: bool = True):
+        if out_format not in FORMATS:
+            raise ValueError(f'unknown format {out_format!r} - use one of {", ".join(FORMATS)}')
+        # read the config now rather than at import - the user may only just have chosen a folder
+        root_dir = Path(root_dir if root_dir is not None else mangodl_config.get_root_dir())
         self.manga_title = manga_title
-        self.base_path = Path(ROOT_DIR) / self.manga_title
+        self.base_path = root_dir / self.manga_title
         self.raw_path = self.base_path / 'raw'  # where we download the raw images
+        self.vols_path = self.base_path / self.manga_title  # where we put the finished volumes
+        self.manifest = Manifest(self.base_path / MANIFEST_NAME, verify)
+        self.volume_map_path = self.base_path / VOLUME_MAP_NAME
+        self.store = PageStore(root_dir / STORE_NAME)
+        self.out_format = out_format
+        self.level = level
 
-    def setup_folders(self) -> None:
+    def setup_folders(self, raw: bool = True) -> None:
+        """Creates the folders for a download. Without `raw`, only the base folder."""
         safe_mkdir(self.base_path)
-        safe_mkdir(self.raw_path)
+        if raw:
+            safe_mkdir(self.raw_path)
+            self.store.setup_folders()
+
+    def volume_name(self, vol_num: Union[int, float, str]) -> str:
+        return f'{self.manga_title}, Vol. {vol_num}'
+
+    def chapter_name(self, ch_num: Union[int, float, str], ch_title: Optional[str], ch_id: Union[str, int]) -> str:
+        """Name for an archive of a single chapter."""
+        if isinstance(ch_num, (int, float)):
+            return f'{self.manga_title}, Ch. {ch_num}'
+        # has no chapter number
+        return ch_title or f'{self.manga_title}, {ch_id}'
+
+    def open_archive(self, name: str, folders: bool = True) -> 'StreamingArchive':
+        """Starts an archive in `self.vols_path` to write pages into as they download."""
+        if self.out_format != 'cbz':
+            # other formats can't be put in order once written
+            raise ValueError(f'pages can only be written straight into cbz archives, not {self.out_format}')
+        safe_mkdir(self.vols_path)
+        return StreamingArchive(self.vols_path / f'{name}.cbz', folders, self.level)
 
-    def create_volumes(self, downloaded: List[Chapter]) -> None:
+    def create_volumes(self, downloaded: List[Chapter], workers: int = 1) -> None:
         """
         Archives chapters into respective volumes.
 
-        Creates a new folder inside `self.base_path` and creates archives
-        inside the new folder.
+        Creates a new folder inside `self.base_path` and writes one archive
+        per volume inside the new folder, straight from the raw chapter
+        folders. Up to `workers` archives are written at the same time.
 
         Parameters
         ----------
         downloaded : array_like
             Chapter instances of downloaded chapters.
+        workers : int, default 1
+            Number of threads writing archives.
 
         Returns
         -------
         None
         """
+        from tqdm import tqdm
+
         logger.info('(っ˘ڡ˘ς) preparing to compile into volumes...')
+        safe_mkdir(self.vols_path)
 
-        # make a new folder to store compiled volumes
-        vols_path = self.base_path / self.manga_title
-        safe_mkdir(vols_path)
-
-        # copy raw chapters
-        for ch in tqdm(downloaded,
-                       total=len(downloaded),
-                       desc=f'Copying files',
-                       bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}',
-                       ncols=80,
-                       leave=False):
-            if ch.ch_num == '_':
-                # has no volume number
-                new_ch_path = vols_path / ch.ch_title
-            else:
-                new_ch_path = vols_path / f'{self.manga_title}, Vol. {ch.vol_num}' / f'{ch.ch_num}'
-            copy_tree(ch.ch_path, new_ch_path)
-            tqdm.write(f'copied {ch.ch_path} -> {new_ch_path}')
+        volumes = self._volume_entries(downloaded)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.write_archive, entries, vol_name)
+                       for vol_name, entries in volumes.items()]
+            for future in tqdm(as_completed(futures),
+                               total=len(futures),
+                               desc=f'Archiving into volumes',
+                               bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}',
+                               ncols=80,
+                               leave=False):
+                future.result()
+
+    def archive_volume(self, chapters: List[Chapter]) -> List[Path]:
+        """
+        Archives the chapters of one volume, as soon as they are all
+        downloaded. Called from worker threads, so it only touches files
+        belonging to this volume. Returns the paths of the archives written.
+        """
+        safe_mkdir(self.vols_path)
+        archive_paths = []
+        for vol_name, entries in self._volume_entries(chapters).items():
+            archive_paths.append(self.write_archive(entries, vol_name))
+        return archive_paths
 
-        for raw_vol in tqdm(os.scandir(vols_path),
-                            total=len(os.listdir(vols_path)),
-                            desc=f'Archiving into volumes',
-                            bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}',
-                            ncols=80,
-                            leave=False):
+    def _volume_entries(self, chapters: List[Chapter]) -> Dict[str, List[Tuple[Path, str]]]:
+        """Works out which pages go into which archive, and under what name."""
+        volumes: Dict[str, List[Tuple[Path, str]]] = defaultdict(list)
+        for ch in sorted(chapters, key=lambda ch: (not isinstance(ch.ch_num, (int, float)), ch.ch_num)):
+            if not isinstance(ch.ch_num, (int, float)):
+                # has no chapter number, so no place in a volume
+                vol_name, ch_folder = self.chapter_name(ch.ch_num, ch.ch_title, ch.id), ''
+            else:
+                vol_name, ch_folder = self.volume_name(ch.vol_num), f'{ch.ch_num}/'
+            for page_path in self.chapter_pages(ch.ch_path):
+                volumes[vol_name].append((page_path, ch_folder + page_path.name))
+        return volumes
 
-            self.to_cbz(Path(raw_vol.path), vols_path)
+    @staticmethod
+    def chapter_pages(ch_path: Path) -> List[Path]:
+        """Lists the saved pages in a chapter folder, in page order."""
+        def page_order(page_path: Path) -> Tuple:
+            stem = page_path.stem
+            return (0, int(stem), '') if stem.isdigit() else (1, 0, page_path.name)
 
-            # delete the non-archived folder
-            shutil.rmtree(raw_vol.path)
+        pages = [Path(entry.path) for entry in os.scandir(ch_path)
+                 if entry.is_file() and not entry.name.endswith(('.part', '.link'))]
+        return sorted(pages, key=page_order)
 
-    @ staticmethod
-    def to_cbz(dir_to_zip: Path, destination: Path) -> None:
+    def write_archive(self, entries: List[Tuple[Path, str]], name: str) -> Path:
         """
-        Creates .cbz file. Both arguments must be pathlib.Path objects.
+        Writes a volume in `self.out_format` from a list of files, streaming
+        each into the archive without staging them in a folder first.
 
         Parameters
         ----------
-        dir_to_zip : Path
-            Absolute path to folder which we want to zip.
-        destination : Path
-            Where to store the new archive.
+        entries : list
+            (file path, name inside archive) tuples, in the order to store them.
+        name : str
+            Name of the volume. The archive goes in `self.vols_path`, with
+            the suffix of the format, and replaces any archive already there.
 
         Returns
         -------
-        None
+        Path
+            Where the archive was written.
+        """
+        with open_writer(self.out_format, self.vols_path / name, self.level) as writer:
+            for page_path, arcname in entries:
+                writer.add(arcname, page_path)
+        return writer.path
+
+
+class StreamingArchive:
+    """
+    A .cbz archive written a page at a time as pages download, so pages
+    never have to be saved as files first. It lives under a temporary
+    name until `finish` is called. Pages may be added from several
+    threads at once.
+
+    Pages are written in the order they arrive, but listed in chapter and
+    page order, which is the order readers go by.
+
+    Parameters
+    ----------
+    path : Path
+        Where the finished archive goes.
+    folders : bool, default True
+        Put each chapter's pages in a folder named after the chapter, as
+        in volume archives.
+    level : int, default 0
+        Compression level, from 0 (none) to 9.
+
+    Attributes
+    ----------
+    pages : int
+        Number of pages in the archive.
+    """
+
+    def __init__(self, path: Path, folders: bool = True, level: int = 0):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + '.part')
+        self.folders = folders
+        self._zf = zipfile.ZipFile(self.tmp_path, 'w', **zip_options(level))
+        self._order: Dict[str, Tuple] = {}  # name inside archive -> sort key
+        self._lock = threading.Lock()
+
+    @property
+    def pages(self) -> int:
+        return len(self._order)
+
+    def add(self, ch_num: Union[int, float, str], page_name: str, data: Union[bytes, bytearray]) -> None:
+        """
+        Stores page `page_name` (like '12.png') of chapter `ch_num`. `data`
+        is written as it is, so a bytearray isn't copied first.
+        """
+        arcname = f'{ch_num}/{page_name}' if self.folders else page_name
+        stem = page_name.split('.')[0]
+        with self._lock:
+            self._zf.writestr(arcname, data)
+            self._order[arcname] = (ch_num, int(stem) if stem.isdigit() else 0, page_name)
+
+    def drop(self, ch_num: Union[int, float, str]) -> None:
+        """
+        Leaves the pages of chapter `ch_num` out of the archive. Their
+        bytes stay in the file, but nothing lists them.
         """
-        os.chdir(dir_to_zip)
-        archive_name = dir_to_zip.stem
-        archive_path = destination / archive_name
-        new_vol_path = shutil.make_archive(base_name=archive_path, format='zip')
-        new_vol_path = Path(new_vol_path)  # convert to pathlib.Path object
-        tqdm.write(f'created archive {new_vol_path} <- {archive_name}')
-
-        # change ext to .cbz
-        with_cbz_ext = new_vol_path.with_suffix('.cbz')
-        os.rename(new_vol_path, with_cbz_ext)
-
-        tqdm.write(f'renamed {new_vol_path} -> {with_cbz_ext}')
-        tqdm.write(f'>>>>>>( ^_^）o自  {archive_name} compiled  自o（^_^ )<<<<<<')
+        with self._lock:
+            self._zf.filelist = [zinfo for zinfo in self._zf.filelist if self._order[zinfo.filename][0] != ch_num]
+            for arcname in [name for name, key in self._order.items() if key[0] == ch_num]:
+                del self._order[arcname]
+                del self._zf.NameToInfo[arcname]
+
+    def finish(self) -> Path:
+        """Writes the archive's listing, in page order, and gives it its real name."""
+        with self._lock:
+            self._zf.filelist.sort(key=lambda zinfo: self._order[zinfo.filename])
+            self._zf.close()
+            os.replace(self.tmp_path, self.path)
+        logger.info(f'created archive {self.path} <- {self.pages} pages')
+        logger.info(f'>>>>>>( ^_^）o自  {self.path.stem} compiled  自o（^_^ )<<<<<<')
+        return self.path
+
+    def abort(self) -> None:
+        """Throws away an unfinished archive."""
+        with self._lock:
+            try:
+                self._zf.close()
+            finally:
+                if os.path.exists(self.tmp_path):
+                    os.remove(self.tmp_path)
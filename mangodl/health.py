@@ -0,0 +1,180 @@
+"""Contains the ServerHealth class, a scoreboard for image servers."""
+
+import time
+import asyncio
+from collections import deque
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable,
+                    Deque)
+from urllib.parse import urlsplit
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# seconds between checks on a server whose probe is still out
+PROBE_POLL = 0.2
+
+
+class _Score:
+    __slots__ = ('ok', 'failed', 'recent', 'recent_failed', 'down_since', 'probe_started', 'waiting', 'tickets')
+
+    def __init__(self):
+        self.ok = 0
+        self.failed = 0
+        self.recent: Deque[Tuple[float, bool]] = deque()  # (time, ok) of the requests in the window
+        self.recent_failed = 0
+        self.down_since: Optional[float] = None
+        self.probe_started: Optional[float] = None
+        self.waiting: Set[int] = set()  # tickets of the requests waiting for the server, in order of arrival
+        self.tickets = 0
+
+
+class ServerHealth:
+    """
+    Keeps score of the requests sent to each server. A server where at
+    least `max_failures` requests, and at least `failure_rate` of all
+    requests, failed in the last `window` seconds is taken to be down.
+    Requests to it wait out a `cooldown`, then a single request goes
+    ahead as a probe: if it works the server is up again, otherwise it
+    stays down for another cooldown.
+
+    Failures are counted over a window rather than in a row, since many
+    requests to a server are in flight at once - a server which is only
+    flaky would soon fail a few of them in a row.
+
+    Parameters
+    ----------
+    max_failures : int, default 5
+        Failures within the window before a server can count as down.
+    failure_rate : float, default 0.5
+        Share of the requests within the window which must have failed.
+    window : float, default 10
+        Seconds over which requests are counted.
+    cooldown : float, default 30
+        Seconds before a server which is down is probed.
+    clock : callable, optional
+        Returns the time in seconds. Defaults to `time.monotonic`.
+
+    Attributes
+    ----------
+    scores : dict
+        Maps each host seen so far to its score.
+    """
+
+    def __init__(self,
+                 max_failures: int = 5,
+                 failure_rate: float = 0.5,
+                 window: float = 10,
+                 cooldown: float = 30,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_failures = max_failures
+        self.failure_rate = failure_rate
+        self.window = window
+        self.cooldown = cooldown
+        self.clock = clock
+        self.scores: Dict[str, _Score] = {}
+
+    def _score(self, url: str) -> _Score:
+        host = urlsplit(url).netloc
+        if host not in self.scores:
+            self.scores[host] = _Score()
+        return self.scores[host]
+
+    def record(self, url: str, ok: bool) -> None:
+        """Records how a request to the server of `url` went."""
+        score = self._score(url)
+        now = self.clock()
+        if ok:
+            score.ok += 1
+        else:
+            score.failed += 1
+
+        if score.down_since is not None:
+            if ok:
+                logger.info(f'{urlsplit(url).netloc} is answering again')
+                score.down_since = score.probe_started = None
+                score.recent.clear()
+                score.recent_failed = 0
+            elif score.probe_started is not None:
+                # the probe failed - cool down again
+                score.down_since, score.probe_started = now, None
+            return
+
+        score.recent.append((now, ok))
+        score.recent_failed += not ok
+        while score.recent[0][0] < now - self.window:
+            score.recent_failed -= not score.recent.popleft()[1]
+        if (score.recent_failed >= self.max_failures
+                and score.recent_failed >= self.failure_rate * len(score.recent)):
+            logger.warning(f'{urlsplit(url).netloc} failed {score.recent_failed} of the last '
+                           f'{len(score.recent)} requests - treating it as down')
+            score.down_since = now
+
+    def is_down(self, url: str) -> bool:
+        """
+        True while the server of `url` is cooling down, or being probed.
+        Once the cooldown is over it counts as up, until `wait` sends a probe.
+        """
+        score = self._score(url)
+        if score.down_since is None:
+            return False
+        now = self.clock()
+        if now - score.down_since < self.cooldown:
+            return True
+        # a probe which never reported back doesn't hold up everything else forever
+        return score.probe_started is not None and now - score.probe_started < self.cooldown
+
+    async def wait(self, url: str) -> bool:
+        """
+        Waits until a request may be sent to the server of `url` - at once
+        if it is up. If it is down, waits out the cooldown, then lets one
+        request through as the probe while the rest keep waiting. Probes
+        go in order of arrival, so a request whose probe failed goes to
+        the back of the line.
+
+        Returns
+        -------
+        bool
+            True if the request is the probe. Its failure should be
+            recorded whatever the reason.
+        """
+        score = self._score(url)
+        if score.down_since is None:
+            return False
+        score.tickets += 1
+        ticket = score.tickets
+        score.waiting.add(ticket)
+        try:
+            while score.down_since is not None:
+                if not self.is_down(url) and ticket == min(score.waiting):
+                    score.probe_started = self.clock()
+                    logger.info(f'{urlsplit(url).netloc} has cooled down - trying it again')
+                    return True
+                if score.probe_started is None and self.is_down(url):
+                    delay = score.down_since + self.cooldown - self.clock()
+                else:
+                    delay = PROBE_POLL
+                await asyncio.sleep(min(max(delay, 0.01), PROBE_POLL * 5))
+            return False
+        finally:
+            score.waiting.discard(ticket)
+
+    def success_rate(self, url: str) -> float:
+        """Share of requests to the server of `url` which went fine. 1 if none were sent."""
+        score = self._score(url)
+        total = score.ok + score.failed
+        return score.ok / total if total else 1.0
+
+    def report(self) -> None:
+        """Logs the servers which had trouble."""
+        for host, score in self.scores.items():
+            if score.failed:
+                logger.info(f'{host}: {score.ok} ok, {score.failed} failed')
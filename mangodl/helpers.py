@@ -2,7 +2,6 @@
 
 import os
 import sys
-import time
 import math
 import re
 from typing import (Optional,
@@ -14,24 +13,22 @@ from typing import (Optional,
                     Awaitable,
                     Set)
 from pathlib import Path
+from urllib.parse import urlsplit
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from requests.exceptions import RequestException
-from urllib3.exceptions import MaxRetryError
 import asyncio
-from aiohttp import ClientSession
 
-from .config import mangodl_config
-API_BASE = mangodl_config.get_api_base()
+from .metrics import Metrics
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def mount_retries(session, domain, max_retries: int = 5, backoff: int = 1) -> requests.Session:
+def mount_retries(session, domain, max_retries: int = 5, backoff: int = 1) -> 'requests.Session':
     """Adds auto-retry to a session instance."""
+    # requests is only needed for login and search - don't make every run import it
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     retry = Retry(total=max_retries,
                   status_forcelist=[429, 500, 502, 503, 504],
                   method_whitelist=["HEAD", "GET", "OPTIONS", "POST"],
@@ -41,96 +38,92 @@ def mount_retries(session, domain, max_retries: int = 5, backoff: int = 1) -> re
     return session
 
 
-def get_api_data(url: str, timeout: int = 10, max_tries: int = 1, backoff: int = 1) -> Dict:
+class _TrackedSlots:
+    """
+    Wraps a semaphore, keeping gauges in a Metrics of how many requests
+    are queued for a slot and how many hold one.
     """
-    Sends a GET request to the API url. Expects a JSON response, and returns
-    the 'data' section of JSON string as a dict.
 
-    Parameters
-    ----------
-    url : str
-        API url to request.
-    time_out : int, default 30
-        How many seconds to wait before throwing Timeout error.
-    max_tries : int, default 10
-        Maximum number of requests to send before throwing MaxRetryError.
+    def __init__(self, semaphore: asyncio.Semaphore, metrics: Metrics, **labels):
+        self.semaphore = semaphore
+        self.metrics = metrics
+        self.labels = labels
 
-    Returns
-    -------
-    dict
-        Dict representation of 'data' section in the JSON string.
-    """
-    with requests.Session() as s:
-        s = mount_retries(s, API_BASE)
+    async def __aenter__(self) -> None:
+        self.metrics.add('slots_waiting', 1, **self.labels)
         try:
-            r = s.get(url, timeout=timeout)
-            return r.json()['data']
-        except (MaxRetryError, RequestException):
-            print('looks like mangadex\'s API is unavailable now ಠ_ಠ')
-            sys.exit()
+            await self.semaphore.acquire()
+        finally:
+            self.metrics.add('slots_waiting', -1, **self.labels)
+        self.metrics.add('slots_in_use', 1, **self.labels)
+
+    async def __aexit__(self, *exc) -> None:
+        self.semaphore.release()
+        self.metrics.add('slots_in_use', -1, **self.labels)
 
 
-# recipe from https://gist.github.com/pquentin/5d8f5408cdad73e589d85ba509091741
-class RateLimitedSession():
+class ConcurrencyPool():
     """
-    Wrapper class for `aiohttp.ClientSession` objects. Injects
-    a rate limit on the number of calls per second by maintaining a bucket
-    of 'tokens'.
+    Bounds the number of requests in flight, with separate limits for
+    metadata requests and image requests. Slots are taken one request at a
+    time, so work is scheduled at the page level rather than per chapter.
+
+    Each image server has its own slots, so a slow server cannot tie up
+    the slots meant for the others.
+
+    Must be created inside a running event loop.
 
     Parameters
     ----------
-    session : session instance
-        Can be a requests.Session or aiohttp.ClientSession instance.
-    rate, max_tokens : int, optional
-        `rate` describes the number of tokens produced per second. `max_tokens`
-        is the size of the bucket. (Both values default to 20.)
+    metadata_limit : int, default 4
+        Maximum number of API requests in flight.
+    image_limit : int, default 16
+        Maximum number of image downloads in flight from each image server.
+    metrics : Metrics, optional
+        Keeps the queue depth and slots in use for each kind of request.
 
     Attributes
     ----------
-    tokens : int
-        Number of tokens in the bucket at any time.
-    updated_at : float
-        Time when the bucket was last updated.
+    metadata : asyncio.Semaphore
+        Use as `async with pool.metadata: ...` around a single request.
     """
 
-    def __init__(self, session: ClientSession, rate: int = 20, max_tokens: int = 20):
-        self.session = session
-        self.rate = rate
-        self.max_tokens = max_tokens
-
-        logger.debug(f'created rate-limited client at {rate} calls per second')
-
-        self.tokens = self.max_tokens
-        self.updated_at = time.monotonic()
-
-    async def get(self, *args, **kwargs):
-        await self.consume_token()
-        return self.session.get(*args, **kwargs)
-
-    async def consume_token(self):
-        while self.tokens < 1:
-            self.add_new_tokens()
-            await asyncio.sleep(0.1)
-        self.tokens -= 1
-
-    def add_new_tokens(self):
-        now = time.monotonic()
-        time_since_update = now - self.updated_at
-        new_tokens = time_since_update * self.rate
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.max_tokens)
-            self.updated_at = now
-
-
-async def gather_with_semaphore(n: int, *tasks) -> Awaitable:
-    """Wrapper function for aiohttp.gather, but injects a semaphore."""
-    semaphore = asyncio.Semaphore(n)
-
-    async def sem_task(task):
-        async with semaphore:
-            return await task
+    def __init__(self, metadata_limit: int = 4, image_limit: int = 16, metrics: Optional[Metrics] = None):
+        self.metadata = asyncio.Semaphore(metadata_limit)
+        if metrics is not None:
+            self.metadata = _TrackedSlots(self.metadata, metrics, kind='metadata')
+        self.image_limit = image_limit
+        self.metrics = metrics
+        self._images: Dict[str, asyncio.Semaphore] = {}
+
+        logger.debug(f'created pool with {metadata_limit} metadata and {image_limit} image slots per server')
+
+    def images_for(self, url: str) -> asyncio.Semaphore:
+        """
+        Returns the image slots for the server `url` points to. Use as
+        `async with pool.images_for(url): ...` around a single request.
+        """
+        host = urlsplit(url).netloc
+        if host not in self._images:
+            self._images[host] = asyncio.Semaphore(self.image_limit)
+            if self.metrics is not None:
+                self._images[host] = _TrackedSlots(self._images[host], self.metrics, kind='images', host=host)
+        return self._images[host]
+
+
+def interleave(*lsts: List) -> List:
+    """
+    Merges several lists by taking one item from each in turn.
 
-    return await asyncio.gather(*(sem_task(task) for task in tasks))
+    interleave([1, 2, 3], ['a'], [4, 5])
+    >>>[1, 'a', 4, 2, 5, 3]
+    """
+    merged = []
+    for i in range(max((len(lst) for lst in lsts), default=0)):
+        for lst in lsts:
+            if i < len(lst):
+                merged.append(lst[i])
+    return merged
 
 
 def chunk(lst: List, n: int) -> List:
@@ -0,0 +1,121 @@
+"""
+Contains the ChapterRecord type, which holds what we need from the
+chapter list, and the ChapterIndex class for looking chapters up.
+"""
+
+import sys
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    NamedTuple)
+
+from .helpers import safe_to_int
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ChapterRecord(NamedTuple):
+    """
+    One upload from a manga's chapter list, with only the fields we use.
+    `number` and `volume` are kept as strings, exactly as the API gives
+    them - use `safe_to_int` to compare them as numbers.
+    """
+    id: int
+    number: str
+    volume: str
+    language: str
+    title: str
+    groups: Tuple[int, ...]
+    timestamp: int
+
+    @classmethod
+    def from_api(cls, raw_ch: Dict) -> 'ChapterRecord':
+        """Picks our fields out of a raw chapter dictionary from the API."""
+        return cls(raw_ch['id'],
+                   raw_ch['chapter'],
+                   raw_ch['volume'],
+                   sys.intern(raw_ch['language']),  # only a handful of distinct values
+                   raw_ch['title'],
+                   tuple(raw_ch.get('groups', ())),
+                   raw_ch.get('timestamp', 0))
+
+
+class ChapterIndex:
+    """
+    Indexes the chapter list of a manga by language and chapter number,
+    built once so staging, range selection and finding another upload
+    don't have to scan the whole chapter list each time.
+
+    Parameters
+    ----------
+    chs_data : list
+        ChapterRecord instances, in the order uploads should be tried.
+
+    Attributes
+    ----------
+    bad_ids : set
+        Ids (as str) of uploads found to be unusable. Skipped by `find_another`.
+    """
+
+    def __init__(self, chs_data: List[ChapterRecord]):
+        self._uploads: Dict[Tuple[str, str], List[ChapterRecord]] = defaultdict(list)  # (language, number) -> uploads
+        self._numbers: Dict[str, List[str]] = defaultdict(list)  # language -> numbers, as first seen
+        self._by_lang: Dict[str, List[ChapterRecord]] = defaultdict(list)  # language -> uploads
+        self._sorted: Dict[str, Tuple[List[Union[int, float]], List[str]]] = {}
+        self.bad_ids: Set[str] = set()
+
+        for record in chs_data:
+            key = (record.language, record.number)
+            if key not in self._uploads:
+                self._numbers[record.language].append(record.number)
+            self._uploads[key].append(record)
+            self._by_lang[record.language].append(record)
+
+        logger.debug(f'indexed {len(chs_data)} upload(s) of {len(self._uploads)} chapter(s)')
+
+    def first_uploads(self, lang: str) -> List[ChapterRecord]:
+        """Returns the first upload of each chapter in `lang`, in the order first seen."""
+        return [self._uploads[(lang, num)][0] for num in self._numbers.get(lang, [])]
+
+    def uploads(self, lang: str, num: str) -> List[ChapterRecord]:
+        """Returns every upload of chapter `num` in `lang`, in order."""
+        return self._uploads.get((lang, num), [])
+
+    def in_language(self, lang: str) -> List[ChapterRecord]:
+        """Returns every upload in `lang`."""
+        return self._by_lang.get(lang, [])
+
+    def mark_bad(self, ch_id: Union[str, int]) -> None:
+        self.bad_ids.add(str(ch_id))
+
+    def find_another(self, record: ChapterRecord) -> Optional[ChapterRecord]:
+        """Returns the first upload of the same chapter which isn't marked bad, or None."""
+        for other in self.uploads(record.language, record.number):
+            if str(other.id) not in self.bad_ids:
+                return other
+        return None
+
+    def _numeric(self, lang: str) -> Tuple[List[Union[int, float]], List[str]]:
+        # chapter numbers in `lang` which are numbers, sorted, with the strings they came from
+        if lang not in self._sorted:
+            pairs = sorted((n, num) for num in self._numbers.get(lang, [])
+                           for n in (safe_to_int(num),) if isinstance(n, (int, float)))
+            self._sorted[lang] = ([n for n, _ in pairs], [num for _, num in pairs])
+        return self._sorted[lang]
+
+    def numbers(self, lang: str) -> List[Union[int, float]]:
+        """Returns the chapter numbers in `lang`, sorted. Chapters without a number are left out."""
+        return self._numeric(lang)[0]
+
+    def between(self, lang: str, lower: Union[int, float], upper: Union[int, float]) -> List[str]:
+        """Returns the chapter numbers in `lang` from `lower` to `upper` inclusive, as in the chapter list."""
+        nums, strs = self._numeric(lang)
+        return strs[bisect_left(nums, lower):bisect_right(nums, upper)]
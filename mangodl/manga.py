@@ -3,13 +3,11 @@ This module contains the Manga class, used to represent
 whatever manga is to be downloaded.
 """
 
-import requests
-import asyncio
-import aiohttp
-import sys
+import time
+import shutil
 from collections import defaultdict
-from tqdm import tqdm
 import pprint
+from types import SimpleNamespace
 from typing import (Optional,
                     Union,
                     Dict,
@@ -20,35 +18,37 @@ from typing import (Optional,
                     Set)
 from pathlib import Path
 
-from .cli import ARGS
 from .chapter import Chapter
+from .client import ApiClient, ApiError
 from .filesys import FileSys
+from .manifest import Manifest
+from .index import ChapterIndex, ChapterRecord
+from .volumes import (assign_volumes,
+                      save_volume_map,
+                      VolumeStrategy,
+                      KnownVolumes,
+                      ByTimestamp,
+                      STRATEGIES)
 from .config import mangodl_config
-from .helpers import (get_api_data,
-                      chunk,
-                      RateLimitedSession,
-                      gather_with_semaphore,
-                      safe_to_int,
+from .helpers import (safe_to_int,
                       horizontal_rule,
                       find_int_between,
                       parse_range_input,
-                      _Getch,
-                      extract_nums,
-                      say_goodbye)
+                      _Getch)
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-# set up logging prefixes for use in tqdm.write
-WARNING_PREFIX = f'{__name__} | [WARNING]: '
-ERROR_PREFIX = f'{__name__} | [ERROR]: '
-CRITICAL_PREFIX = f'{__name__} | [CRITICAL]: '
+getch = _Getch()
 
-# load from config file
-API_BASE = mangodl_config.get_api_base()
 
-getch = _Getch()
+class SearchAnother(Exception):
+    """Raised from a prompt when the user would rather search for another manga."""
+
+
+class Quit(Exception):
+    """Raised from a prompt when the user wants to quit."""
 
 
 class Manga:
@@ -60,15 +60,22 @@ class Manga:
     ----------
     id : str or int
         Mangadex id for the manga.
+    data, chs_data
+        Manga info and chapter list as returned by the API - see
+        `DownloadScheduler.load_mangas`. Only the fields we use are kept
+        from the chapter list.
 
     Attributes
     ----------
+    id : str or int
     url : str
     title : str
     data : dict
         The 'data' section of JSON string returned by API.
     chs_data : list
-        Raw chapter dictionaries.
+        ChapterRecord for each upload, from first to last.
+    index : index.ChapterIndex
+        `chs_data` by language and chapter number.
     p_downloads : list
         All chapters which can be downloaded.
     s_downloads : list
@@ -77,22 +84,44 @@ class Manga:
         Chapters missing from mangadex.
     serverless : list
         Chapters listed on mangadex but without an image server.
+    bad_chs : set
+        Ids (as str) of chapter uploads found to be unusable.
+    vol_plan : dict or None
+        Volume of each staged chapter number, if volumes were planned
+        before download.
+    vol_strategies : list
+        volumes.VolumeStrategy instances tried before volumes are
+        worked out from the chapter numbers.
+    vol_map_path : Path or None
+        Where the volume of each chapter is saved once worked out.
     """
 
-    def __init__(self, id: Union[str, int]):
+    def __init__(self,
+                 id: Union[str, int],
+                 data: Dict,
+                 chs_data: List[Dict]):
         logger.debug('creating Manga object')
-        self.url = API_BASE + f'manga/{id}'
+        self.id = id
+        self.url = mangodl_config.get_api_base() + f'manga/{id}'
 
-        self.data = get_api_data(self.url)
-        self.chs_data = get_api_data(self.url + '/chapters')['chapters']
-        self.chs_data.reverse()  # api gives chapters from last to first
+        self.data = data
+        # api gives chapters from last to first - and we don't need most of what it says about them
+        self.chs_data = [ChapterRecord.from_api(raw_ch) for raw_ch in reversed(chs_data)]
+        self.index = ChapterIndex(self.chs_data)
         self.title = self.data['title']
 
-        self.p_downloads: List[Dict] = []  # 'possible' downloads
-        self.s_downloads: List[Dict] = []  # selected downloads (by user)
+        self.p_downloads: List[ChapterRecord] = []  # 'possible' downloads
+        self.s_downloads: List[ChapterRecord] = []  # selected downloads (by user)
         self.downloaded: List[Chapter] = []  # downloaded chapters
         self.missing: List[int] = []  # missing chapters
         self.serverless: List[Union[float, int]] = []  # chapters listed but no server
+        self.bad_chs: Set[str] = self.index.bad_ids  # chapter ids with no server
+        self.lang: Optional[str] = None
+        self.allow_search = False  # offer to search for another manga in prompts
+        self.vol_plan: Optional[Dict[str, Union[int, float, str]]] = None  # chapter number -> volume
+        self._vol_pending: Dict[Union[int, float, str], Set[str]] = {}  # volume -> chapters still to come
+        self.vol_strategies: List[VolumeStrategy] = []
+        self.vol_map_path: Optional[Path] = None
 
     def download_chapters(self,
                           fs: FileSys,
@@ -101,7 +130,10 @@ class Manga:
                           rate_limit: int,
                           no_volume: bool,
                           vol_len: int,
-                          no_prompt: bool = False):
+                          no_prompt: bool = False,
+                          metadata_limit: int = 4,
+                          image_limit: int = 16,
+                          use_cache: bool = True):
         """
         Saves all chapters into a folder.
 
@@ -120,100 +152,323 @@ class Manga:
             Default length per volume if not provided by mangadex.
         no_prompt : bool, default False
             If set to True, will download every chapter found without prompting user.
+        metadata_limit, image_limit : int, optional
+            Maximum number of API and image requests in flight.
+        use_cache : bool, default True
+            Keep API responses in a `ResponseCache` between runs.
 
         Returns
         -------
         None
         """
-        added: List[str] = []  # chapter numbers staged for download
-        bad_chs: List[str] = []  # chapter ids with no server
-
-        def is_right_lang(raw_ch: Dict) -> bool:
-            return raw_ch['language'] == lang
-
-        # check if we've already queued a chapter for download
-        def is_new(raw_ch: Dict) -> bool:
-            return raw_ch['chapter'] not in added
-
-        async def check_server_and_download(session: RateLimitedSession,
-                                            raw_ch: Optional[Dict]) -> Awaitable:
-            """Downloads one chapter."""
-            if raw_ch:
-                chapter = Chapter(raw_ch['id'], saver)
-                await chapter.load(session)
-                if chapter.page_links:
-                    # chapter has image server - proceed with download
-                    await chapter.download(session, fs.raw_path)
-                    self.downloaded.append(chapter)
-                else:
-                    # chapter has no server - find another
-                    bad_chs.append(raw_ch['id'])
-                    await check_server_and_download(session, find_another(raw_ch))
-            else:
-                # searched all uploads of this chapter and still no servers
-                self.serverless.append(safe_to_int(raw_ch['chapter']))
-                tqdm.write(f'{CRITICAL_PREFIX}could not find any valid servers for chapter {raw_ch["chapter"]} ಥ_ಥ')
-
-        def find_another(bad_ch: Dict) -> Optional[Dict]:
-            # find another instance of the chapter from self.chapter_data
-            wanted_num = bad_ch['chapter']
-            tqdm.write(f'finding another server for chapter {wanted_num}')
-            for raw_ch in self.chs_data:
-                num = raw_ch['chapter']
-                ch_id = raw_ch['id']
-                if is_right_lang(raw_ch) and num == wanted_num and ch_id not in bad_chs:
-                    tqdm.write(f'found another instance of chapter {wanted_num} (id {raw_ch["id"]})')
-                    return raw_ch
-
-            # return None if no other chapter found
-            return None
+        from .scheduler import DownloadScheduler
+
+        if not self.stage_chapters(lang, no_prompt):
+            return
 
-        async def main_download() -> Awaitable:
-            tasks = []
-            async with aiohttp.ClientSession() as session:
-                session = RateLimitedSession(session, rate_limit, rate_limit)
-                for raw_ch in self.s_downloads:
-                    tasks.append(check_server_and_download(session, raw_ch))
-                await gather_with_semaphore(2, *tasks)
+        # prepare folders for download
+        fs.setup_folders()
+
+        with DownloadScheduler(rate_limit, metadata_limit, image_limit, use_cache) as scheduler:
+            scheduler.add(self, fs, saver, None if no_volume else vol_len)
+            scheduler.run()
 
-        # stage chapters for download by adding to `self.p_downloads`
-        for raw_ch in self.chs_data:
-            if is_right_lang(raw_ch) and is_new(raw_ch):
-                self.p_downloads.append(raw_ch)
-                added.append(raw_ch['chapter'])
+        self.finish_download(no_volume, vol_len)
+
+    def stage_chapters(self,
+                       lang: str,
+                       no_prompt: bool = False,
+                       ranges: Optional[str] = None,
+                       allow_search: bool = False) -> bool:
+        """
+        Finds the chapters which can be downloaded and lets the user pick
+        from them. Selected chapters are stored in `self.s_downloads`.
+
+        Parameters
+        ----------
+        lang : str
+            Manga language.
+        no_prompt : bool, default False
+            If set to True, selects every chapter found without prompting user.
+        ranges : str, optional
+            Chapters to select without prompting, like '1-20, 25'.
+        allow_search : bool, default False
+            Offer to search for another manga in the prompts.
+
+        Returns
+        -------
+        bool
+            False if there is nothing to download for this manga.
+
+        Raises
+        ------
+        SearchAnother, Quit
+            If the user picked these options when prompted.
+        """
+        self._stage_possible(lang)
+        self.allow_search = allow_search
 
         if not self.p_downloads:
             logger.critical(f'no chapters found for {self.title}')
-            if ARGS.url:
-                logger.info(f'quitting application')
-                sys.exit()
-            from .mangodl import next_manga
-            next_manga()
-
-        if no_prompt:
+            logger.info(f'skipping {self.title}')
+            return False
+
+        if ranges is not None:
+            selection = self._chapters_in(parse_range_input(ranges))
+            self.s_downloads = [ch for ch in self.p_downloads if ch.number in selection]
+            if not self.s_downloads:
+                logger.critical(f'{ranges} did not correspond to any chapters of {self.title}')
+                return False
+        elif no_prompt:
             self.s_downloads = self.p_downloads
         else:
             # show some info to the user and get input
             self._display_chs()
 
-        # prepare folders for download
-        fs.setup_folders()
+        return True
+
+    def stage_new_chapters(self, lang: str, manifest: Manifest) -> bool:
+        """
+        Selects only the chapters whose numbers are not among the chapters
+        `manifest` lists as saved. Never prompts the user.
+
+        Parameters
+        ----------
+        lang : str
+            Manga language.
+        manifest : manifest.Manifest instance
+            Record of what earlier runs saved for this manga.
 
-        asyncio.run(main_download())
-        logger.info('all chapters downloaded (ᵔᴥᵔ)')
+        Returns
+        -------
+        bool
+            False if there are no new chapters.
+        """
+        self._stage_possible(lang)
+        saved = {entry['chapter'] for entry in manifest.chapters.values() if entry.get('status') == 'complete'}
+        self.s_downloads = [record for record in self.p_downloads if record.number not in saved]
+
+        if not self.s_downloads:
+            logger.info(f'{self.title} is up to date')
+            return False
+        logger.info(f'found {len(self.s_downloads)} new chapter(s) for {self.title}')
+        return True
+
+    def _stage_possible(self, lang: str) -> None:
+        """Stages one upload of every chapter in `lang` by adding it to `self.p_downloads`."""
+        self.lang = lang
+        self.p_downloads = self.index.first_uploads(lang)
+
+    async def download_chapter(self,
+                               client: ApiClient,
+                               record: ChapterRecord,
+                               fs: FileSys,
+                               saver: bool,
+                               progress=None,
+                               archive=None) -> Awaitable:
+        """
+        Downloads one chapter into `fs.raw_path`. Falls back to other uploads
+        of the same chapter if the first one has no image server, could
+        not be loaded, or still has missing pages after trying other
+        image servers. Chapters which `fs.manifest` shows were already
+        saved are not requested again.
+
+        If an `archive` (a filesys.StreamingArchive) is given, the pages go
+        straight into it instead, and nothing is kept in the manifest.
+        """
+        wanted_num = record.number
+        metrics = client.metrics
+
+        # a previous run may have saved this chapter already
+        chapter = None if archive is not None else Chapter.from_manifest(record.id, saver, fs.manifest, fs.raw_path)
+        if chapter:
+            logger.info(f'chapter {chapter.ch_num} already saved -> {chapter.ch_path}')
+            self._add_downloaded(chapter, wanted_num)
+            if metrics is not None:
+                metrics.inc('chapters', result='resumed')
+            return
+
+        start = time.perf_counter()
+
+        while record:
+            chapter = Chapter(record.id, saver)
+            try:
+                await chapter.load(client)
+            except ApiError as e:
+                logger.error(f'could not load chapter id {record.id} - {e}')
+                chapter.page_links = None
+            if chapter.page_links:
+                # chapter has image server - proceed with download
+                if progress is not None:
+                    progress.total += len(chapter.page_links)
+                    progress.refresh()
+                if archive is not None:
+                    await chapter.download(client, None, progress, archive=archive)
+                else:
+                    await chapter.download(client, fs.raw_path, progress, fs.manifest, fs.store)
+                if chapter.failed_pages:
+                    # pages still missing after trying other servers - try another upload
+                    self.index.mark_bad(record.id)
+                    another = self._find_another(record)
+                    if another:
+                        logger.warning(f'dropping chapter {wanted_num} (id {record.id}) for another upload')
+                        if archive is not None:
+                            archive.drop(chapter.ch_num)
+                        else:
+                            shutil.rmtree(chapter.ch_path, ignore_errors=True)
+                            fs.manifest.drop_chapter(chapter.id)
+                        record = another
+                        continue
+                    # keep what we have - a later run can fill in the gaps
+                self._add_downloaded(chapter, wanted_num)
+                if metrics is not None:
+                    metrics.observe('chapter', time.perf_counter() - start)
+                    metrics.inc('chapters', result='incomplete' if chapter.failed_pages else 'saved')
+                return
+            # chapter has no server - find another
+            self.index.mark_bad(record.id)
+            record = self._find_another(record)
+
+        # searched all uploads of this chapter and still no servers
+        self.serverless.append(safe_to_int(wanted_num))
+        if metrics is not None:
+            metrics.inc('chapters', result='serverless')
+        logger.critical(f'could not find any valid servers for chapter {wanted_num} ಥ_ಥ')
+
+    def _add_downloaded(self, chapter: Chapter, wanted_num: str) -> None:
+        # another upload may disagree on the volume - stick to the plan
+        if self.vol_plan is not None:
+            chapter.vol_num = self.vol_plan.get(wanted_num, chapter.vol_num)
+        self.downloaded.append(chapter)
+
+    def use_volume_strategy(self, fs: FileSys, strategy: str = 'chapters', map_file: Optional[str] = None) -> None:
+        """
+        Chooses how chapters without a volume are placed, and saves the
+        volumes worked out to `fs.volume_map_path` from now on.
+
+        In order: volumes from `map_file` (replacing those mangadex
+        gives), then volumes saved by earlier runs, so archives keep the
+        chapters they had - then with `strategy` 'timestamps', new
+        chapters by upload date. Whatever is left is worked out from the
+        chapter numbers.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f'unknown volume strategy {strategy!r} - use one of {", ".join(STRATEGIES)}')
+        self.vol_strategies = []
+        if map_file:
+            self.vol_strategies.append(KnownVolumes.from_file(map_file, override=True))
+        if fs.volume_map_path.exists():
+            logger.info(f'reusing the volumes from earlier downloads <- {fs.volume_map_path}')
+            self.vol_strategies.append(KnownVolumes.from_file(fs.volume_map_path))
+        if strategy == 'timestamps':
+            self.vol_strategies.append(ByTimestamp({str(record.id): record.timestamp for record in self.chs_data}))
+        self.vol_map_path = fs.volume_map_path
+
+    def plan_volumes(self, vol_len: int) -> None:
+        """
+        Assigns every staged chapter a volume before anything is
+        downloaded, so each volume can be archived as soon as its last
+        chapter arrives. Uses the chapter and volume numbers in the
+        chapter list, which match those in the chapter info.
+        """
+        stand_ins = [SimpleNamespace(id=record.id,
+                                     ch_num=safe_to_int(record.number),
+                                     vol_num=safe_to_int(record.volume))
+                     for record in self.s_downloads]
+        self._compile_volume_info(vol_len, stand_ins)
+
+        self.vol_plan = {record.number: ch.vol_num for record, ch in zip(self.s_downloads, stand_ins)}
+        self._vol_pending = defaultdict(set)
+        for ch_num, vol_num in self.vol_plan.items():
+            self._vol_pending[vol_num].add(ch_num)
+
+    def volume_done(self, record: ChapterRecord) -> Optional[List[Chapter]]:
+        """
+        Marks a staged chapter as finished with, whether or not it could be
+        downloaded. Returns the downloaded chapters of its volume if that
+        was the last one the volume was waiting on, otherwise None.
+        """
+        vol_num = self.vol_plan[record.number]
+        pending = self._vol_pending.get(vol_num)
+        if pending is None:
+            return None
+        pending.discard(record.number)
+        if pending:
+            return None
+        del self._vol_pending[vol_num]
+        return [ch for ch in self.downloaded if ch.vol_num == vol_num]
+
+    def finish_download(self, no_volume: bool, vol_len: int, direct: Optional[str] = None) -> None:
+        """
+        Wraps up after every chapter has been downloaded. With `direct`,
+        the archives are written already, from the volumes planned before
+        download or from none at all - so nothing is worked out again.
+        """
+        logger.info(f'all chapters of {self.title} downloaded (ᵔᴥᵔ)')
 
         # ensure every chapter has a volume
-        if not no_volume:
+        if not no_volume and self.vol_plan is None and direct is None:
             self._compile_volume_info(vol_len)
 
+    def sync_volumes(self, fs: FileSys, saver: bool, vol_len: int) -> List[Chapter]:
+        """
+        Works out which volumes the chapters just downloaded fall into,
+        taking account of the chapters saved by earlier runs.
+
+        Volume info is compiled twice: once for the chapters saved before
+        this run, and once for those plus the new chapters. A volume needs
+        rebuilding if it gained a new chapter, or if any earlier chapter
+        moved into or out of it.
+
+        Returns
+        -------
+        list
+            Chapter instances, old and new, in every volume which needs rebuilding.
+        """
+        new_ids = {str(ch.id) for ch in self.downloaded}
+        old_ids = [str(record.id) for record in self.index.in_language(self.lang)
+                   if str(record.id) not in new_ids]
+
+        # only the folders and numbers are needed - no point hashing every saved page
+        before = [Chapter.from_manifest(ch_id, saver, fs.manifest, fs.raw_path, verify=False) for ch_id in old_ids]
+        before = [ch for ch in before if ch]
+        given_vols = {ch.id: ch.vol_num for ch in before}
+        if before:
+            self._compile_volume_info(vol_len, before)
+        old_vols = {ch.id: ch.vol_num for ch in before}
+
+        # start again from the volumes mangadex gives
+        for ch in before:
+            ch.vol_num = given_vols[ch.id]
+        chapters = before + self.downloaded
+        self._compile_volume_info(vol_len, chapters)
+
+        touched = set()
+        for ch in chapters:
+            if str(ch.id) in new_ids:
+                touched.add(ch.vol_num)
+            elif old_vols[ch.id] != ch.vol_num:
+                touched.update((old_vols[ch.id], ch.vol_num))
+        logger.info(f'volume(s) to rebuild for {self.title}: {sorted(touched, key=str)}')
+
+        return [ch for ch in chapters if ch.vol_num in touched]
+
+    def _find_another(self, bad_ch: ChapterRecord) -> Optional[ChapterRecord]:
+        """Finds another upload of a chapter which isn't known to be bad."""
+        wanted_num = bad_ch.number
+        logger.info(f'finding another server for chapter {wanted_num}')
+        record = self.index.find_another(bad_ch)
+        if record:
+            logger.info(f'found another instance of chapter {wanted_num} (id {record.id})')
+        return record
+
     def _display_chs(self):
         """Print out some info about the chapters found and solicits user input
         before commencing download."""
 
         # separate the valid chapter numbers from invalid ones
-        _ch_nums = [safe_to_int(ch['chapter']) for ch in self.p_downloads]
-        ch_nums, ch_str_nums = extract_nums(_ch_nums)
-        ch_nums.sort()
+        ch_nums = self.index.numbers(self.lang)
+        has_nameless = len(ch_nums) < len(self.p_downloads)
 
         horizontal_rule()
         print(f'Found {len(self.p_downloads)} chapter(s) for {self.title}')
@@ -235,11 +490,11 @@ class Manga:
 
         # prompt user for download range
         selection = self._get_download_range(ch_nums)
-        self.s_downloads = [ch for ch in self.p_downloads if ch['chapter'] in selection]
+        self.s_downloads = [ch for ch in self.p_downloads if ch.number in selection]
 
         # now deal with those without any chapter numbers
-        if ch_str_nums:
-            nameless_chs = [ch for ch in self.p_downloads if isinstance(safe_to_int(ch['chapter']), str)]
+        if has_nameless:
+            nameless_chs = [ch for ch in self.p_downloads if isinstance(safe_to_int(ch.number), str)]
             horizontal_rule()
             self._handle_nameless(nameless_chs)
 
@@ -247,6 +502,18 @@ class Manga:
         if len(self.s_downloads) < len(self.p_downloads):
             self._confirm_download()
 
+    def _chapters_in(self, parsed: List[str]) -> Set[str]:
+        """Returns the chapter numbers within the ranges from `parse_range_input`."""
+        s: Set[str] = set()
+        for sect in parsed:
+            b = sect.split('-')
+            lower = safe_to_int(min(b))
+            upper = safe_to_int(max(b))
+            for ch_num in self.index.between(self.lang, lower, upper):
+                s.add(ch_num)
+                logger.info(f'chapter {ch_num} queued for download')
+        return s
+
     def _get_download_range(self, ch_nums: List[Union[float, int]]) -> Set[str]:
         """
         Prompts user to select a range of chapters to download.
@@ -259,16 +526,7 @@ class Manga:
             r = input('Specify a range: ')
             parsed = parse_range_input(r)
             if parsed:
-                for sect in parsed:
-                    b = sect.split('-')
-                    lower = safe_to_int(min(b))
-                    upper = safe_to_int(max(b))
-                    for ch_num in ch_nums:
-                        if lower <= ch_num <= upper:
-                            s.add(str(ch_num))
-                            logger.info(f'chapter {ch_num} queued for download')
-                        else:
-                            logger.info(f'chapter {ch_num} will not be downloaded')
+                s.update(self._chapters_in(parsed))
                 if not s:
                     # nothing selected!
                     logger.critical(f'input of {r} did not correspond to any chapters')
@@ -279,7 +537,7 @@ class Manga:
 
         print('Which chapters to download?')
 
-        if ARGS.url:
+        if not self.allow_search:
             # don't print the 'search another manga' option
             print('[a] - download all chapters')
             print('[r] - select custom range')
@@ -288,14 +546,13 @@ class Manga:
 
             if c.lower() == 'a':
                 logger.info(f'input \'{c}\' - download all chapters available')
-                return {str(_) for _ in ch_nums}
+                return set(self.index.between(self.lang, float('-inf'), float('inf')))
             elif c.lower() == 'r':
                 logger.info(f'input \'{c}\' - select custom range')
                 collect_range_input()
             elif c.lower() == 'q':
                 logger.info(f'input \'{c}\' - quitting application')
-                say_goodbye()
-                sys.exit()
+                raise Quit
             else:
                 logger.error(f'invalid input - \'{c}\'')
                 return self._get_download_range(ch_nums)
@@ -308,19 +565,17 @@ class Manga:
 
             if c.lower() == 'a':
                 logger.info(f'input \'{c}\' - download all chapters available')
-                return {str(_) for _ in ch_nums}
+                return set(self.index.between(self.lang, float('-inf'), float('inf')))
             elif c.lower() == 'r':
                 logger.info(f'input \'{c}\' - select custom range')
                 collect_range_input()
             elif c.lower() == 's':
                 logger.warning(
                     f'input \'{c}\' - abandoning the manga {self.title}')
-                from .mangodl import search_another
-                search_another()
+                raise SearchAnother
             elif c.lower() == 'q':
                 logger.info(f'input \'{c}\' - quitting application')
-                say_goodbye()
-                sys.exit()
+                raise Quit
             else:
                 logger.error(f'invalid input - \'{c}\'')
                 return self._get_download_range(ch_nums)
@@ -331,7 +586,7 @@ class Manga:
         """Allows user to check the chapters queued for download before continuing."""
         horizontal_rule()
 
-        selected_nums = [safe_to_int(c['chapter']) for c in self.s_downloads]
+        selected_nums = [safe_to_int(c.number) for c in self.s_downloads]
         print('These chapters will be downloaded:')
         ch_count = len(self.s_downloads)
         pprint.pprint(selected_nums,
@@ -339,7 +594,7 @@ class Manga:
                       width=min(ch_count, 80))
         print(f'Proceed to download {ch_count} chapter(s) of {self.title}?')
 
-        if ARGS.url:
+        if not self.allow_search:
             print('[y] - yes, confirm download')
             print('[r] - choose range again')
             print('[q] - quit app')
@@ -351,7 +606,7 @@ class Manga:
                 return self._display_chs()
             elif check.lower() == 'q':
                 logger.info(f'received input \'{check}\' - quitting application')
-                sys.exit()
+                raise Quit
             else:
                 logger.warning(f'invalid input - \'{check}\'')
                 return self._confirm_download()
@@ -368,11 +623,10 @@ class Manga:
                 return self._display_chs()
             elif check.lower() == 's':
                 logger.warning(f'abandoning manga -> {self.title}')
-                from .mangodl import search_another
-                search_another()
+                raise SearchAnother
             elif check.lower() == 'q':
                 logger.info(f'received input \'{check}\' - quitting application')
-                sys.exit()
+                raise Quit
             else:
                 logger.warning(f'invalid input - \'{check}\'')
                 return self._confirm_download()
@@ -380,7 +634,7 @@ class Manga:
     def _handle_nameless(self, nameless_chs: List) -> None:
         """Lets user decide what to do with chapters which have no chapter number."""
         print(f'Found {len(nameless_chs)} chapter(s) with no chapter number ಠ_ಠ')
-        ch_titles = [ch['title'] for ch in nameless_chs]
+        ch_titles = [ch.title for ch in nameless_chs]
         print(f'Title(s):', ', '.join(ch_titles))
         print('↑ download or ignore? ↑')
         print('[y] - download as well    [n] - ignore')
@@ -396,121 +650,15 @@ class Manga:
             logger.error(f'got invalid input -{c}')
             return self._handle_nameless(nameless_chs)
 
-    def _compile_volume_info(self, vol_len: int) -> None:
+    def _compile_volume_info(self, vol_len: int, chapters: Optional[List[Chapter]] = None) -> None:
         """Assigns a volume number to all downloaded mangas via their 
-        respective Chapter instances."""
+        respective Chapter instances. Works on `chapters` instead of
+        `self.downloaded` if given. See `volumes.assign_volumes`."""
         logger.info('figuring out which chapter belongs to which volume')
-
-        orphans: Chapter = []  # those chapters without volumes
-        prelim_map = defaultdict(list)  # maps volume to its chapters
-
-        for ch in self.downloaded:
-            if ch.ch_num == '_':
-                # bad news! a chapter without a chapter number
-                logger.warning(f'chapter id {ch.id} has no chapter number')
-            elif ch.vol_num == '':
-                logger.info(f'chapter {ch.ch_num} has no volume number')
-                orphans.append(ch)
-            else:
-                prelim_map[ch.vol_num].append(ch.ch_num)
-
-        vol_nums = sorted(prelim_map)  # list of volume numbers so far
-
-        def fit_between():
-            """
-            Sees if the orphans can fit into existing volumes
-            by checking the lower and upper bounds for each volume.
-            """
-            for i, orphan in enumerate(orphans[:]):
-                for j, vol_num in enumerate(vol_nums):
-                    try:
-                        previous_vol = vol_nums[j - 1]
-                        lower_bound = prelim_map[previous_vol][-1]
-                    except IndexError:
-                        # vol_num is the first volume
-                        lower_bound = prelim_map[vol_num][0] - 1
-                    try:
-                        next_vol = vol_nums[j + 1]
-                        upper_bound = prelim_map[next_vol][0]
-                    except IndexError:
-                        # vol_num is the last vol
-                        upper_bound = prelim_map[vol_num][-1] + 0.5
-
-                    if lower_bound <= orphan.ch_num <= upper_bound:
-                        # orphaned chapter can be fit into currently existing volume!
-                        orphan.vol_num = vol_num
-                        prelim_map[vol_num].append(orphans.pop(i).ch_num)  # remove the orphan
-                        prelim_map[vol_num].sort()
-                        logger.debug(f'chapter {orphan.ch_num} -> volume {vol_num}')
-
-        def extrapolate():
-            """Create new volumes by extrapolating from current ones."""
-            # compute average length of volumes detected so far
-            ch_lens = [len(vol) for vol in prelim_map.values()]
-            avg_len = round(sum(ch_lens) / len(ch_lens))
-
-            first_chapter = prelim_map[vol_nums[0]][0]
-            last_chapter = prelim_map[vol_nums[-1]][-1]
-
-            below: Chapter = []  # chapter falls below range of current volumes
-            above: Chapter = []  # chapter is above range of current volumes
-
-            for orphan in orphans:
-                if orphan.ch_num < first_chapter:
-                    below.append(orphan)
-                elif orphan.ch_num > last_chapter:
-                    above.append(orphan)
-                else:
-                    # I don't think this is possible
-                    logger.warning(f'chapter {orphan.ch_num} is a rogue chapter!')
-                    pass
-
-            below.reverse()  # we want from highest to lowest
-
-            if below:
-                for new_vol in chunk(below, avg_len):
-                    new_vol_num = vol_nums[0] - 1
-                    vol_nums.insert(0, new_vol_num)
-                    logger.debug(f'creating volume {new_vol_num}')
-
-                    for ch in new_vol:
-                        prelim_map[new_vol_num].append(ch.ch_num)
-                        ch.vol_num = new_vol_num
-                        logger.debug(f'chapter {ch.ch_num} -> volume {new_vol_num}')
-            if above:
-                for new_vol in chunk(above, avg_len):
-                    new_vol_num = vol_nums[-1] + 1
-                    vol_nums.append(new_vol_num)
-                    logger.debug(f'creating volume {new_vol_num}')
-
-                    for ch in new_vol:
-                        prelim_map[new_vol_num].append(ch.ch_num)
-                        ch.vol_num = new_vol_num
-                        logger.debug(f'chapter {ch.ch_num} -> volume {new_vol_num}')
-
-        def from_scratch(vol_len):
-            """Call this if there is no volume info whatsoever. Makes volumes of a set length."""
-            logger.warning(f'no volume info found - defaulting to {vol_len} chapters per volume')
-
-            for new_vol in chunk(orphans, vol_len):
-                new_vol_num = len(vol_nums) + 1
-                logger.info(f'creating new volume - vol. {new_vol_num}')
-                vol_nums.append(new_vol_num)
-                for ch in new_vol:
-                    prelim_map[new_vol_num].append(ch.ch_num)
-                    ch.vol_num = new_vol_num
-                    logger.debug(f'chapter {ch.ch_num} -> volume {new_vol_num}')
-
-        if orphans and vol_nums:
-            fit_between()
-            if orphans:
-                extrapolate()
-        elif not vol_nums:
-            from_scratch(vol_len)
-        else:
-            # all chapters already have volumes assigned
-            logger.info('all chapters come naturally with volume info')
-
+        chapters = chapters if chapters is not None else self.downloaded
+        assign_volumes(chapters, vol_len, self.vol_strategies)
+        if self.vol_map_path is not None and self.vol_map_path.parent.is_dir():
+            save_volume_map(self.vol_map_path, chapters)
         logger.info('all chapters have been assigned to a volume ^_^')
 
     def print_bad_chapters(self):
@@ -8,69 +8,163 @@
 # TODO add more emojis!!! - and refactor them to another file
 
 import logging
-import os
 import sys
 
-from .cli import ARGS
-from .filesys import FileSys
+from . import cli
 from .helpers import _Getch, horizontal_rule, say_goodbye
-from .login import login
-from .manga import Manga
 from .mangodl_logging import mangodl_logging
-from .search import get_manga_id
+
+# the rest of the app is imported where it's needed, so that
+# `mangodl --help` or a bad option doesn't load every dependency,
+# and downloads by url or sync never load the login and search ones
 
 logger = logging.getLogger(__name__)
 
 getch = _Getch()
 
+# command line options - set when the app starts
+ARGS = None
+
+# set when --metrics or --metricsport is given
+METRICS = None
+
 
 def main():
     """This function is the program's entry point."""
+    global ARGS
+    mangodl_logging.setup()
+    ARGS = cli.parse_args()
+    start_metrics()
+
+    from .manga import Quit
+    try:
+        run()
+    except Quit:
+        say_goodbye()
+    finally:
+        stop_metrics()
+
+
+def start_metrics() -> None:
+    """Starts collecting metrics, if the options ask for them."""
+    global METRICS
+    if not ARGS.metrics and ARGS.metricsport is None:
+        return
+    from .metrics import Metrics, serve_prometheus
+
+    METRICS = Metrics(open(ARGS.metrics, 'a') if ARGS.metrics else None)
+    if ARGS.metricsport is not None:
+        serve_prometheus(METRICS, ARGS.metricsport)
+
+
+def stop_metrics() -> None:
+    if METRICS is not None and METRICS.stream is not None:
+        METRICS.close()
+        METRICS.stream.close()
+        logger.info(f'metrics written -> {ARGS.metrics}')
+
+
+def run():
+    # update manga downloaded before - no login
+    if ARGS.command == 'sync':
+        sync(*ARGS.ids)
+        sys.exit()
 
     # download via url - no login
     if ARGS.url:
+        manga_ids = []
         for url in ARGS.url:
             logger.info(f'downloading manga at {url}')
-            manga_id = url.split('/')[-2]
-            manga = Manga(manga_id)
-            proc_download(manga)
+            manga_ids.append(url.split('/')[-2])
+        proc_download(*manga_ids)
         sys.exit()
 
     # login and save cookies to file
+    from .login import login
     global COOKIE_FILE
     COOKIE_FILE = login()
 
-    # search for manga
-    manga_id = get_manga_id(ARGS.manga, COOKIE_FILE)
-    manga = Manga(manga_id)
-    # nothing has been downloaded before this point
-
-    # now commence download
-    proc_download(manga)
+    # search for manga and download it
+    search_and_download(ARGS.manga)
     # download completed
 
     # let user decide whether to quit or download another one
     next_manga()
 
 
-def proc_download(manga: Manga) -> None:
-    """Downloads everything."""
-    fs = FileSys(manga.title)
-    manga.download_chapters(fs,
-                            ARGS.language,
-                            ARGS.saver,
-                            ARGS.ratelimit,
-                            ARGS.novolume,
-                            ARGS.vollen,
-                            ARGS.all)
-
-    # archive to volumes
-    if not ARGS.novolume:
-        fs.create_volumes(manga.downloaded)
-
-    manga.print_bad_chapters()
-    logger.info(
-        f'{manga.title} has finished downloading - see the raw and archived files @ {fs.base_path}')
+def proc_download(*manga_ids: str) -> None:
+    """
+    Downloads everything. When given several manga, all of them are
+    fetched and downloaded together by one scheduler.
+    """
+    from .filesys import FileSys
+    from .scheduler import DownloadScheduler
+
+    staged = []
+    with DownloadScheduler(ARGS.ratelimit,
+                           ARGS.metalimit,
+                           ARGS.imagelimit,
+                           not ARGS.nocache,
+                           ARGS.archiveworkers,
+                           not ARGS.fixedrate,
+                           metrics=METRICS,
+                           cache_path=ARGS.cachepath) as scheduler:
+        for manga in scheduler.load_mangas(manga_ids):
+            # offer to search instead only when the manga came from a search
+            if not manga.stage_chapters(ARGS.language, ARGS.all, allow_search=not ARGS.url):
+                continue
+            fs = FileSys(manga.title, ARGS.folder, ARGS.format, ARGS.level, not ARGS.noverify)
+            fs.setup_folders(raw=not ARGS.direct)
+            manga.use_volume_strategy(fs, ARGS.volstrategy, ARGS.volmap)
+            # volumes are archived by the scheduler as they complete
+            scheduler.add(manga, fs, ARGS.saver, None if ARGS.novolume else ARGS.vollen, ARGS.direct)
+            staged.append((manga, fs))
+
+        scheduler.run()
+
+    for manga, fs in staged:
+        manga.finish_download(ARGS.novolume, ARGS.vollen, ARGS.direct)
+        manga.print_bad_chapters()
+        logger.info(
+            f'{manga.title} has finished downloading - see the {"" if ARGS.direct else "raw and "}archived files @ {fs.base_path}')
+
+
+def sync(*manga_ids: str) -> None:
+    """
+    Downloads the chapters of each manga which are missing from its
+    manifest, then rebuilds only the volumes those chapters fall into.
+    """
+    from .filesys import FileSys
+    from .scheduler import DownloadScheduler
+
+    staged = []
+    with DownloadScheduler(ARGS.ratelimit,
+                           ARGS.metalimit,
+                           ARGS.imagelimit,
+                           not ARGS.nocache,
+                           ARGS.archiveworkers,
+                           not ARGS.fixedrate,
+                           metrics=METRICS,
+                           cache_path=ARGS.cachepath) as scheduler:
+        logger.info(f'checking {len(manga_ids)} manga for new chapters')
+        for manga in scheduler.load_mangas(manga_ids):
+            fs = FileSys(manga.title, ARGS.folder, ARGS.format, ARGS.level, not ARGS.noverify)
+            if not manga.stage_new_chapters(ARGS.language, fs.manifest):
+                continue
+            fs.setup_folders()
+            manga.use_volume_strategy(fs, ARGS.volstrategy, ARGS.volmap)
+            scheduler.add(manga, fs, ARGS.saver)
+            staged.append((manga, fs))
+
+        scheduler.run()
+
+    for manga, fs in staged:
+        logger.info(f'all new chapters of {manga.title} downloaded (ᵔᴥᵔ)')
+        if not ARGS.novolume:
+            fs.create_volumes(manga.sync_volumes(fs, ARGS.saver, ARGS.vollen), ARGS.archiveworkers)
+
+        manga.print_bad_chapters()
+        logger.info(f'{manga.title} is up to date @ {fs.base_path}')
 
 
 def next_manga() -> None:
@@ -84,23 +178,25 @@ def next_manga() -> None:
         next_option()
 
         manga_title = input('Search for a manga: ')
-        manga_id = get_manga_id(manga_title, COOKIE_FILE)
-        manga = Manga(manga_id)
-        proc_download(manga)
+        search_and_download(manga_title)
 
 
-def search_another() -> None:
+def search_and_download(manga_title: str) -> None:
     """
-    Calling this function will abort the current process 
-    and search another manga.
+    Searches for a manga and downloads it. Searches again for as long
+    as the user abandons the manga found.
     """
-    horizontal_rule()
-    manga_title = input('Search for a manga: ')
-    manga_id = get_manga_id(manga_title, COOKIE_FILE)
-    manga = Manga(manga_id)
-    proc_download(manga)
+    from .manga import SearchAnother
+    from .search import get_manga_id
 
-    next_manga()
+    while True:
+        manga_id = get_manga_id(manga_title, COOKIE_FILE)
+        try:
+            proc_download(manga_id)
+            return
+        except SearchAnother:
+            horizontal_rule()
+            manga_title = input('Search for a manga: ')
 
 
 def next_option():
@@ -2,5 +2,21 @@ from pathlib import Path
 # configure root logger
 import logging
 import logging.config
+
 config_file = Path(__file__).parent / 'mangodl_logging.ini'
-logging.config.fileConfig(config_file)
+
+
+class TqdmHandler(logging.StreamHandler):
+    """Writes log messages above any progress bars, instead of through them."""
+
+    def emit(self, record):
+        from tqdm import tqdm  # only loaded once there's something to log
+        try:
+            tqdm.write(self.format(record), file=self.stream)
+        except Exception:
+            self.handleError(record)
+
+
+def setup():
+    """Configures the root logger for the command line app. Not called on import."""
+    logging.config.fileConfig(config_file, disable_existing_loggers=False)
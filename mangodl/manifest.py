@@ -0,0 +1,183 @@
+"""Contains the Manifest class, which records what has been saved to disk."""
+
+import os
+import json
+import hashlib
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set)
+from pathlib import Path
+
+import logging
+logger = logging.getLogger(__name__)
+
+# bytes hashed at a time when checking a saved page
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: Path) -> str:
+    """Hex sha256 of a file, read a chunk at a time."""
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+class Manifest:
+    """
+    Manifest objects keep track of every chapter and page of a manga that
+    has been saved to disk, so a later run can skip them.
+
+    The manifest is an append-only file of JSON lines. Each completed page
+    adds one line, so recording progress costs the same however large the
+    manga is. Later lines override earlier ones, and `close` rewrites the
+    file with one line per record.
+
+    Parameters
+    ----------
+    path : Path
+        Where the manifest lives. It is created on the first write.
+    verify : bool, default True
+        Check the sha256 of saved pages, not just their size, before
+        counting them as done. Costs a read of every saved page.
+
+    Attributes
+    ----------
+    chapters : dict
+        Maps chapter id (as str) to a dict with the keys 'chapter', 'volume',
+        'title', 'folder', 'status' and 'pages'. 'pages' maps each page's
+        name on the image server to a dict with the keys 'url', 'file',
+        'size', 'sha256' and 'status'.
+    """
+
+    def __init__(self, path: Path, verify: bool = True):
+        self.path = path
+        self.verify = verify
+        self.chapters: Dict[str, Dict] = {}
+        self._file = None
+
+        self._load()
+
+    def _load(self) -> None:
+        """Replays the manifest file, if there is one."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        # last line may have been cut off by a crash
+                        logger.warning(f'skipping damaged line in {self.path}')
+        except FileNotFoundError:
+            return
+        logger.info(f'loaded manifest with {len(self.chapters)} chapter(s) <- {self.path}')
+
+    def _apply(self, rec: Dict) -> None:
+        ch_id = str(rec['id'])
+        if rec['type'] == 'chapter':
+            ch = self.chapters.setdefault(ch_id, {'pages': {}})
+            ch.update({k: rec[k] for k in ('chapter', 'volume', 'title', 'folder', 'status')})
+        elif rec['type'] == 'page':
+            ch = self.chapters.setdefault(ch_id, {'pages': {}, 'status': 'partial'})
+            ch['pages'][rec['page']] = {k: rec[k] for k in ('url', 'file', 'size', 'sha256', 'status')}
+        elif rec['type'] == 'drop':
+            self.chapters.pop(ch_id, None)
+
+    def _append(self, rec: Dict) -> None:
+        self._apply(rec)
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(rec) + '\n')
+        self._file.flush()
+
+    def add_chapter(self, ch_id: Union[str, int], ch_num: str, vol_num: str, title: str, folder: str) -> None:
+        """Records that a chapter has started downloading into `folder`."""
+        self._append({'type': 'chapter',
+                      'id': str(ch_id),
+                      'chapter': ch_num,
+                      'volume': vol_num,
+                      'title': title,
+                      'folder': folder,
+                      'status': 'partial'})
+
+    def finish_chapter(self, ch_id: Union[str, int]) -> None:
+        """Marks a chapter as having every page saved."""
+        rec = {k: v for k, v in self.chapters[str(ch_id)].items() if k != 'pages'}
+        rec.update({'type': 'chapter', 'id': str(ch_id), 'status': 'complete'})
+        self._append(rec)
+
+    def drop_chapter(self, ch_id: Union[str, int]) -> None:
+        """Forgets a chapter and its pages, after its folder was removed."""
+        self._append({'type': 'drop', 'id': str(ch_id)})
+
+    def add_page(self,
+                 ch_id: Union[str, int],
+                 page: str,
+                 url: str,
+                 file_name: str,
+                 size: int,
+                 checksum: str) -> None:
+        """Records a page which has been fully written to disk."""
+        self._append({'type': 'page',
+                      'id': str(ch_id),
+                      'page': page,
+                      'url': url,
+                      'file': file_name,
+                      'size': size,
+                      'sha256': checksum,
+                      'status': 'complete'})
+
+    def page_is_done(self, ch_id: Union[str, int], page: str, page_path: Path, verify: bool = True) -> bool:
+        """
+        Checks if a page was saved before and is still on disk at
+        `page_path` with the recorded size - and, with `verify` here and
+        on the manifest, the recorded sha256.
+        """
+        try:
+            entry = self.chapters[str(ch_id)]['pages'][page]
+        except KeyError:
+            return False
+        if entry['status'] != 'complete' or entry['file'] != page_path.name:
+            return False
+        try:
+            if os.path.getsize(page_path) != entry['size']:
+                return False
+            # the right size doesn't rule out a page damaged on disk
+            if verify and self.verify and file_sha256(page_path) != entry['sha256']:
+                logger.warning(f'{page_path} doesn\'t match its checksum - saving it again')
+                return False
+        except OSError:
+            return False
+        return True
+
+    def completed_chapter(self, ch_id: Union[str, int]) -> Optional[Dict]:
+        """Returns the entry for a chapter if all of its pages were saved, otherwise None."""
+        entry = self.chapters.get(str(ch_id))
+        if entry and entry.get('status') == 'complete':
+            return entry
+        return None
+
+    def close(self) -> None:
+        """Rewrites the manifest with one line per record."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self.chapters:
+            return
+
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for ch_id, ch in self.chapters.items():
+                for page, entry in ch['pages'].items():
+                    f.write(json.dumps({'type': 'page', 'id': ch_id, 'page': page, **entry}) + '\n')
+                if 'folder' in ch:
+                    rec = {k: v for k, v in ch.items() if k != 'pages'}
+                    f.write(json.dumps({'type': 'chapter', 'id': ch_id, **rec}) + '\n')
+        os.replace(tmp_path, self.path)
+        logger.debug(f'compacted manifest -> {self.path}')
@@ -0,0 +1,247 @@
+"""
+Contains the Metrics class, which collects counters, gauges and timings
+from a download run, and ways to get them out: a Prometheus text
+endpoint, and a stream of JSON lines.
+"""
+
+import json
+import math
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable,
+                    TextIO)
+
+import logging
+logger = logging.getLogger(__name__)
+
+# upper bounds of the histogram buckets for timings, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf)
+
+# prefix for every metric name in the Prometheus output
+PREFIX = 'mangodl_'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Timing:
+    __slots__ = ('count', 'sum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+
+class Metrics:
+    """
+    Collects what happens during a run. Safe to use from several threads.
+
+    - counters only go up, e.g. pages downloaded or retries made.
+    - gauges go up and down, e.g. requests waiting for a slot.
+    - timings are kept as histograms, e.g. time to first byte.
+
+    Each kind of metric takes keyword arguments as labels, like
+    `metrics.inc('pages', result='saved')`.
+
+    Parameters
+    ----------
+    stream : file-like, optional
+        Counters and timings are written to it as JSON lines as they
+        happen. Gauges change too often for that, so only their final
+        values are written, by `close`.
+    clock : callable, optional
+        Returns the time in seconds. Defaults to `time.time`.
+
+    Attributes
+    ----------
+    counters, gauges : dict
+        Map (name, labels) to the current value.
+    timings : dict
+        Map (name, labels) to a histogram.
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None, clock: Callable[[], float] = time.time):
+        self.stream = stream
+        self.clock = clock
+        self.counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.gauges: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self.timings: Dict[Tuple[str, Labels], _Timing] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, object]) -> Tuple[str, Labels]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def _write(self, kind: str, name: str, labels: Labels, value: float) -> None:
+        # called with the lock held
+        if self.stream is not None:
+            self.stream.write(json.dumps({'time': round(self.clock(), 6), 'type': kind, 'name': name,
+                                          'labels': dict(labels), 'value': value}) + '\n')
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Adds `value` to a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] += value
+            self._write('counter', name, key[1], value)
+
+    def add(self, name: str, delta: float, **labels) -> None:
+        """Moves a gauge up or down by `delta`."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] += delta
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Sets a gauge."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Records how long something took."""
+        key = self._key(name, labels)
+        with self._lock:
+            timing = self.timings.get(key)
+            if timing is None:
+                timing = self.timings[key] = _Timing()
+            timing.count += 1
+            timing.sum += seconds
+            timing.buckets[bisect_left(BUCKETS, seconds)] += 1
+            self._write('timing', name, key[1], seconds)
+
+    def to_prometheus(self) -> str:
+        """Returns every metric in the Prometheus text format."""
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, v.replace('\\', r'\\').replace('"', r'\"'))
+                                  for k, v in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                seen = set()
+                for (name, labels), value in sorted(values.items()):
+                    full_name = PREFIX + name + ('_total' if kind == 'counter' else '')
+                    if name not in seen:
+                        lines.append(f'# TYPE {full_name} {kind}')
+                        seen.add(name)
+                    lines.append(f'{full_name}{fmt(labels)} {value:g}')
+            seen = set()
+            for (name, labels), timing in sorted(self.timings.items(), key=lambda item: item[0]):
+                full_name = PREFIX + name + '_seconds'
+                if name not in seen:
+                    lines.append(f'# TYPE {full_name} histogram')
+                    seen.add(name)
+                cumulative = 0
+                for bound, count in zip(BUCKETS, timing.buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else f'{bound:g}'
+                    lines.append(f'{full_name}_bucket{fmt(labels, (("le", le),))} {cumulative}')
+                lines.append(f'{full_name}_sum{fmt(labels)} {timing.sum:g}')
+                lines.append(f'{full_name}_count{fmt(labels)} {timing.count}')
+        return '\n'.join(lines) + '\n'
+
+    def close(self) -> None:
+        """Writes the final value of every gauge to the stream, and flushes it."""
+        if self.stream is None:
+            return
+        with self._lock:
+            for (name, labels), value in sorted(self.gauges.items()):
+                self._write('gauge', name, labels, value)
+            self.stream.flush()
+
+
+def trace_config(metrics: Metrics) -> 'aiohttp.TraceConfig':
+    """
+    Returns an `aiohttp.TraceConfig` which times the steps of every
+    request made by a session into `metrics`: DNS lookups, new
+    connections and the time to the response headers (TTFB).
+    """
+    import aiohttp
+    from urllib.parse import urlsplit
+
+    def now() -> float:
+        return time.perf_counter()
+
+    async def on_request_start(session, ctx, params) -> None:
+        ctx.start = now()
+        ctx.host = urlsplit(str(params.url)).netloc
+
+    async def on_dns_start(session, ctx, params) -> None:
+        ctx.dns_start = now()
+
+    async def on_dns_end(session, ctx, params) -> None:
+        metrics.observe('dns', now() - ctx.dns_start, host=params.host)
+
+    async def on_connect_start(session, ctx, params) -> None:
+        ctx.connect_start = now()
+
+    async def on_connect_end(session, ctx, params) -> None:
+        metrics.observe('connect', now() - ctx.connect_start, host=ctx.host)
+
+    async def on_reuse(session, ctx, params) -> None:
+        metrics.inc('connections_reused', host=ctx.host)
+
+    async def on_request_end(session, ctx, params) -> None:
+        metrics.observe('ttfb', now() - ctx.start, host=ctx.host)
+        metrics.inc('responses', host=ctx.host, status=params.response.status)
+
+    async def on_request_exception(session, ctx, params) -> None:
+        metrics.inc('request_errors', host=ctx.host, error=type(params.exception).__name__)
+
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_dns_resolvehost_start.append(on_dns_start)
+    config.on_dns_resolvehost_end.append(on_dns_end)
+    config.on_connection_create_start.append(on_connect_start)
+    config.on_connection_create_end.append(on_connect_end)
+    config.on_connection_reuseconn.append(on_reuse)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+
+def serve_prometheus(metrics: Metrics, port: int, host: str = '127.0.0.1') -> 'http.server.HTTPServer':
+    """
+    Serves `metrics` in the Prometheus text format at /metrics, from a
+    background thread, so it keeps answering while the event loop is
+    busy or the app is waiting on a prompt. Call `shutdown()` on the
+    returned server to stop it.
+    """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = Server((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'serving metrics at http://{host}:{server.server_port}/metrics')
+    return server
@@ -0,0 +1,277 @@
+"""
+Contains the RateLimitedSession class, and the adaptive token bucket it
+uses to pace requests.
+"""
+
+import time
+import asyncio
+import aiohttp
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable)
+from aiohttp import ClientSession
+
+from .metrics import Metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+# statuses which mean we are asking too often
+THROTTLE_STATUSES = {429, 503}
+
+
+def parse_retry_after(value: Optional[str], now: Optional[float] = None) -> Optional[float]:
+    """
+    Reads a Retry-After header, which holds either a number of seconds or
+    an HTTP date. Returns the seconds left to wait, or None if the header
+    is missing or unreadable.
+
+    parse_retry_after('120')
+    >>>120.0
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        then = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return max(then - (time.time() if now is None else now), 0.0)
+
+
+class TokenBucket:
+    """
+    Token bucket whose refill rate follows the server's feedback, by
+    additive increase / multiplicative decrease (AIMD):
+
+    - every successful response raises the rate by `increase / rate`, so
+      about `increase` more requests per second for each second of
+      smooth traffic, up to `max_rate`.
+    - a throttling status cuts the rate by `decrease`, and a Retry-After
+      header stops all requests until it has passed.
+    - if the average latency climbs to `latency_factor` times the best
+      seen so far, the server is struggling - the rate stops climbing and
+      is cut gently.
+
+    Cuts happen at most once per `cooldown` seconds, so a burst of 429s
+    from requests already in flight only counts once.
+
+    Waiters are served in order, and each one sleeps exactly until its
+    token is due rather than polling.
+
+    Parameters
+    ----------
+    rate : float, default 20
+        Tokens produced per second to begin with.
+    max_tokens : int, default 20
+        Size of the bucket.
+    min_rate, max_rate : float, optional
+        Bounds for the rate. `max_rate` defaults to four times `rate`.
+    adaptive : bool, default True
+        If False, the rate never changes, though Retry-After is still obeyed.
+    clock : callable, optional
+        Returns the time in seconds. Defaults to `time.monotonic`.
+
+    Attributes
+    ----------
+    tokens : float
+        Number of tokens in the bucket when it was last updated.
+    latency : float or None
+        Moving average of the time taken to get response headers.
+    blocked_until : float
+        No tokens are handed out before this time.
+    """
+
+    def __init__(self,
+                 rate: float = 20,
+                 max_tokens: int = 20,
+                 min_rate: float = 1,
+                 max_rate: Optional[float] = None,
+                 adaptive: bool = True,
+                 increase: float = 1,
+                 decrease: float = 0.5,
+                 latency_factor: float = 2,
+                 cooldown: float = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max_rate if max_rate is not None else rate * 4
+        self.adaptive = adaptive
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.clock = clock
+
+        self.tokens = float(max_tokens)
+        self.updated_at = clock()
+        self.blocked_until = 0.0
+        self.latency: Optional[float] = None
+        self.best_latency: Optional[float] = None
+        self._last_cut = float('-inf')
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def acquire(self) -> Awaitable:
+        """Waits until a token is available, then takes it."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # holding the lock while asleep keeps waiters in order
+        async with self._lock:
+            delay = self.reserve()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.reserve()  # the rate may have changed meanwhile
+
+    def reserve(self) -> float:
+        """
+        Takes a token if one is available and returns 0. Otherwise returns
+        the number of seconds until one will be.
+        """
+        now = self.clock()
+        if now < self.blocked_until:
+            # nothing builds up while the server wants us to stay away
+            self.tokens, self.updated_at = 0.0, now
+            return self.blocked_until - now
+        since = max(self.updated_at, self.blocked_until)
+        self.tokens = min(self.tokens + (now - since) * self.rate, self.max_tokens)
+        self.updated_at = now
+        if self.tokens >= 1 - 1e-9:  # don't sleep off rounding errors
+            self.tokens = max(self.tokens - 1, 0.0)
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def on_response(self, status: int, retry_after: Optional[str] = None, latency: Optional[float] = None) -> None:
+        """Adjusts the rate after a response arrives."""
+        if status in THROTTLE_STATUSES:
+            delay = parse_retry_after(retry_after)
+            if delay:
+                self.blocked_until = max(self.blocked_until, self.clock() + delay)
+                logger.warning(f'server asked us to wait {delay:.1f}s (status {status})')
+            self._cut(self.decrease, f'throttled with status {status}')
+            return
+
+        if latency is not None:
+            self.latency = latency if self.latency is None else self.latency + 0.2 * (latency - self.latency)
+            if self.best_latency is None or self.latency < self.best_latency:
+                self.best_latency = self.latency
+            else:
+                # let the baseline creep up, so one lucky response doesn't set it for good
+                self.best_latency += 0.01 * (self.latency - self.best_latency)
+            if self.latency > self.latency_factor * self.best_latency:
+                self._cut(0.8, f'latency up to {self.latency:.2f}s from {self.best_latency:.2f}s')
+                return
+
+        if self.adaptive and status < 500:
+            self.rate = min(self.rate + self.increase / self.rate, self.max_rate)
+
+    def on_error(self) -> None:
+        """Adjusts the rate after a request fails without a response."""
+        self._cut(0.8, 'request failed')
+
+    def _cut(self, factor: float, reason: str) -> None:
+        now = self.clock()
+        if not self.adaptive or now - self._last_cut < self.cooldown:
+            return
+        self._last_cut = now
+        old_rate, self.rate = self.rate, max(self.rate * factor, self.min_rate)
+        logger.debug(f'{reason} - rate {old_rate:.1f} -> {self.rate:.1f} requests per second')
+
+
+class _ReportingRequest:
+    """Wraps a request context manager, telling the bucket how the request went."""
+
+    def __init__(self, request, bucket: TokenBucket):
+        self.request = request
+        self.bucket = bucket
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        start = time.monotonic()
+        try:
+            resp = await self.request.__aenter__()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.bucket.on_error()
+            raise
+        self.bucket.on_response(resp.status, resp.headers.get('Retry-After'), time.monotonic() - start)
+        return resp
+
+    async def __aexit__(self, *exc) -> Awaitable:
+        return await self.request.__aexit__(*exc)
+
+
+# recipe from https://gist.github.com/pquentin/5d8f5408cdad73e589d85ba509091741
+class RateLimitedSession():
+    """
+    Wrapper class for `aiohttp.ClientSession` objects. Injects
+    a rate limit on the number of calls per second by maintaining a bucket
+    of 'tokens', and lets the responses steer the rate.
+
+    Every host gets its own bucket, so a strict or slow server only holds
+    back the requests sent to it.
+
+    Use as `async with await session.get(url) as resp: ...`.
+
+    Parameters
+    ----------
+    session : aiohttp.ClientSession
+    rate, max_tokens : int, optional
+        `rate` describes the number of tokens produced per second to begin
+        with, for each host. `max_tokens` is the size of each bucket. (Both
+        values default to 20.)
+    adaptive : bool, default True
+        Raise and lower the rate according to the responses. If False,
+        the rate stays at `rate`.
+    metrics : Metrics, optional
+        Records how long requests wait for a token, and each host's rate.
+
+    Attributes
+    ----------
+    buckets : dict
+        Maps each host contacted so far to its TokenBucket.
+    """
+
+    def __init__(self,
+                 session: ClientSession,
+                 rate: int = 20,
+                 max_tokens: int = 20,
+                 adaptive: bool = True,
+                 metrics: Optional[Metrics] = None):
+        self.session = session
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.adaptive = adaptive
+        self.metrics = metrics
+        self.buckets: Dict[str, TokenBucket] = {}
+
+        logger.debug(f'created rate-limited client at {rate} calls per second per host (adaptive: {adaptive})')
+
+    def bucket_for(self, url: str) -> TokenBucket:
+        """Returns the bucket for the host of `url`, creating it on first use."""
+        host = urlsplit(str(url)).netloc
+        if host not in self.buckets:
+            logger.debug(f'new rate limit bucket for {host}')
+            self.buckets[host] = TokenBucket(self.rate, self.max_tokens, adaptive=self.adaptive)
+        return self.buckets[host]
+
+    async def get(self, url: str, *args, **kwargs) -> _ReportingRequest:
+        bucket = self.bucket_for(url)
+        if self.metrics is None:
+            await bucket.acquire()
+        else:
+            start = time.perf_counter()
+            await bucket.acquire()
+            host = urlsplit(str(url)).netloc
+            self.metrics.observe('token_wait', time.perf_counter() - start, host=host)
+            self.metrics.set('rate_limit', bucket.rate, host=host)
+        return _ReportingRequest(self.session.get(url, *args, **kwargs), bucket)
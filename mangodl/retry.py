@@ -0,0 +1,201 @@
+"""
+Contains the RetryPolicy class, used to retry failed requests with
+exponential backoff, and the RetryBudget which caps retries across a run.
+"""
+
+import random
+import asyncio
+import aiohttp
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable,
+                    Type)
+
+from .metrics import Metrics
+from .ratelimit import parse_retry_after
+
+import logging
+logger = logging.getLogger(__name__)
+
+# statuses worth asking again for
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# exceptions worth trying again after - dropped connections, timeouts and the like
+RETRY_EXCEPTIONS: Tuple[Type[BaseException], ...] = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class StatusError(Exception):
+    """Raised by a request which got a bad HTTP status."""
+
+    def __init__(self, status: int, retry_after: Optional[str] = None):
+        super().__init__(f'got status {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RetryError(Exception):
+    """Raised when a RetryPolicy gives up."""
+
+
+def check_status(resp: aiohttp.ClientResponse) -> None:
+    """Raises StatusError if a response does not have a 2xx status."""
+    if not 200 <= resp.status < 300:
+        raise StatusError(resp.status, resp.headers.get('Retry-After'))
+
+
+class RetryBudget:
+    """
+    Caps the number of retries in a run, as a share of the requests made.
+    Once a server starts failing everything, retries soon run out, rather
+    than each request retrying on its own.
+
+    Parameters
+    ----------
+    ratio : float, default 0.5
+        Retries allowed per request made - enough for a server which
+        fails a third of its requests to still serve every page.
+    min_retries : int, default 20
+        Retries allowed on top of that, so the first few failures of a
+        run can always be retried.
+
+    Attributes
+    ----------
+    requests : int
+        Number of requests made, not counting retries.
+    retries : int
+        Number of retries spent.
+    """
+
+    def __init__(self, ratio: float = 0.5, min_retries: int = 20):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.requests = 0
+        self.retries = 0
+        self._warned = False
+
+    def record_request(self) -> None:
+        self.requests += 1
+
+    def spend(self) -> bool:
+        """Takes one retry from the budget. Returns False if there are none left."""
+        if self.retries >= self.min_retries + self.ratio * self.requests:
+            if not self._warned:
+                logger.warning(f'retry budget used up after {self.retries} retries - failing fast for now')
+                self._warned = True
+            return False
+        self.retries += 1
+        return True
+
+
+class RetryPolicy:
+    """
+    Runs a request again when it fails in a way that might go away:
+    a dropped connection, a timeout or a status in `retry_statuses`.
+
+    Waits grow exponentially with each attempt, with random jitter so
+    that many requests failing together don't all come back together.
+    If the server sent a Retry-After header, we wait at least that long.
+
+    Parameters
+    ----------
+    max_tries : int, default 5
+        Attempts per request, including the first.
+    base_delay : float, default 1
+        Seconds to wait, on average, after the first failure. Doubles each time.
+    max_delay : float, default 30
+        Upper bound for the backoff, not counting Retry-After.
+    retry_statuses : set, optional
+        Defaults to `RETRY_STATUSES`.
+    budget : RetryBudget, optional
+        Shared by every request using this policy.
+    rng : random.Random, optional
+        Source of jitter.
+    metrics : Metrics, optional
+        Counts retries and give-ups, by reason.
+    """
+
+    def __init__(self,
+                 max_tries: int = 5,
+                 base_delay: float = 1,
+                 max_delay: float = 30,
+                 retry_statuses: Optional[Set[int]] = None,
+                 budget: Optional[RetryBudget] = None,
+                 rng: Optional[random.Random] = None,
+                 metrics: Optional[Metrics] = None):
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses if retry_statuses is not None else RETRY_STATUSES
+        self.budget = budget
+        self.rng = rng if rng is not None else random.Random()
+        self.metrics = metrics
+
+    def delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait after failed attempt number `attempt` (counting from 0)."""
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        # half fixed, half random - never hammer the server, never synchronise
+        delay = cap / 2 + self.rng.uniform(0, cap / 2)
+        return max(delay, retry_after or 0)
+
+    async def call(self,
+                   fn: Callable[[], Awaitable],
+                   what: str = 'request',
+                   retry_on: Tuple[Type[BaseException], ...] = RETRY_EXCEPTIONS):
+        """
+        Awaits `fn()` until it succeeds, and returns what it returns.
+
+        Parameters
+        ----------
+        fn : callable
+            Makes one attempt. Should raise StatusError for bad statuses.
+        what : str
+            Describes the request in log messages.
+        retry_on : tuple
+            Exceptions which are worth another attempt.
+
+        Returns
+        -------
+        Whatever `fn()` returns.
+
+        Raises
+        ------
+        RetryError
+            If the last attempt failed, or the budget ran out.
+        Any other exception raised by `fn`, including StatusError for
+        statuses not in `retry_statuses`, immediately.
+        """
+        if self.budget is not None:
+            self.budget.record_request()
+
+        for attempt in range(self.max_tries):
+            try:
+                return await fn()
+            except StatusError as e:
+                if e.status not in self.retry_statuses:
+                    raise
+                error, retry_after = e, parse_retry_after(e.retry_after)
+            except retry_on as e:
+                error, retry_after = e, None
+
+            reason = str(error.status) if isinstance(error, StatusError) else type(error).__name__
+            if attempt + 1 == self.max_tries:
+                break
+            if self.budget is not None and not self.budget.spend():
+                if self.metrics is not None:
+                    self.metrics.inc('retries_denied', reason=reason)
+                raise RetryError(f'not retrying {what} - retry budget used up ({repr(error)})') from error
+            delay = self.delay(attempt, retry_after)
+            logger.warning(f'{what} failed ({repr(error)}) - trying again in {delay:.1f}s')
+            if self.metrics is not None:
+                self.metrics.inc('retries', reason=reason)
+            await asyncio.sleep(delay)
+
+        if self.metrics is not None:
+            self.metrics.inc('retries_exhausted', reason=reason)
+        raise RetryError(f'gave up on {what} after {self.max_tries} tries ({repr(error)})') from error
@@ -0,0 +1,451 @@
+"""
+Contains the DownloadScheduler class, which downloads chapters from
+several manga at once.
+"""
+
+import time
+import asyncio
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Callable,
+                    NamedTuple)
+from pathlib import Path
+
+from .cache import ResponseCache
+from .client import ApiClient
+from .filesys import FileSys, StreamingArchive
+from .helpers import ConcurrencyPool, interleave, safe_to_int
+from .index import ChapterRecord
+from .metrics import Metrics, trace_config
+from .ratelimit import RateLimitedSession
+from .retry import RetryPolicy, RetryBudget
+from .manga import Manga
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Progress(NamedTuple):
+    """
+    What a DownloadScheduler reports to its `on_progress` callback.
+
+    `kind` is 'page' each time a page is dealt with, 'chapter' when a
+    chapter is done with (whether or not it could be downloaded) and
+    'volume' when a volume archive has been written. `done` and `total`
+    count the pages, chapters or volumes of `manga` so far - the total
+    number of pages grows as chapters are loaded. `item` is the chapter
+    number for chapters and the archive path for volumes.
+    """
+    kind: str
+    manga: Manga
+    done: int
+    total: int
+    item: Union[str, Path, None] = None
+
+
+class _MangaProgress:
+    """
+    Counts what has been done for one manga. Stands in for the shared
+    progress bar in `Manga.download_chapter`, passing page counts on to
+    the bar (if there is one) and the callback.
+    """
+
+    def __init__(self, manga: Manga, bar, report: Callable[[Progress], None]):
+        self.manga = manga
+        self.bar = bar
+        self.report = report
+        self.n = 0
+        self._total = 0
+        self.chapters = 0
+        self.volumes = 0
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    @total.setter
+    def total(self, total: int) -> None:
+        if self.bar is not None:
+            self.bar.total += total - self._total
+        self._total = total
+
+    def refresh(self) -> None:
+        if self.bar is not None:
+            self.bar.refresh()
+
+    def update(self, n: int = 1) -> None:
+        self.n += n
+        if self.bar is not None:
+            self.bar.update(n)
+        self.report(Progress('page', self.manga, self.n, self._total))
+
+
+class DownloadScheduler:
+    """
+    Downloads the staged chapters of every manga added to it inside one
+    event loop, sharing the same sessions and a single `ConcurrencyPool`.
+
+    Chapters from different manga are interleaved, so a slow title does
+    not hold up the titles queued after it. The pool hands out slots per
+    request, so pages from many chapters are in flight together.
+
+    Downloading and archiving run as two stages of a pipeline. Each
+    chapter, once done with, goes into a bounded queue. Archivers take
+    chapters from it, and as soon as the last chapter of a volume arrives
+    they write the volume in a worker thread, while downloads carry on.
+    If archiving falls behind, the queue fills up and downloads wait for
+    it, so unarchived chapters never pile up.
+
+    In direct mode, pages are written into their archive as they
+    download and no raw files are kept. Each volume being downloaded has
+    an archive open, and archivers only have to close it once the volume
+    is complete.
+
+    The sessions live as long as the scheduler, so manga info, chapter
+    info and images all reuse keep-alive connections. API calls and images
+    go through separate sessions, each with its own connection pool and a
+    cap on connections per host, so image servers never take the
+    connections meant for the API. Use it as a context manager:
+
+    with DownloadScheduler(30) as scheduler:
+        for manga in scheduler.load_mangas(ids):
+            ...
+            scheduler.add(manga, fs, saver, vol_len)
+        scheduler.run()
+
+    Parameters
+    ----------
+    rate_limit : int
+        Starting rate for the `RateLimitedSession` instance.
+    metadata_limit : int, default 4
+        Maximum number of API requests in flight, across all manga.
+    image_limit : int, default 16
+        Maximum number of image downloads in flight from each image server,
+        across all manga.
+    use_cache : bool, default True
+        Keep API responses in a `ResponseCache` between runs.
+    cache_path : str or Path, optional
+        File to keep them in, instead of the default in the user's cache folder.
+    archive_workers : int, default 4
+        Maximum number of volume archives being written at once.
+    archive_queue : int, default 16
+        Maximum number of finished chapters waiting for the archivers.
+    adaptive_rate : bool, default True
+        Let the rate limit follow the server's responses. If False, it
+        stays at `rate_limit`.
+    show_progress : bool, default True
+        Draw a progress bar in the terminal.
+    on_progress : callable, optional
+        Called with a `Progress` tuple as pages, chapters and volumes are
+        done. Called from the scheduler's thread.
+    metrics : Metrics, optional
+        Records timings and counts for the whole pipeline: the phases of
+        every request (DNS, connect, time to first byte, transfer), token
+        bucket waits, queue depths, retries, pages, chapters and archives.
+
+    Attributes
+    ----------
+    jobs : list
+        (manga, filesys, saver, archive, direct) tuples, one for each manga added since the last run.
+    client : ApiClient
+        Available once the scheduler has been entered.
+    """
+
+    def __init__(self,
+                 rate_limit: int,
+                 metadata_limit: int = 4,
+                 image_limit: int = 16,
+                 use_cache: bool = True,
+                 archive_workers: int = 4,
+                 adaptive_rate: bool = True,
+                 show_progress: bool = True,
+                 on_progress: Optional[Callable[[Progress], None]] = None,
+                 metrics: Optional[Metrics] = None,
+                 archive_queue: int = 16,
+                 cache_path: Union[str, Path, None] = None):
+        self.rate_limit = rate_limit
+        self.adaptive_rate = adaptive_rate
+        self.metadata_limit = metadata_limit
+        self.image_limit = image_limit
+        self.use_cache = use_cache
+        self.cache_path = cache_path
+        self.show_progress = show_progress
+        self.on_progress = on_progress
+        self.metrics = metrics
+        self.jobs: List[Tuple] = []
+
+        self.archive_workers = archive_workers
+        self.archive_queue = archive_queue
+        self.archive_pool = ThreadPoolExecutor(max_workers=archive_workers)
+        self._queue: Optional[asyncio.Queue] = None
+        self._archiving = 0  # volumes being written right now
+        self._streaming: Dict[Tuple[int, Union[int, float]], StreamingArchive] = {}  # direct mode volumes in progress
+
+        self.loop = asyncio.new_event_loop()
+        self.client: Optional[ApiClient] = None
+
+    def __enter__(self) -> 'DownloadScheduler':
+        self.loop.run_until_complete(self._open())
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.loop.run_until_complete(self.client.session.session.close())
+        self.loop.run_until_complete(self.client.image_session.session.close())
+        self.loop.close()
+        self.archive_pool.shutdown()
+        if self.client.cache:
+            self.client.cache.close()
+
+    async def _open(self) -> Awaitable:
+        # aiohttp sessions must be created inside the loop they run in
+        api_connector = aiohttp.TCPConnector(limit_per_host=self.metadata_limit)
+        image_connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.image_limit)
+        traces = [trace_config(self.metrics)] if self.metrics is not None else []
+        session = RateLimitedSession(aiohttp.ClientSession(connector=api_connector, trace_configs=traces),
+                                     self.rate_limit, self.rate_limit, self.adaptive_rate, self.metrics)
+        image_session = RateLimitedSession(aiohttp.ClientSession(connector=image_connector, trace_configs=traces),
+                                           self.rate_limit, self.rate_limit, self.adaptive_rate, self.metrics)
+        pool = ConcurrencyPool(self.metadata_limit, self.image_limit, self.metrics)
+        cache = ResponseCache(self.cache_path) if self.use_cache else None
+        # one budget for every request of the run, so a dead server can't soak up endless retries
+        retry = RetryPolicy(budget=RetryBudget(), metrics=self.metrics)
+        self.client = ApiClient(session, pool, retry=retry, cache=cache, image_session=image_session,
+                                metrics=self.metrics)
+
+    def load_mangas(self, ids: List[Union[str, int]]) -> List[Manga]:
+        """
+        Fetches info and chapter lists for many manga at once. Manga which
+        could not be fetched are left out.
+        """
+        logger.info(f'getting info for {len(ids)} manga')
+        results = self.loop.run_until_complete(self.client.get_mangas(ids))
+        return [Manga(id, *res) for id, res in zip(ids, results) if res]
+
+    def add(self,
+            manga: Manga,
+            fs: FileSys,
+            saver: bool,
+            vol_len: Optional[int] = None,
+            direct: Optional[str] = None) -> None:
+        """
+        Queues the chapters in `manga.s_downloads` for download.
+
+        Parameters
+        ----------
+        manga : manga.Manga instance
+            Must have its chapters staged already.
+        fs : filesys.FileSys instance
+        saver : bool
+            Lower quality images if set to True.
+        vol_len : int, optional
+            If given, volumes are planned now and archived during the run,
+            with `vol_len` as the default length per volume. Otherwise
+            nothing is archived.
+        direct : {'volume', 'chapter'}, optional
+            Write pages straight into an archive per volume (which needs
+            `vol_len`) or per chapter, without saving them to `fs.raw_path`
+            first. Nothing is recorded in `fs.manifest`.
+
+        Returns
+        -------
+        None
+        """
+        logger.debug(f'scheduled {len(manga.s_downloads)} chapter(s) of {manga.title}')
+        if direct not in (None, 'volume', 'chapter'):
+            raise ValueError(f'unknown direct mode {direct!r} - use volume or chapter')
+        if direct is not None and fs.out_format != 'cbz':
+            raise ValueError(f'pages can only be written straight into cbz archives, not {fs.out_format}')
+        if direct == 'volume' and vol_len is None:
+            raise ValueError('writing volumes directly needs a volume length')
+        if vol_len is not None and direct != 'chapter':
+            manga.plan_volumes(vol_len)
+        self.jobs.append((manga, fs, saver, vol_len is not None and direct != 'chapter', direct))
+
+    def run(self) -> None:
+        """Downloads everything queued so far. Blocks until all chapters are done."""
+        if self.jobs:
+            try:
+                self.loop.run_until_complete(self._main())
+            finally:
+                for _, fs, _, _, _ in self.jobs:
+                    fs.manifest.close()
+                self.jobs = []
+
+    async def _main(self) -> Awaitable:
+        bar = None
+        if self.show_progress:
+            from tqdm import tqdm  # not needed at all without a terminal
+
+            # total grows as each chapter reports its page count
+            bar = tqdm(total=0,
+                       desc='Downloading pages',
+                       bar_format='{l_bar}{bar}| {n_fmt}/{total_fmt}',
+                       ncols=80,
+                       leave=False)
+        # items are (manga, record, fs, progress, direct) for each chapter done with, and None to stop
+        self._queue = asyncio.Queue(maxsize=self.archive_queue)
+        errors: List[BaseException] = []
+        archivers = [self.loop.create_task(self._archiver(errors)) for _ in range(self.archive_workers)]
+        try:
+            try:
+                # one list of chapter downloads per manga, merged round-robin
+                per_manga = []
+                for manga, fs, saver, archive, direct in self.jobs:
+                    progress = _MangaProgress(manga, bar, self._report)
+                    per_manga.append([self._download_chapter(manga, record, fs, saver, archive, progress, direct)
+                                      for record in manga.s_downloads])
+                await asyncio.gather(*interleave(*per_manga))
+            finally:
+                if bar is not None:
+                    bar.close()
+
+            self.client.health.report()
+
+            # let the archivers finish the last volumes
+            if self._queue.qsize() or self._archiving:
+                logger.info('waiting for the last volume(s) to be archived')
+            for _ in archivers:
+                await self._queue.put(None)
+            await asyncio.gather(*archivers)
+        finally:
+            for task in archivers:
+                task.cancel()
+            # volumes left open by a failed run
+            for streaming in self._streaming.values():
+                streaming.abort()
+            self._streaming.clear()
+        if errors:
+            raise errors[0]
+
+    async def _download_chapter(self,
+                                manga: Manga,
+                                record: ChapterRecord,
+                                fs: FileSys,
+                                saver: bool,
+                                archive: bool,
+                                progress: _MangaProgress,
+                                direct: Optional[str] = None) -> Awaitable:
+        if direct is None:
+            await manga.download_chapter(self.client, record, fs, saver, progress)
+        else:
+            await self._download_direct(manga, record, fs, saver, progress, direct)
+        progress.chapters += 1
+        self._report(Progress('chapter', manga, progress.chapters, len(manga.s_downloads), record.number))
+        if archive:
+            # waits here if the archivers are behind
+            await self._queue.put((manga, record, fs, progress, direct))
+            if self.metrics is not None:
+                self.metrics.set('archive_queue', self._queue.qsize())
+
+    async def _download_direct(self,
+                               manga: Manga,
+                               record: ChapterRecord,
+                               fs: FileSys,
+                               saver: bool,
+                               progress: _MangaProgress,
+                               direct: str) -> Awaitable:
+        ch_num = safe_to_int(record.number)
+        if direct == 'volume' and isinstance(ch_num, (int, float)):
+            # the volume's archive is shared by its chapters, and closed by an archiver
+            key = (id(manga), manga.vol_plan[record.number])
+            if key not in self._streaming:
+                self._streaming[key] = fs.open_archive(fs.volume_name(key[1]))
+            await manga.download_chapter(self.client, record, fs, saver, progress, self._streaming[key])
+            return
+
+        # chapters without a number have no place in a volume, so get an archive each
+        streaming = fs.open_archive(fs.chapter_name(ch_num, record.title, record.id), folders=False)
+        try:
+            await manga.download_chapter(self.client, record, fs, saver, progress, streaming)
+        except BaseException:
+            streaming.abort()
+            raise
+        if not streaming.pages:
+            streaming.abort()
+            return
+        archive_paths = await self.loop.run_in_executor(self.archive_pool, self._archive, fs, [], streaming)
+        self._archived(archive_paths, progress)
+
+    async def _archiver(self, errors: List[BaseException]) -> Awaitable:
+        """
+        The archiving stage. Takes finished chapters off the queue, and
+        writes a volume in the archive pool once all its chapters are in.
+        A volume which fails is logged and left out, so the queue keeps
+        moving - the first error is raised once the run is over.
+        """
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if self.metrics is not None:
+                self.metrics.set('archive_queue', self._queue.qsize())
+            manga, record, fs, progress, direct = item
+            chapters = manga.volume_done(record)
+            if chapters is None:
+                continue
+            streaming = None
+            if direct:
+                # the pages are in the volume's archive already, which only needs closing
+                streaming = self._streaming.pop((id(manga), manga.vol_plan[record.number]), None)
+                if streaming is None:
+                    continue
+                if not streaming.pages:
+                    streaming.abort()
+                    continue
+            elif not chapters:
+                continue
+            self._archiving += 1
+            if self.metrics is not None:
+                self.metrics.add('archives_pending', 1)
+            try:
+                archive_paths = await self.loop.run_in_executor(self.archive_pool, self._archive, fs, chapters,
+                                                                streaming)
+            except Exception as e:
+                logger.error(f'could not archive a volume of {manga.title} - {e!r}')
+                errors.append(e)
+                continue
+            finally:
+                self._archiving -= 1
+                if self.metrics is not None:
+                    self.metrics.add('archives_pending', -1)
+            self._archived(archive_paths, progress)
+
+    def _archive(self, fs: FileSys, chapters: List, streaming: Optional[StreamingArchive] = None) -> List[Path]:
+        # runs in an archive worker
+        start = time.perf_counter()
+        try:
+            if streaming is not None:
+                archives = [streaming.finish()]
+            else:
+                archives = fs.archive_volume(chapters)
+        except Exception:
+            if streaming is not None:
+                streaming.abort()
+            if self.metrics is not None:
+                self.metrics.inc('archives', result='failed')
+            raise
+        if self.metrics is not None:
+            self.metrics.observe('archive', time.perf_counter() - start)
+            self.metrics.inc('archives', len(archives), result='written')
+        return archives
+
+    def _archived(self, archive_paths: List[Path], progress: _MangaProgress) -> None:
+        # chapters without a number get an archive each, so there may be more archives than volumes
+        vol_plan = progress.manga.vol_plan
+        planned = len(set(vol_plan.values())) if vol_plan is not None else len(progress.manga.s_downloads)
+        for archive_path in archive_paths:
+            progress.volumes += 1
+            self._report(Progress('volume', progress.manga, progress.volumes,
+                                  max(planned, progress.volumes), archive_path))
+
+    def _report(self, event: Progress) -> None:
+        if self.on_progress is not None:
+            self.on_progress(event)
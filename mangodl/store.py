@@ -0,0 +1,99 @@
+"""Contains the PageStore class, a content-addressed store for page images."""
+
+import os
+import re
+import shutil
+import uuid
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set)
+from pathlib import Path
+
+from .helpers import safe_mkdir
+
+import logging
+logger = logging.getLogger(__name__)
+
+# image servers name pages after a sha256 of their contents
+_DIGEST_IN_NAME = re.compile(r'[0-9a-f]{64}')
+
+
+class PageStore:
+    """
+    Keeps one copy of each distinct page image, named after the sha256 of
+    its bytes. Chapter folders hold hardlinks to these blobs, so the same
+    image saved by different uploads, titles or runs takes up space once.
+
+    Blobs are only ever stored under their real digest, so a page whose
+    name on the image server contains the digest of a stored blob can be
+    linked without downloading it again.
+
+    Parameters
+    ----------
+    path : Path
+        Folder for the store. Must be on the same filesystem as the chapter
+        folders for hardlinks to work - otherwise pages are copied.
+
+    Attributes
+    ----------
+    tmp_path : Path
+        Where pages are written while downloading.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.tmp_path = path / 'tmp'
+
+    def setup_folders(self) -> None:
+        safe_mkdir(self.path)
+        safe_mkdir(self.tmp_path)
+
+    def blob_path(self, digest: str) -> Path:
+        return self.path / digest[:2] / digest
+
+    def new_temp_path(self) -> Path:
+        """Returns a unique path inside `tmp_path` to download a page into."""
+        return self.tmp_path / f'{uuid.uuid4().hex}.part'
+
+    def find(self, page: str) -> Optional[str]:
+        """
+        Returns the digest if the name of a page on the image server
+        contains the digest of a blob we already have, otherwise None.
+        """
+        m = _DIGEST_IN_NAME.search(page)
+        if m and self.blob_path(m.group()).exists():
+            return m.group()
+        return None
+
+    def commit(self, tmp_path: Path, digest: str, page_path: Path) -> bool:
+        """
+        Moves a finished download into the store and links it to `page_path`.
+        Returns True if an identical blob was already stored.
+        """
+        blob_path = self.blob_path(digest)
+        if blob_path.exists():
+            os.remove(tmp_path)
+            dup = True
+        else:
+            safe_mkdir(blob_path.parent)
+            os.replace(tmp_path, blob_path)
+            dup = False
+        self.link(digest, page_path)
+        return dup
+
+    def link(self, digest: str, page_path: Path) -> None:
+        """Makes `page_path` a hardlink to a blob, replacing whatever was there."""
+        blob_path = self.blob_path(digest)
+        tmp_link = page_path.with_name(page_path.name + '.link')
+        try:
+            os.link(blob_path, tmp_link)
+        except OSError as e:
+            # no hardlinks across filesystems, or on some filesystems at all
+            logger.debug(f'could not link {blob_path} - copying instead ({repr(e)})')
+            shutil.copyfile(blob_path, tmp_link)
+        os.replace(tmp_link, page_path)
@@ -0,0 +1,311 @@
+"""
+Works out which volume each chapter belongs to, when mangadex doesn't say.
+
+Strategies get the first say: a mapping file from the user, the volumes
+saved by an earlier run, or upload dates. Whatever they leave is placed
+by the chapters which come with a volume, which mark out where each
+volume starts and ends. Chapters without one (orphans) are placed by a
+binary search over those boundaries, so a manga with thousands of
+chapters takes one pass of O(n log n). Orphans past either end are
+grouped into new volumes of the average length, and if no chapter has a
+volume at all, volumes of a fixed length are made from scratch.
+"""
+
+import csv
+import json
+import os
+from abc import ABC, abstractmethod
+from bisect import bisect_right
+from collections import defaultdict
+from pathlib import Path
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Set,
+                    Sequence,
+                    NamedTuple)
+
+from .helpers import chunk, safe_to_int
+
+import logging
+logger = logging.getLogger(__name__)
+
+Number = Union[int, float]
+
+# what --volstrategy can be set to
+STRATEGIES = ('chapters', 'timestamps')
+
+
+class Bounds(NamedTuple):
+    """First and last chapter numbers of a volume."""
+    volume: Number
+    first: Number
+    last: Number
+
+
+def is_number(x) -> bool:
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def volume_bounds(chapters: Sequence) -> List[Bounds]:
+    """
+    Returns the bounds of every volume with a numeric volume number which
+    has at least one numbered chapter, in order of their first chapter.
+    """
+    first: Dict[Number, Number] = {}
+    last: Dict[Number, Number] = {}
+    for ch in chapters:
+        if is_number(ch.ch_num) and is_number(ch.vol_num):
+            vol = ch.vol_num
+            if vol not in first or ch.ch_num < first[vol]:
+                first[vol] = ch.ch_num
+            if vol not in last or ch.ch_num > last[vol]:
+                last[vol] = ch.ch_num
+    return sorted((Bounds(vol, first[vol], last[vol]) for vol in first), key=lambda b: (b.first, b.volume))
+
+
+def fit_between(orphans: Sequence, bounds: List[Bounds]) -> Tuple[List, List]:
+    """
+    Places each orphan in the volume which starts at or before it, as long
+    as it isn't past the ends of the manga: at most one chapter before the
+    first volume, and half a chapter after the last. Chapters in a gap
+    between two volumes go to the earlier one.
+
+    Parameters
+    ----------
+    orphans : list
+        Chapters with a numeric `ch_num` and no volume. Their `vol_num`
+        is set if they fit.
+    bounds : list
+        Bounds of the known volumes, as returned by `volume_bounds`.
+
+    Returns
+    -------
+    tuple
+        The orphans below the first volume and above the last, each
+        sorted by chapter number.
+    """
+    firsts = [b.first for b in bounds]
+    lowest, highest = bounds[0].first - 1, bounds[-1].last + 0.5
+    below, above = [], []
+    for orphan in orphans:
+        x = orphan.ch_num
+        if x < lowest:
+            below.append(orphan)
+        elif x > highest:
+            above.append(orphan)
+        else:
+            # the first volume also takes the chapter just before it
+            orphan.vol_num = bounds[max(bisect_right(firsts, x) - 1, 0)].volume
+            logger.debug(f'chapter {x} -> volume {orphan.vol_num}')
+    below.sort(key=lambda ch: ch.ch_num)
+    above.sort(key=lambda ch: ch.ch_num)
+    return below, above
+
+
+def extrapolate(below: List, above: List, bounds: List[Bounds], avg_len: int) -> None:
+    """
+    Makes new volumes of `avg_len` chapters for the orphans past either
+    end, numbered on from the lowest and highest volume numbers.
+    """
+    if below:
+        # count down from the first volume, so the chapters nearest to it stay with it
+        vol_num = min(b.volume for b in bounds)
+        for new_vol in chunk(below[::-1], avg_len):
+            vol_num -= 1
+            logger.debug(f'creating volume {vol_num}')
+            for ch in new_vol:
+                ch.vol_num = vol_num
+    if above:
+        vol_num = max(b.volume for b in bounds)
+        for new_vol in chunk(above, avg_len):
+            vol_num += 1
+            logger.debug(f'creating volume {vol_num}')
+            for ch in new_vol:
+                ch.vol_num = vol_num
+
+
+def from_scratch(orphans: List, vol_len: int) -> None:
+    """Makes volumes of `vol_len` chapters, in order of chapter number, starting from volume 1."""
+    logger.warning(f'no volume info found - defaulting to {vol_len} chapters per volume')
+    orphans = sorted(orphans, key=lambda ch: ch.ch_num)
+    for vol_num, new_vol in enumerate(chunk(orphans, vol_len), 1):
+        logger.info(f'creating new volume - vol. {vol_num}')
+        for ch in new_vol:
+            ch.vol_num = vol_num
+
+
+class VolumeStrategy(ABC):
+    """
+    A way of placing chapters in volumes. Subclasses set `vol_num` on
+    the chapters they can place and leave the rest alone.
+    """
+
+    @abstractmethod
+    def assign(self, chapters: Sequence) -> None:
+        ...
+
+
+class KnownVolumes(VolumeStrategy):
+    """
+    Takes volumes from a map of chapter number to volume number.
+
+    Parameters
+    ----------
+    volumes : dict
+        Maps chapter numbers (as str) to volume numbers.
+    override : bool, default False
+        Replace the volumes mangadex gives as well. Otherwise only
+        chapters without a volume are placed - so a map saved by an
+        earlier run keeps the volumes it guessed, but gives way once
+        mangadex knows better.
+    """
+
+    def __init__(self, volumes: Dict[str, Union[Number, str]], override: bool = False):
+        self.volumes = {str(safe_to_int(ch_num)): safe_to_int(vol_num) for ch_num, vol_num in volumes.items()}
+        self.override = override
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path], override: bool = False) -> 'KnownVolumes':
+        """
+        Reads a map from a .json file holding an object of chapter
+        number to volume number, or a .csv file with a chapter number and
+        a volume number on each line.
+        """
+        return cls(read_volume_map(Path(path)), override)
+
+    def assign(self, chapters: Sequence) -> None:
+        placed = 0
+        for ch in chapters:
+            vol_num = self.volumes.get(str(ch.ch_num))
+            if vol_num is not None and (self.override or ch.vol_num == ''):
+                ch.vol_num = vol_num
+                placed += 1
+        logger.debug(f'{placed} chapter(s) placed from a volume map')
+
+
+class ByTimestamp(VolumeStrategy):
+    """
+    Places chapters past the last known volume by when they were
+    uploaded, going by how often a new volume came out so far. Suits
+    ongoing series, where a volume collects a few months of chapters
+    however many there are.
+
+    Chapters inside the known volumes are left alone, since old chapters
+    are often uploaded long after they came out.
+
+    Parameters
+    ----------
+    timestamps : dict
+        Maps chapter ids (as str) to upload times.
+    """
+
+    def __init__(self, timestamps: Dict[str, int]):
+        self.timestamps = timestamps
+
+    def assign(self, chapters: Sequence) -> None:
+        starts: Dict[Number, int] = {}  # volume -> first upload
+        last_ch = None
+        for ch in chapters:
+            if is_number(ch.ch_num) and is_number(ch.vol_num):
+                last_ch = ch.ch_num if last_ch is None else max(last_ch, ch.ch_num)
+                ts = self.timestamps.get(str(ch.id))
+                if ts:
+                    starts[ch.vol_num] = min(starts.get(ch.vol_num, ts), ts)
+        if len(starts) < 2:
+            logger.info('not enough volumes to tell how often they come out')
+            return
+        vols = sorted(starts)
+        periods = sorted((starts[b] - starts[a]) / (b - a) for a, b in zip(vols, vols[1:]))
+        period = periods[len(periods) // 2]
+        if period <= 0:
+            logger.info('volumes were all uploaded at once - can\'t tell how often they come out')
+            return
+
+        last_vol = vols[-1]
+        tail = sorted((ch for ch in chapters if ch.vol_num == '' and is_number(ch.ch_num)
+                       and ch.ch_num > last_ch and self.timestamps.get(str(ch.id))),
+                      key=lambda ch: ch.ch_num)
+        latest = starts[last_vol]
+        for ch in tail:
+            # a late upload of an earlier chapter mustn't send it back a volume
+            latest = max(latest, self.timestamps[str(ch.id)])
+            ch.vol_num = last_vol + int((latest - starts[last_vol]) // period)
+            logger.debug(f'chapter {ch.ch_num} -> volume {ch.vol_num} by upload date')
+
+
+def read_volume_map(path: Path) -> Dict[str, Union[Number, str]]:
+    """Reads a map of chapter number to volume number from a .json or .csv file."""
+    with open(path, newline='') as f:
+        if path.suffix.lower() == '.csv':
+            return {row[0].strip(): row[1].strip() for row in csv.reader(f) if len(row) >= 2 and row[0].strip()}
+        return json.load(f)
+
+
+def save_volume_map(path: Path, chapters: Sequence) -> None:
+    """
+    Adds the volume of every numbered chapter in `chapters` to the map
+    saved at `path`, keeping the chapters already there.
+    """
+    volumes = read_volume_map(path) if path.exists() else {}
+    for ch in chapters:
+        if is_number(ch.ch_num) and ch.vol_num != '':
+            volumes[str(ch.ch_num)] = ch.vol_num
+    tmp_path = path.with_name(path.name + '.part')
+    with open(tmp_path, 'w') as f:
+        json.dump(volumes, f, indent=1)
+    os.replace(tmp_path, path)
+    logger.debug(f'saved volumes of {len(volumes)} chapter(s) -> {path}')
+
+
+def assign_volumes(chapters: Sequence, vol_len: int, strategies: Sequence[VolumeStrategy] = ()) -> None:
+    """
+    Gives every numbered chapter in `chapters` a volume number. Each of
+    `strategies` places what it can first, in order, and those chapters
+    count as known volumes afterwards. Otherwise chapters which already
+    have a volume keep it. The result doesn't depend on the order of
+    `chapters`.
+
+    Parameters
+    ----------
+    chapters : list
+        Objects with `id`, `ch_num` and `vol_num` attributes, such as
+        Chapter instances. `vol_num` is '' for chapters with no volume,
+        and is set in place.
+    vol_len : int
+        Chapters per volume, if no chapter has a volume number.
+    strategies : list, optional
+        VolumeStrategy instances.
+    """
+    for strategy in strategies:
+        strategy.assign(chapters)
+
+    orphans = []
+    for ch in chapters:
+        if not is_number(ch.ch_num):
+            # bad news! a chapter without a chapter number
+            logger.warning(f'chapter id {ch.id} has no chapter number')
+        elif ch.vol_num == '':
+            orphans.append(ch)
+    if not orphans:
+        logger.info('all chapters come naturally with volume info')
+        return
+    logger.info(f'{len(orphans)} chapter(s) have no volume number')
+
+    bounds = volume_bounds(chapters)
+    if not bounds:
+        from_scratch(orphans, vol_len)
+        return
+
+    below, above = fit_between(orphans, bounds)
+    if below or above:
+        # volumes now hold the orphans fitted between them too
+        sizes: Dict[Number, int] = defaultdict(int)
+        for ch in chapters:
+            if is_number(ch.ch_num) and is_number(ch.vol_num):
+                sizes[ch.vol_num] += 1
+        extrapolate(below, above, bounds, max(round(sum(sizes.values()) / len(sizes)), 1))
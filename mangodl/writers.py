@@ -0,0 +1,594 @@
+"""
+Writers for each output format volumes can be saved in.
+
+Every writer takes pages one at a time, in reading order, and streams
+them into its output as they come - nothing is staged in a folder, and
+no page is read into memory whole unless the format needs it. Output is
+written under a temporary name and only given its real name by `close`,
+so a half-written volume never looks complete.
+
+>>> with open_writer('epub', vols_path / 'Vol. 1', level=6) as writer:
+...     writer.add('1/1.jpg', page_path)
+"""
+
+import os
+import shutil
+import tarfile
+import time
+import uuid
+import zipfile
+import zlib
+from abc import ABC, abstractmethod
+from io import BytesIO
+from pathlib import Path, PurePosixPath
+from typing import (Optional,
+                    Union,
+                    Dict,
+                    List,
+                    Tuple,
+                    Iterator,
+                    Awaitable,
+                    Iterable,
+                    Set,
+                    IO,
+                    NamedTuple)
+from xml.sax.saxutils import escape
+
+import logging
+logger = logging.getLogger(__name__)
+
+# a page is either a saved file or the bytes of one
+Page = Union[Path, bytes]
+
+# bytes copied at a time from a page file
+CHUNK_SIZE = 64 * 1024
+
+MEDIA_TYPES = {'.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png',
+               '.gif': 'image/gif', '.webp': 'image/webp'}
+
+
+class ImageInfo(NamedTuple):
+    """What the PDF and EPUB writers need to know about a page image."""
+    kind: str  # 'jpeg' or 'png'
+    width: int
+    height: int
+    components: int  # colour channels, counting alpha
+    bits: int = 8
+    color_type: int = 0  # png only
+    interlaced: bool = False  # png only
+
+
+def image_info(page: Page) -> Optional[ImageInfo]:
+    """
+    Reads the size and colours of a JPEG or PNG page, a file or its
+    bytes. Only the headers are read, however far into the file the
+    JPEG frame header comes. Returns None for other images, or broken ones.
+    """
+    with open_page(page) as f:
+        head = f.read(29)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR' and len(head) == 29:
+            width, height = int.from_bytes(head[16:20], 'big'), int.from_bytes(head[20:24], 'big')
+            bits, color_type, interlace = head[24], head[25], head[28]
+            components = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type, 0)
+            return ImageInfo('png', width, height, components, bits, color_type, interlace == 1)
+        if head.startswith(b'\xff\xd8'):
+            f.seek(2)
+            return jpeg_info(f)
+    return None
+
+
+def jpeg_info(f: IO[bytes]) -> Optional[ImageInfo]:
+    # skips from segment to segment up to the frame header - exif data and
+    # colour profiles before it can take up hundreds of kilobytes
+    while True:
+        if f.read(1) != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':
+            # fill bytes
+            marker = f.read(1)
+        if not marker or marker in (b'\xd9', b'\xda'):
+            # end of image, or start of the image data - no frame header
+            return None
+        if marker in (b'\xd8', b'\x01') or b'\xd0' <= marker <= b'\xd7':
+            # markers without a length
+            continue
+        length = int.from_bytes(f.read(2), 'big')
+        if b'\xc0' <= marker <= b'\xcf' and marker not in (b'\xc4', b'\xc8', b'\xcc'):
+            # start of frame
+            frame = f.read(6)
+            if len(frame) < 6:
+                return None
+            bits, height, width = frame[0], int.from_bytes(frame[1:3], 'big'), int.from_bytes(frame[3:5], 'big')
+            return ImageInfo('jpeg', width, height, frame[5], bits)
+        if length < 2:
+            return None
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def open_page(page: Page) -> IO[bytes]:
+    """Opens a page for reading, whether it is a file or its bytes."""
+    return BytesIO(page) if isinstance(page, bytes) else open(page, 'rb')
+
+
+def read_chunks(page: Page) -> Iterator[bytes]:
+    """Yields the bytes of a page, a chunk at a time if it is a file."""
+    if isinstance(page, bytes):
+        yield page
+        return
+    with open(page, 'rb') as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+
+def zip_options(level: int) -> Dict:
+    """ZipFile arguments for a compression level - 0 stores pages as they are."""
+    if level <= 0:
+        return {'compression': zipfile.ZIP_STORED}
+    return {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': min(level, 9)}
+
+
+class Writer(ABC):
+    """
+    Base class of the writers. Use as a context manager, or call `close`
+    once every page is added - or `abort` to throw the output away.
+
+    Parameters
+    ----------
+    path : Path
+        Where the output goes, without the suffix of the format.
+    level : int, default 0
+        Compression level from 0 (none) to 9. Page images are already
+        compressed, so levels above 0 mostly cost time - they are for
+        consumers which want smaller files whatever it takes.
+
+    Attributes
+    ----------
+    suffix : str
+        Added to `path` for the name of the output.
+    pages : int
+        Number of pages added so far.
+    """
+    suffix = ''
+
+    def __init__(self, path: Path, level: int = 0):
+        self.path = path.with_name(path.name + self.suffix)
+        self.tmp_path = self.path.with_name(self.path.name + '.part')
+        self.level = level
+        self.pages = 0
+
+    def __enter__(self) -> 'Writer':
+        return self
+
+    def __exit__(self, exc_type, *exc) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @abstractmethod
+    def add(self, arcname: str, page: Page) -> None:
+        """
+        Adds the next page. `arcname` is its name inside the output, like
+        '12/3.png' for page 3 of chapter 12 - or just '3.png'.
+        """
+
+    def close(self) -> Path:
+        """Finishes the output, gives it its real name and returns its path."""
+        self._finish()
+        os.replace(self.tmp_path, self.path)
+        logger.info(f'created {self.path} <- {self.pages} pages')
+        logger.info(f'>>>>>>( ^_^）o自  {self.path.stem} compiled  自o（^_^ )<<<<<<')
+        return self.path
+
+    def abort(self) -> None:
+        """Throws away unfinished output."""
+        try:
+            self._finish()
+        except Exception:
+            pass
+        if self.tmp_path.is_dir():
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    @abstractmethod
+    def _finish(self) -> None:
+        # writes whatever is left and closes files
+        ...
+
+
+class CbzWriter(Writer):
+    """A zip of the pages, which comic readers know as .cbz."""
+    suffix = '.cbz'
+
+    def __init__(self, path: Path, level: int = 0):
+        super().__init__(path, level)
+        self._zf = zipfile.ZipFile(self.tmp_path, 'w', **zip_options(level))
+
+    def add(self, arcname: str, page: Page) -> None:
+        if isinstance(page, bytes):
+            self._zf.writestr(arcname, page)
+        else:
+            self._zf.write(page, arcname)
+        self.pages += 1
+
+    def _finish(self) -> None:
+        self._zf.close()
+
+
+class CbtWriter(Writer):
+    """
+    A tar of the pages (.cbt). Uncompressed at level 0, which makes the
+    fastest archive to write and move about in bulk - otherwise gzipped.
+    """
+    suffix = '.cbt'
+
+    def __init__(self, path: Path, level: int = 0):
+        super().__init__(path, level)
+        # pages are hardlinks into the store - store each in full, not as a link to the last
+        if level <= 0:
+            self._tf = tarfile.open(self.tmp_path, 'w', dereference=True)
+        else:
+            self._tf = tarfile.open(self.tmp_path, 'w:gz', compresslevel=min(level, 9), dereference=True)
+
+    def add(self, arcname: str, page: Page) -> None:
+        if isinstance(page, bytes):
+            info = tarfile.TarInfo(arcname)
+            info.size = len(page)
+            info.mtime = int(time.time())
+            self._tf.addfile(info, BytesIO(page))
+        else:
+            self._tf.add(str(page), arcname)
+        self.pages += 1
+
+    def _finish(self) -> None:
+        self._tf.close()
+
+
+class FolderWriter(Writer):
+    """
+    A plain folder of the pages. Page files are hardlinked where they
+    can be, since pages in the store never change, and copied otherwise.
+    `level` is ignored.
+    """
+
+    def __init__(self, path: Path, level: int = 0):
+        super().__init__(path, level)
+        if self.tmp_path.exists():
+            shutil.rmtree(self.tmp_path)
+        os.mkdir(self.tmp_path)
+
+    def add(self, arcname: str, page: Page) -> None:
+        dest = self.tmp_path / arcname
+        if not dest.parent.exists():
+            os.makedirs(dest.parent)
+        if isinstance(page, bytes):
+            dest.write_bytes(page)
+        else:
+            try:
+                os.link(page, dest)
+            except OSError:
+                shutil.copyfile(page, dest)
+        self.pages += 1
+
+    def close(self) -> Path:
+        # a folder can't be replaced in one go like a file
+        if self.path.is_dir():
+            shutil.rmtree(self.path)
+        return super().close()
+
+    def _finish(self) -> None:
+        pass
+
+
+class EpubWriter(Writer):
+    """
+    An EPUB 3 book with one fixed-layout page per image, for e-readers
+    which don't open comic archives. Each chapter folder gets an entry in
+    the table of contents. Images are stored as they are at level 0.
+    """
+    suffix = '.epub'
+
+    def __init__(self, path: Path, level: int = 0):
+        super().__init__(path, level)
+        self._zf = zipfile.ZipFile(self.tmp_path, 'w', **zip_options(level))
+        # the mimetype must come first and uncompressed, for readers to recognise the book
+        self._zf.writestr(zipfile.ZipInfo('mimetype'), 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        self._zf.writestr('META-INF/container.xml', CONTAINER_XML)
+        self._items: List[Tuple[str, str, str]] = []  # (page id, image name, media type)
+        self._toc: List[Tuple[str, str]] = []  # (chapter, page id of its first page)
+
+    def add(self, arcname: str, page: Page) -> None:
+        name = PurePosixPath(arcname)
+        info = image_info(page)
+        width, height = (info.width, info.height) if info else (800, 1200)
+        media_type = MEDIA_TYPES.get(name.suffix.lower(), 'image/jpeg')
+
+        page_id = f'p{self.pages + 1:05d}'
+        image_name = f'images/{page_id}{name.suffix.lower()}'
+        if isinstance(page, bytes):
+            self._zf.writestr(f'OEBPS/{image_name}', page)
+        else:
+            self._zf.write(page, f'OEBPS/{image_name}')
+        self._zf.writestr(f'OEBPS/{page_id}.xhtml', PAGE_XHTML.format(width=width,
+                                                                     height=height,
+                                                                     title=escape(arcname),
+                                                                     image=image_name))
+        chapter = str(name.parent) if str(name.parent) != '.' else ''
+        if not self._toc or self._toc[-1][0] != chapter:
+            self._toc.append((chapter, page_id))
+        self._items.append((page_id, image_name, media_type))
+        self.pages += 1
+
+    def _finish(self) -> None:
+        if self._zf.fp is None:
+            return
+        title = escape(self.path.stem)
+        manifest = ''.join(f'<item id="{page_id}" href="{page_id}.xhtml" media-type="application/xhtml+xml"/>\n'
+                           f'<item id="{page_id}-img" href="{image}" media-type="{media_type}"/>\n'
+                           for page_id, image, media_type in self._items)
+        spine = ''.join(f'<itemref idref="{page_id}"/>\n' for page_id, _, _ in self._items)
+        toc = ''.join(f'<li><a href="{page_id}.xhtml">{escape(f"Chapter {chapter}" if chapter else title)}</a></li>\n'
+                      for chapter, page_id in self._toc)
+        self._zf.writestr('OEBPS/nav.xhtml', NAV_XHTML.format(title=title, toc=toc))
+        self._zf.writestr('OEBPS/content.opf', CONTENT_OPF.format(
+            title=title,
+            id=uuid.uuid5(uuid.NAMESPACE_URL, self.path.name),
+            modified=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            manifest=manifest,
+            spine=spine))
+        self._zf.close()
+
+
+class PdfWriter(Writer):
+    """
+    A PDF with one page per image, each page the size of its image.
+
+    JPEGs and PNGs are embedded as they are, without decoding them, so
+    writing is about as fast as copying. Transparent PNGs are the
+    exception: their alpha channel has to go in as a separate mask, so
+    they are decompressed and split in two, then compressed again at
+    `level` (or the fastest level at 0). Otherwise `level` compresses
+    only the small page descriptions, since the images are compressed
+    already.
+
+    Other images, and interlaced PNGs, can't be embedded without an
+    imaging library - adding one raises ValueError.
+    """
+    suffix = '.pdf'
+
+    def __init__(self, path: Path, level: int = 0):
+        super().__init__(path, level)
+        self._f = open(self.tmp_path, 'wb')
+        self._offsets: Dict[int, int] = {}
+        self._kids: List[int] = []
+        self._next_id = 3  # 1 is the catalog and 2 the page tree, both written last
+        # 1.5 for 16 bit images
+        self._f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+
+    def _new_id(self) -> int:
+        self._next_id += 1
+        return self._next_id - 1
+
+    def _begin(self, obj_id: int) -> None:
+        self._offsets[obj_id] = self._f.tell()
+        self._f.write(f'{obj_id} 0 obj\n'.encode())
+
+    def _object(self, obj_id: int, body: str) -> None:
+        self._begin(obj_id)
+        self._f.write(f'{body}\nendobj\n'.encode())
+
+    def _stream(self, head: str, chunks: Iterable[bytes]) -> int:
+        # the length goes in an object of its own after the stream, so the data needn't be held to measure it
+        obj_id, length_id = self._new_id(), self._new_id()
+        self._begin(obj_id)
+        self._f.write(f'<< {head} /Length {length_id} 0 R >>\nstream\n'.encode())
+        start = self._f.tell()
+        for data in chunks:
+            self._f.write(data)
+        length = self._f.tell() - start
+        self._f.write(b'\nendstream\nendobj\n')
+        self._object(length_id, str(length))
+        return obj_id
+
+    def add(self, arcname: str, page: Page) -> None:
+        info = image_info(page)
+        if info is None:
+            raise ValueError(f'page {arcname} is not a jpeg or png - it can\'t be put in a pdf without converting it')
+        if info.kind == 'png' and info.interlaced:
+            raise ValueError(f'page {arcname} is an interlaced png - it can\'t be put in a pdf without converting it')
+
+        size = f'/Width {info.width} /Height {info.height}'
+        if info.kind == 'jpeg':
+            colors = {1: '/DeviceGray', 4: '/DeviceCMYK'}.get(info.components, '/DeviceRGB')
+            head = f'/Filter /DCTDecode /ColorSpace {colors} /BitsPerComponent {info.bits}'
+            if info.components == 4:
+                # cmyk jpegs are nearly all written inverted, the way photoshop does
+                head += ' /Decode [1 0 1 0 1 0 1 0]'
+            image_id = self._stream(f'/Type /XObject /Subtype /Image {size} {head}', read_chunks(page))
+        elif info.color_type in (4, 6):
+            level = min(self.level, 9) or 1
+            mask_id = self._stream(f'/Type /XObject /Subtype /Image {size} {png_head(info, 1, "/DeviceGray")}',
+                                   png_planes(page, info, True, level))
+            colors = '/DeviceGray' if info.color_type == 4 else '/DeviceRGB'
+            head = png_head(info, info.components - 1, colors)
+            image_id = self._stream(f'/Type /XObject /Subtype /Image {size} {head} /SMask {mask_id} 0 R',
+                                    png_planes(page, info, False, level))
+        else:
+            if info.color_type == 3:
+                palette = png_palette(page)
+                colors = f'[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]'
+            else:
+                colors = '/DeviceGray' if info.components == 1 else '/DeviceRGB'
+            head = png_head(info, info.components, colors)
+            image_id = self._stream(f'/Type /XObject /Subtype /Image {size} {head}', png_data(page))
+
+        # draw the image over the whole page
+        content = f'q {info.width} 0 0 {info.height} 0 0 cm /Im0 Do Q'.encode()
+        content_id, page_id = self._new_id(), self._new_id()
+        if self.level > 0:
+            content = zlib.compress(content, min(self.level, 9))
+            self._begin(content_id)
+            self._f.write(f'<< /Length {len(content)} /Filter /FlateDecode >>\nstream\n'.encode())
+        else:
+            self._begin(content_id)
+            self._f.write(f'<< /Length {len(content)} >>\nstream\n'.encode())
+        self._f.write(content + b'\nendstream\nendobj\n')
+        self._object(page_id, f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {info.width} {info.height}] '
+                              f'/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>')
+        self._kids.append(page_id)
+        self.pages += 1
+
+    def _finish(self) -> None:
+        if self._f.closed:
+            return
+        kids = ' '.join(f'{kid} 0 R' for kid in self._kids)
+        self._object(2, f'<< /Type /Pages /Kids [{kids}] /Count {len(self._kids)} >>')
+        self._object(1, '<< /Type /Catalog /Pages 2 0 R >>')
+        xref = self._f.tell()
+        self._f.write(f'xref\n0 {self._next_id}\n0000000000 65535 f \n'.encode())
+        for obj_id in range(1, self._next_id):
+            self._f.write(f'{self._offsets[obj_id]:010d} 00000 n \n'.encode())
+        self._f.write(f'trailer\n<< /Size {self._next_id} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n'.encode())
+        self._f.close()
+
+
+def png_head(info: ImageInfo, colors: int, color_space: str) -> str:
+    """
+    The pdf image entries for png data with `colors` channels. PNG rows
+    are filtered like pdf's png predictors, so the compressed data can go
+    in unchanged.
+    """
+    params = f'/DecodeParms << /Predictor 15 /Colors {colors} /BitsPerComponent {info.bits} /Columns {info.width} >>'
+    return f'/Filter /FlateDecode {params} /ColorSpace {color_space} /BitsPerComponent {info.bits}'
+
+
+def png_chunks(page: Page) -> Iterator[Tuple[bytes, bytes]]:
+    """Yields the (type, data) chunks of a png, one at a time."""
+    f = BytesIO(page) if isinstance(page, bytes) else open(page, 'rb')
+    try:
+        f.read(8)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            length, kind = int.from_bytes(header[:4], 'big'), header[4:]
+            data = f.read(length)
+            f.read(4)  # crc
+            yield kind, data
+            if kind == b'IEND':
+                return
+    finally:
+        f.close()
+
+
+def png_data(page: Page) -> Iterator[bytes]:
+    """Yields the compressed image data of a png."""
+    for kind, data in png_chunks(page):
+        if kind == b'IDAT':
+            yield data
+
+
+def png_palette(page: Page) -> bytes:
+    for kind, data in png_chunks(page):
+        if kind == b'PLTE':
+            return data
+    return b''
+
+
+def png_planes(page: Page, info: ImageInfo, alpha: bool, level: int) -> Iterator[bytes]:
+    """
+    Yields the colour channels of a png with an alpha channel - or with
+    `alpha`, just the alpha channel - compressed again at `level`.
+
+    The rows keep their filters: png filters each channel against the
+    same channel of the pixels around it, so the filtered bytes of a
+    channel are still valid on their own.
+    """
+    size = info.bits // 8  # bytes per channel
+    pixel = info.components * size
+    keep = range(pixel - size, pixel) if alpha else range(pixel - size)
+    row_len, out_len = 1 + info.width * pixel, 1 + info.width * len(keep)
+    decompressor, compressor = zlib.decompressobj(), zlib.compressobj(level)
+    rows = bytearray()
+    for data in png_data(page):
+        rows += decompressor.decompress(data)
+        count = len(rows) // row_len
+        out = bytearray(count * out_len)
+        for r in range(count):
+            row, o = r * row_len, r * out_len
+            out[o] = rows[row]  # the filter type
+            for i, k in enumerate(keep):
+                out[o + 1 + i:o + out_len:len(keep)] = rows[row + 1 + k:row + row_len:pixel]
+        del rows[:count * row_len]
+        yield compressor.compress(out)
+    yield compressor.flush()
+
+
+WRITERS = {'cbz': CbzWriter,
+           'cbt': CbtWriter,
+           'epub': EpubWriter,
+           'pdf': PdfWriter,
+           'folder': FolderWriter}
+
+# what --format can be set to
+FORMATS = tuple(WRITERS)
+
+
+def open_writer(out_format: str, path: Path, level: int = 0) -> Writer:
+    """
+    Starts writing `path` (without a suffix) in `out_format`, one of
+    `FORMATS`.
+    """
+    try:
+        return WRITERS[out_format](path, level)
+    except KeyError:
+        raise ValueError(f'unknown format {out_format!r} - use one of {", ".join(FORMATS)}') from None
+
+
+CONTAINER_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles>
+<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+</rootfiles>
+</container>
+"""
+
+CONTENT_OPF = """<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id" prefix="rendition: http://www.idpf.org/vocab/rendition/#">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+<dc:identifier id="id">urn:uuid:{id}</dc:identifier>
+<dc:title>{title}</dc:title>
+<dc:language>en</dc:language>
+<meta property="dcterms:modified">{modified}</meta>
+<meta property="rendition:layout">pre-paginated</meta>
+<meta property="rendition:spread">none</meta>
+</metadata>
+<manifest>
+<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+{manifest}</manifest>
+<spine>
+{spine}</spine>
+</package>
+"""
+
+NAV_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head><title>{title}</title></head>
+<body>
+<nav epub:type="toc"><ol>
+{toc}</ol></nav>
+</body>
+</html>
+"""
+
+PAGE_XHTML = """<?xml version="1.0" encoding="UTF-8"?>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{title}</title><meta name="viewport" content="width={width}, height={height}"/></head>
+<body style="margin:0"><img src="{image}" alt="" style="width:100%;height:100%"/></body>
+</html>
+"""
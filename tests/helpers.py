@@ -0,0 +1,6 @@
+"""Builders shared by the tests."""
+
+
+def raw_ch(id, chapter, volume='', language='gb'):
+    """A chapter as the mangadex API lists it for a manga."""
+    return {'id': id, 'chapter': chapter, 'volume': volume, 'title': '', 'language': language}
@@ -0,0 +1,41 @@
+import subprocess
+import sys
+import pytest
+from mangodl.api import DownloadOptions
+from mangodl.manga import Manga
+from tests.helpers import raw_ch
+
+
+@pytest.fixture
+def manga():
+    # api lists chapters from last to first
+    return Manga(1, {'title': 'T'}, [raw_ch(id, str(id)) for id in range(10, 0, -1)] + [raw_ch(11, '')])
+
+
+def test_import_has_no_side_effects():
+    # arguments the app doesn't know would stop it at once if it parsed them
+    proc = subprocess.run([sys.executable, '-c', 'import mangodl, mangodl.mangodl', '--not-an-option'],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert proc.returncode == 0
+    assert proc.stdout == ''
+
+
+def test_stage_chapters_by_range(manga):
+    assert manga.stage_chapters('gb', ranges='2-4, 9')
+    assert [record.number for record in manga.s_downloads] == ['2', '3', '4', '9']
+    # nothing in range - nothing to download
+    assert not manga.stage_chapters('gb', ranges='20-30')
+
+
+def test_stage_chapters_without_prompt(manga):
+    assert manga.stage_chapters('gb', no_prompt=True)
+    assert len(manga.s_downloads) == 11
+    assert not manga.stage_chapters('fr', no_prompt=True)
+
+
+@pytest.mark.parametrize('field', ['vol_len', 'rate_limit', 'metadata_limit', 'image_limit', 'archive_workers'])
+def test_download_options_must_be_positive(field):
+    DownloadOptions(folder='.').check()
+    for value in (0, -1, 2.5):
+        with pytest.raises(ValueError, match=field):
+            DownloadOptions(folder='.', **{field: value}).check()
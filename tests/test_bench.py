@@ -0,0 +1,78 @@
+import asyncio
+import sys
+from pathlib import Path
+from aiohttp.test_utils import TestClient, TestServer
+
+# the benchmarks aren't a package - bench.py finds the mock next to it
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'benchmarks'))
+
+from bench import compare  # noqa: E402
+from mock_mangadex import MockMangaDex, Settings  # noqa: E402
+
+
+def result(pages_per_s=100, bytes_per_s=1e6, archive_s=1.0, peak_rss_mb=50):
+    return {'pages_per_s': pages_per_s, 'bytes_per_s': bytes_per_s,
+            'archive_s': archive_s, 'peak_rss_mb': peak_rss_mb}
+
+
+def test_compare_flags_what_got_worse():
+    baseline = {'base': result(), 'latency': result()}
+    # faster and leaner is fine
+    assert compare({'base': result(pages_per_s=150, archive_s=0.5)}, baseline, 0.1) == []
+    # within the tolerance, or with nothing to compare against
+    assert compare({'base': result(pages_per_s=95), 'new': result(pages_per_s=1)}, baseline, 0.1) == []
+
+    regressions = compare({'base': result(pages_per_s=80), 'latency': result(peak_rss_mb=60)}, baseline, 0.1)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('base: pages_per_s 100 -> 80')
+    assert regressions[1].startswith('latency: peak_rss_mb 50 -> 60')
+
+
+def serve(settings, requests):
+    # runs `requests` against a mock server, and returns the mock
+    mock = MockMangaDex(settings, '')
+
+    async def run():
+        async with TestClient(TestServer(mock.app)) as client:
+            await requests(client)
+
+    asyncio.run(run())
+    return mock
+
+
+def test_mock_serves_a_manga():
+    got = {}
+
+    async def requests(client):
+        got['manga'] = await (await client.get('/v2/manga/7')).json()
+        got['chapters'] = await (await client.get('/v2/manga/7/chapters')).json()
+        last = got['chapters']['data']['chapters'][0]
+        got['chapter'] = await (await client.get(f'/v2/chapter/{last["id"]}')).json()
+        chapter = got['chapter']['data']
+        got['page'] = await (await client.get(f'/data/{chapter["hash"]}/{chapter["pages"][0]}')).read()
+
+    mock = serve(Settings(chapters=4, pages=3, page_size=100), requests)
+    assert got['manga']['data']['title'] == 'Bench 7'
+    # listed last to first, the first half in volumes
+    assert [(ch['chapter'], ch['volume']) for ch in got['chapters']['data']['chapters']] == \
+        [('4', ''), ('3', ''), ('2', '1'), ('1', '1')]
+    assert got['chapter']['data']['chapter'] == '4' and len(got['chapter']['data']['pages']) == 3
+    assert len(got['page']) == 100
+    assert (mock.requests, mock.bytes_sent) == (4, 100)
+
+
+def test_mock_fails_and_throttles():
+    statuses = []
+
+    async def requests(client):
+        for _ in range(5):
+            statuses.append((await client.get('/data/abc/p0-x.png')).status)
+
+    mock = serve(Settings(error_rate=1.0), requests)
+    assert statuses == [500] * 5 and mock.failed == 5
+
+    statuses.clear()
+    mock = serve(Settings(max_rate=2), requests)
+    # unless a new second started part way, only the first two get through
+    assert statuses.count(429) >= 2 and set(statuses) == {200, 429}
+    assert mock.throttled == statuses.count(429)
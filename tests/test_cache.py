@@ -0,0 +1,57 @@
+import pytest
+from mangodl.cache import ResponseCache, endpoint_of, CACHE_NAME
+
+
+@pytest.fixture
+def cache(tmp_path):
+    c = ResponseCache(tmp_path / 'cache.sqlite3', max_bytes=100)
+    yield c
+    c.close()
+
+
+def test_endpoint_of():
+    base = 'https://api.mangadex.org/v2/'
+    assert endpoint_of(base + 'manga/1') == 'manga'
+    assert endpoint_of(base + 'manga/1/chapters') == 'chapters'
+    assert endpoint_of(base + 'chapter/1?saver=true') == 'chapter'
+    assert endpoint_of(base + 'user/1') is None
+
+
+def test_cache_fresh_then_stale(tmp_path):
+    url = 'https://api.mangadex.org/v2/manga/1'
+    c = ResponseCache(tmp_path / 'cache.sqlite3', ttls={'manga': 60})
+    c.store(url, '{"data": {}}', etag='"abc"')
+    entry = c.lookup(url)
+    assert entry.fresh
+    assert entry.etag == '"abc"'
+    c.close()
+
+    # a TTL of zero makes every entry stale, but it is still kept for revalidation
+    c_ = ResponseCache(tmp_path / 'cache.sqlite3', ttls={'manga': 0})
+    entry = c_.lookup(url)
+    assert not entry.fresh
+    assert entry.body == '{"data": {}}'
+    c_.close()
+
+
+def test_cache_evicts_least_recently_used(cache):
+    body = 'x' * 40
+    cache.store('a', body)
+    cache.store('b', body)
+    # touch 'a' so 'b' becomes the least recently used
+    cache.lookup('a')
+    cache.store('c', body)
+
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') is not None
+    assert cache.lookup('c') is not None
+    assert cache.total_bytes == 80
+
+
+def test_default_path_is_in_user_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr('sys.platform', 'linux')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'xdg'))
+    c = ResponseCache()
+    c.close()
+    assert c.path == tmp_path / 'xdg' / 'mangodl' / CACHE_NAME
+    assert c.path.exists()
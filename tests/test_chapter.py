@@ -0,0 +1,156 @@
+import asyncio
+import random
+import aiohttp
+from types import SimpleNamespace
+import mangodl.health
+from mangodl.chapter import Chapter
+from mangodl.health import ServerHealth
+from mangodl.helpers import ConcurrencyPool
+from mangodl.retry import RetryPolicy, RetryBudget
+
+SERVER = 'https://s1.mangadex.org/data/'
+
+
+class FakeResponse:
+    def __init__(self, status, body=b'', cut_after=None):
+        self.status = status
+        self.headers = {}
+        self.body = body
+        self.cut_after = cut_after  # chunks sent before the connection drops
+        self.content = SimpleNamespace(iter_chunked=self.iter_chunked)
+
+    async def iter_chunked(self, size):
+        self.chunk_size = size
+        for n, start in enumerate(range(0, len(self.body), size)):
+            if n == self.cut_after:
+                raise aiohttp.ClientPayloadError('connection lost')
+            yield self.body[start:start + size]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FlakySession:
+    """An image server which fails requests at random, or all of the first `fail_first`."""
+
+    def __init__(self, error_rate=0.0, fail_first=0, seed=0):
+        self.error_rate = error_rate
+        self.fail_first = fail_first
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    async def get(self, url):
+        self.requests += 1
+        failed = self.requests <= self.fail_first or self.rng.random() < self.error_rate
+        await asyncio.sleep(0)
+        if failed:
+            return FakeResponse(500)
+        return FakeResponse(200, url.encode())
+
+
+def make_chapter(ch_num, n_pages):
+    chapter = Chapter(ch_num, False)
+    chapter.hash, chapter.ch_num = f'h{ch_num}', ch_num
+    chapter.pages = [f'{n}.png' for n in range(1, n_pages + 1)]
+    chapter.page_links = [SERVER + f'h{ch_num}/' + page for page in chapter.pages]
+    return chapter
+
+
+def make_client(session, health, chapters, image_limit=16):
+    # must be called inside the event loop, for the pool
+    async def get(url, fresh=False):
+        # asking again names the same server - there is nowhere else to go
+        chapter = chapters[int(url.rsplit('/', 1)[1]) - 1]
+        return {'hash': chapter.hash, 'chapter': str(chapter.ch_num), 'volume': '', 'title': '',
+                'server': SERVER, 'pages': chapter.pages}
+
+    return SimpleNamespace(image_session=session,
+                           pool=ConcurrencyPool(4, image_limit),
+                           retry=RetryPolicy(base_delay=0, budget=RetryBudget(), rng=random.Random(0)),
+                           health=health,
+                           metrics=None,
+                           get=get)
+
+
+def download(tmp_path, session, health, n_pages=100):
+    chapter = make_chapter(1, n_pages)
+
+    async def main():
+        await chapter.download(make_client(session, health, [chapter]), tmp_path)
+
+    asyncio.run(main())
+    return chapter
+
+
+def test_flaky_server_still_serves_every_page(tmp_path):
+    # 16 requests in flight at 30% errors soon fail a few in a row - the server isn't down though
+    chapter = download(tmp_path, FlakySession(error_rate=0.3), ServerHealth())
+    assert chapter.failed_pages == []
+    assert len(list(chapter.ch_path.iterdir())) == 100
+
+
+def test_pages_wait_for_server_to_come_back(tmp_path, caplog, monkeypatch):
+    # the server is down for a while, and the pages have nowhere else to go
+    monkeypatch.setattr(mangodl.health, 'PROBE_POLL', 0.01)
+    caplog.set_level('INFO', logger='mangodl.health')
+    health = ServerHealth(cooldown=0.05)
+    chapter = download(tmp_path, FlakySession(fail_first=25), health, n_pages=30)
+    assert chapter.failed_pages == []
+    assert 's1.mangadex.org has cooled down' in caplog.text
+    assert 's1.mangadex.org is answering again' in caplog.text
+
+
+class CountingSession:
+    """An image server which keeps track of how many requests it serves at once."""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.peak = 0
+
+    async def get(self, url):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        return FakeResponse(200, url.encode())
+
+
+def test_chapters_share_image_slots(tmp_path):
+    # two short chapters fill the server's slots between them, and never go past them
+    session = CountingSession()
+    chapters = [make_chapter(1, 3), make_chapter(2, 3)]
+
+    async def main():
+        client = make_client(session, ServerHealth(), chapters, image_limit=4)
+        await asyncio.gather(*(chapter.download(client, tmp_path) for chapter in chapters))
+
+    asyncio.run(main())
+    assert session.peak == 4
+    assert all(chapter.failed_pages == [] for chapter in chapters)
+
+
+class ScriptedSession:
+    """An image server which gives the responses it is handed, in order."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.served = []
+
+    async def get(self, url):
+        self.served.append(self.responses.pop(0))
+        return self.served[-1]
+
+
+def test_pages_streamed_to_disk(tmp_path, monkeypatch):
+    monkeypatch.setattr('mangodl.chapter.CHUNK_SIZE', 4)
+    body = bytes(range(30))
+    session = ScriptedSession(FakeResponse(200, body, cut_after=3), FakeResponse(200, body))
+    chapter = download(tmp_path, session, ServerHealth(), n_pages=1)
+
+    # read a chunk at a time, and the first try broke off part way without leaving anything behind
+    assert [resp.chunk_size for resp in session.served] == [4, 4]
+    assert [p.name for p in chapter.ch_path.iterdir()] == ['1.png']
+    assert (chapter.ch_path / '1.png').read_bytes() == body
@@ -0,0 +1,12 @@
+import pytest
+from mangodl.cli import make_parser
+
+
+@pytest.mark.parametrize('option', ['--vollen', '--ratelimit', '--metalimit', '--imagelimit', '--archiveworkers'])
+def test_limits_must_be_positive(option, capsys):
+    parser = make_parser()
+    assert getattr(parser.parse_args([option, '3']), option[2:]) == 3
+    for value in ('0', '-2', 'x'):
+        with pytest.raises(SystemExit):
+            parser.parse_args([option, value])
+    assert 'must be at least 1' in capsys.readouterr().err
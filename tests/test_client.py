@@ -0,0 +1,67 @@
+import asyncio
+import json
+from mangodl.client import ApiClient
+from mangodl.helpers import ConcurrencyPool
+from mangodl.retry import RetryPolicy
+
+API = 'http://api.test/v2/'
+
+
+class FakeApiResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.headers = {}
+        self.body = body
+
+    async def text(self):
+        return json.dumps(self.body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeApi:
+    """The manga endpoints, slow enough for requests to overlap."""
+
+    def __init__(self, missing=(), fail_once=()):
+        self.missing = set(missing)
+        self.fail_once = set(fail_once)
+        self.in_flight = 0
+        self.peak = 0
+
+    async def get(self, url, headers=None):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        manga_id = url[len(API):].split('/')[1]
+        if manga_id in self.missing:
+            return FakeApiResponse(404, {'status': 'error'})
+        if url in self.fail_once:
+            self.fail_once.discard(url)
+            return FakeApiResponse(503, {})
+        if url.endswith('/chapters'):
+            return FakeApiResponse(200, {'data': {'chapters': [{'id': 1}]}})
+        return FakeApiResponse(200, {'data': {'id': manga_id}})
+
+
+def test_get_mangas_at_once():
+    api = FakeApi(missing={'3'}, fail_once={API + 'manga/2'})
+
+    async def main():
+        client = ApiClient(api, ConcurrencyPool(metadata_limit=3), api_base=API,
+                           retry=RetryPolicy(base_delay=0))
+        return await client.get_mangas([1, 2, 3, 4])
+
+    results = asyncio.run(main())
+    assert results[0] == ({'id': '1'}, [{'id': 1}])
+    # retried after a 503
+    assert results[1] == ({'id': '2'}, [{'id': 1}])
+    # a manga which isn't there doesn't stop the rest
+    assert results[2] is None
+    assert results[3] == ({'id': '4'}, [{'id': 1}])
+    # info and chapter lists were fetched side by side, up to the metadata limit
+    assert api.peak == 3
@@ -0,0 +1,49 @@
+import os
+import subprocess
+import sys
+from mangodl.config.mangodl_config import Config
+
+
+def test_config_writes_once(tmp_path):
+    path = tmp_path / 'config.ini'
+    config = Config(path)
+    # defaults are there before anything is written
+    assert config.get('links', 'api_base').startswith('https://')
+    assert not path.exists()
+    # ... and aren't worth saving on their own
+    assert not config.dirty
+
+    config.set('user info', 'username', 'u')
+    config.set('settings', 'root_dir', '/tmp')
+    config.save()
+    assert Config(path).get('settings', 'root_dir') == '/tmp'
+
+
+def test_config_is_read_once(tmp_path):
+    path = tmp_path / 'config.ini'
+    config = Config(path)
+    config.set('user info', 'username', 'u')
+    config.save()
+
+    # changes made behind our back aren't picked up - the file was read already
+    path.write_text('[user info]\nusername = someone else\n')
+    assert config.get('user info', 'username') == 'u'
+
+    # setting the same value again doesn't make a write
+    config = Config(path)
+    config.set('user info', 'username', 'someone else')
+    assert not config.dirty
+
+
+def test_missing_config_is_not_written_at_exit(tmp_path):
+    path = tmp_path / 'config.ini'
+    code = 'import mangodl.mangodl; from mangodl.chapter import Chapter; Chapter(1, False)'
+    subprocess.run([sys.executable, '-c', code], env=dict(os.environ, MANGODL_CONFIG=str(path)), check=True)
+    assert not path.exists()
+
+
+def test_api_base_is_read_when_used(monkeypatch):
+    from mangodl.config import mangodl_config
+    from mangodl.chapter import Chapter
+    monkeypatch.setattr(mangodl_config, 'get_api_base', lambda: 'http://127.0.0.1:8000/v2/')
+    assert Chapter(1, False).url == 'http://127.0.0.1:8000/v2/chapter/1'
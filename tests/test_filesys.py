@@ -0,0 +1,33 @@
+import zipfile
+from types import SimpleNamespace
+from mangodl.filesys import FileSys
+
+
+def saved_chapter(fs, id, ch_num, vol_num, pages, ch_title=None):
+    ch_path = fs.raw_path / str(ch_num)
+    ch_path.mkdir(parents=True)
+    for page in pages:
+        (ch_path / page).write_bytes(page.encode())
+    return SimpleNamespace(id=id, ch_num=ch_num, vol_num=vol_num, ch_title=ch_title, ch_path=ch_path)
+
+
+def test_create_volumes(tmp_path):
+    fs = FileSys('T', tmp_path)
+    fs.setup_folders()
+    chapters = [saved_chapter(fs, 12, 2, 1, ['1.png']),
+                # a download cut short leaves a part file behind
+                saved_chapter(fs, 11, 1, 1, ['10.png', '2.png', '1.png', '3.png.part']),
+                saved_chapter(fs, 13, '_', '', ['1.jpg'], ch_title='Extra')]
+
+    fs.create_volumes(chapters)
+    vols_path = fs.base_path / 'T'
+    # written straight from the chapter folders
+    assert sorted(p.name for p in vols_path.iterdir()) == ['Extra.cbz', 'T, Vol. 1.cbz']
+
+    with zipfile.ZipFile(vols_path / 'T, Vol. 1.cbz') as zf:
+        # chapter by chapter, pages in number order, stored as they are
+        assert zf.namelist() == ['1/1.png', '1/2.png', '1/10.png', '2/1.png']
+        assert zf.read('1/10.png') == b'10.png'
+        assert all(info.compress_type == zipfile.ZIP_STORED for info in zf.infolist())
+    with zipfile.ZipFile(vols_path / 'Extra.cbz') as zf:
+        assert zf.namelist() == ['1.jpg']
@@ -0,0 +1,72 @@
+import asyncio
+import mangodl.health
+from mangodl.health import ServerHealth
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+URL = 'https://s1.mangadex.org/data/abc/1.png'
+
+
+def test_server_down_when_most_requests_fail():
+    clock = FakeClock()
+    health = ServerHealth(max_failures=3, failure_rate=0.5, window=10, cooldown=10, clock=clock)
+
+    # a flaky server fails a few in a row now and then, but most requests go through
+    for ok in [False, False, False, True, True, True, True, True, True, True]:
+        health.record(URL, ok)
+    assert not health.is_down(URL)
+
+    # old failures drop out of the window
+    clock.now += 11
+    for ok in [True, False, False]:
+        health.record(URL, ok)
+    assert not health.is_down(URL)
+    health.record(URL, False)
+    assert health.is_down(URL)
+    # other servers are not affected
+    assert not health.is_down('https://s2.mangadex.org/data/abc/1.png')
+
+    # gets another chance after the cooldown
+    clock.now += 10
+    assert not health.is_down(URL)
+    assert health.success_rate(URL) == 8 / 14
+
+
+def test_one_probe_after_cooldown(monkeypatch):
+    monkeypatch.setattr(mangodl.health, 'PROBE_POLL', 0.01)
+    clock = FakeClock()
+    health = ServerHealth(max_failures=2, cooldown=10, clock=clock)
+    health.record(URL, False)
+    health.record(URL, False)
+    assert health.is_down(URL)
+
+    async def main():
+        waiting = [asyncio.ensure_future(health.wait(URL)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert not any(task.done() for task in waiting)
+
+        # the first to notice the cooldown is over goes alone
+        clock.now += 10
+        done, pending = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        assert [task.result() for task in done] == [True]
+        assert health.is_down(URL)
+
+        # the probe failed - everyone waits another cooldown
+        health.record(URL, False)
+        await asyncio.sleep(0.05)
+        assert not any(task.done() for task in pending)
+
+        clock.now += 10
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        health.record(URL, True)
+        assert not health.is_down(URL)
+        assert await asyncio.gather(*pending) == [False]
+
+    asyncio.run(main())
@@ -1,6 +1,6 @@
 import pytest
-from mangodl.helpers import (chunk, find_int_between, parse_range_input,
-                             safe_to_int)
+from mangodl.helpers import (ConcurrencyPool, chunk, find_int_between,
+                             interleave, parse_range_input, safe_to_int)
 
 
 @pytest.fixture
@@ -150,3 +150,26 @@ def test_parse_range_input_mixed():
     # mixed input with whitespace
     i = ' 1  -   10    , 11  , 12  -    20  '
     assert parse_range_input(i) == i_
+
+
+def test_interleave_uneven_lists():
+    # lists of different lengths
+    a = [1, 2, 3]
+    b = ['a']
+    c = [4, 5]
+    # expected output
+    l_ = [1, 'a', 4, 2, 5, 3]
+
+    assert interleave(a, b, c) == l_
+
+
+def test_interleave_empty():
+    assert interleave() == []
+    assert interleave([], []) == []
+
+
+def test_pool_has_image_slots_per_server():
+    pool = ConcurrencyPool(image_limit=2)
+    s1 = pool.images_for('https://s1.mangadex.org/data/abc/1.png')
+    assert pool.images_for('https://s1.mangadex.org/data/abc/2.png') is s1
+    assert pool.images_for('https://s2.mangadex.org/data/abc/1.png') is not s1
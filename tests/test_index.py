@@ -0,0 +1,50 @@
+import pytest
+from mangodl.index import ChapterIndex, ChapterRecord
+
+
+def upload(id, chapter, language='gb'):
+    return ChapterRecord(id, chapter, '', language, '', (), 0)
+
+
+@pytest.fixture
+def index():
+    return ChapterIndex([upload(1, '1'),
+                         upload(2, '2'),
+                         upload(3, '2'),
+                         upload(4, '2', 'fr'),
+                         upload(5, '10'),
+                         upload(6, '2.5'),
+                         upload(7, '')])
+
+
+def test_index_first_uploads(index):
+    assert [ch.id for ch in index.first_uploads('gb')] == [1, 2, 5, 6, 7]
+    assert [ch.id for ch in index.first_uploads('fr')] == [4]
+    assert index.first_uploads('de') == []
+
+
+def test_index_find_another(index):
+    index.mark_bad(2)
+    assert index.find_another(upload(2, '2')).id == 3
+    index.mark_bad('3')
+    assert index.find_another(upload(2, '2')) is None
+    # other languages are never used in place of each other
+    assert index.find_another(upload(4, '2', 'fr')).id == 4
+
+
+def test_index_numbers_and_range(index):
+    # the chapter without a number is left out
+    assert index.numbers('gb') == [1, 2, 2.5, 10]
+    assert index.between('gb', 2, 9) == ['2', '2.5']
+    assert index.between('gb', 0, 1) == ['1']
+    assert index.between('gb', 11, 20) == []
+
+
+def test_record_from_api():
+    raw_ch = {'id': 9, 'hash': 'abc', 'mangaId': 1, 'mangaTitle': 'T', 'volume': '1',
+              'chapter': '3', 'title': 'Three', 'language': 'gb', 'groups': [4, 5],
+              'uploader': 6, 'timestamp': 1600000000, 'threadId': 7, 'comments': 0, 'views': 8}
+    record = ChapterRecord.from_api(raw_ch)
+    assert record == (9, '3', '1', 'gb', 'Three', (4, 5), 1600000000)
+    # only a few distinct languages, so they are shared rather than copied
+    assert record.language is ChapterRecord.from_api(dict(raw_ch, id=10)).language
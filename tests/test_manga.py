@@ -0,0 +1,86 @@
+import hashlib
+import pytest
+from types import SimpleNamespace
+from mangodl.chapter import Chapter
+from mangodl.filesys import FileSys
+from mangodl.manga import Manga
+from mangodl.volumes import save_volume_map
+from tests.helpers import raw_ch
+
+
+def saved_manga(tmp_path, missing, vol_map=True):
+    # 30 chapters without volumes, all saved by an earlier run except `missing`
+    manga = Manga(1, {'title': 'T'}, [raw_ch(id, str(id)) for id in range(30, 0, -1)])
+    fs = FileSys('T', tmp_path)
+    fs.setup_folders()
+    if vol_map:
+        # the earlier run had every chapter, in volumes of 5, then lost `missing`
+        save_volume_map(fs.volume_map_path, [SimpleNamespace(ch_num=id, vol_num=(id - 1) // 5 + 1)
+                                             for id in range(1, 31)])
+    for id in range(1, 31):
+        if id in missing:
+            continue
+        folder = f'ch {id}'
+        (fs.raw_path / folder).mkdir()
+        (fs.raw_path / folder / '1.png').write_bytes(b'page')
+        fs.manifest.add_chapter(id, str(id), '', '', folder)
+        fs.manifest.add_page(id, 'x.png', 'http://a/x.png', '1.png', 4, hashlib.sha256(b'page').hexdigest())
+        fs.manifest.finish_chapter(id)
+    manga.use_volume_strategy(fs)
+    return manga, fs
+
+
+def sync(manga, fs):
+    # download the staged chapters, then work out what to rebuild
+    manga.downloaded = [SimpleNamespace(id=record.id, ch_num=int(record.number), vol_num='')
+                        for record in manga.s_downloads]
+    return manga.sync_volumes(fs, False, 5)
+
+
+def test_sync_rebuilds_only_touched_volumes(tmp_path):
+    manga, fs = saved_manga(tmp_path, missing={3, 20})
+    assert manga.stage_new_chapters('gb', fs.manifest)
+    assert [record.number for record in manga.s_downloads] == ['3', '20']
+
+    chapters = sync(manga, fs)
+    assert {ch.vol_num for ch in chapters} == {1, 4}
+    assert sorted(ch.ch_num for ch in chapters) == [1, 2, 3, 4, 5, 16, 17, 18, 19, 20]
+
+
+def test_sync_rebuilds_volumes_whose_chapters_move(tmp_path):
+    # the earlier run never had chapters 3 and 20, so every volume from the first shifts
+    manga, fs = saved_manga(tmp_path, missing={3, 20}, vol_map=False)
+    manga.stage_new_chapters('gb', fs.manifest)
+    chapters = sync(manga, fs)
+    assert {ch.vol_num for ch in chapters} == {1, 2, 3, 4, 5, 6}
+
+
+def test_sync_reads_saved_chapters_once(tmp_path, monkeypatch):
+    manga, fs = saved_manga(tmp_path, missing={3, 20})
+    manga.stage_new_chapters('gb', fs.manifest)
+    loaded = []
+    from_manifest = Chapter.from_manifest.__func__
+
+    def counting(cls, id, *args, **kwargs):
+        loaded.append(id)
+        return from_manifest(cls, id, *args, **kwargs)
+
+    monkeypatch.setattr(Chapter, 'from_manifest', classmethod(counting))
+    # pages are only checked for their size
+    monkeypatch.setattr('mangodl.manifest.file_sha256', lambda path: pytest.fail('page hashed'))
+    sync(manga, fs)
+    assert sorted(loaded) == sorted(str(id) for id in range(1, 31) if id not in {3, 20})
+
+
+def test_direct_chapters_get_no_volumes(tmp_path):
+    # chapters written straight into their own archives have no raw files to put in volumes
+    manga, fs = saved_manga(tmp_path, missing=set(), vol_map=False)
+    manga.downloaded = [SimpleNamespace(id=1, ch_num=1, vol_num='')]
+    manga.finish_download(False, 5, direct='chapter')
+    assert manga.downloaded[0].vol_num == ''
+    assert not fs.volume_map_path.exists()
+
+
+def test_sync_with_nothing_new(tmp_path):
+    manga, fs = saved_manga(tmp_path, missing=set())
+    assert not manga.stage_new_chapters('gb', fs.manifest)
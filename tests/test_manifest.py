@@ -0,0 +1,94 @@
+import hashlib
+import json
+
+import pytest
+from mangodl.manifest import Manifest
+
+
+@pytest.fixture
+def saved_page(tmp_path):
+    # a chapter folder holding one page of 5 bytes
+    ch_path = tmp_path / 'ch 1'
+    ch_path.mkdir()
+    page_path = ch_path / '1.png'
+    page_path.write_bytes(b'12345')
+    return page_path
+
+
+DIGEST = hashlib.sha256(b'12345').hexdigest()
+
+
+def test_manifest_replays_after_restart(tmp_path, saved_page):
+    path = tmp_path / 'manifest.jsonl'
+    m = Manifest(path)
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, DIGEST)
+
+    m_ = Manifest(path)
+    assert m_.page_is_done(7, 'x1.png', saved_page)
+    # not every page was recorded, so the chapter is incomplete
+    assert m_.completed_chapter(7) is None
+
+
+def test_manifest_rejects_changed_page(tmp_path, saved_page):
+    m = Manifest(tmp_path / 'manifest.jsonl')
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, 'abc')
+    # size on disk no longer matches
+    saved_page.write_bytes(b'123')
+    assert not m.page_is_done(7, 'x1.png', saved_page)
+    # page was never recorded
+    assert not m.page_is_done(7, 'x2.png', saved_page)
+
+
+def test_manifest_rejects_corrupted_page(tmp_path, saved_page):
+    path = tmp_path / 'manifest.jsonl'
+    m = Manifest(path)
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, DIGEST)
+    assert m.page_is_done(7, 'x1.png', saved_page)
+    # same size, different bytes
+    saved_page.write_bytes(b'12045')
+    assert not m.page_is_done(7, 'x1.png', saved_page)
+    # unless only sizes are checked
+    assert Manifest(path, verify=False).page_is_done(7, 'x1.png', saved_page)
+
+
+def test_manifest_skips_damaged_line(tmp_path, saved_page):
+    path = tmp_path / 'manifest.jsonl'
+    m = Manifest(path)
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, 'abc')
+    m.finish_chapter(7)
+    m.close()
+    # simulate a crash in the middle of writing a line
+    with open(path, 'a') as f:
+        f.write('{"type": "page", "id"')
+
+    m_ = Manifest(path)
+    assert m_.completed_chapter(7)['folder'] == 'ch 1'
+
+
+def test_manifest_close_compacts(tmp_path):
+    path = tmp_path / 'manifest.jsonl'
+    m = Manifest(path)
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, 'abc')
+    m.finish_chapter(7)
+    m.close()
+
+    lines = [json.loads(line) for line in open(path)]
+    assert [rec['type'] for rec in lines] == ['page', 'chapter']
+    assert Manifest(path).completed_chapter(7)['status'] == 'complete'
+
+
+def test_manifest_drop_chapter(tmp_path, saved_page):
+    path = tmp_path / 'manifest.jsonl'
+    m = Manifest(path)
+    m.add_chapter(7, '1', '', 'title', 'ch 1')
+    m.add_page(7, 'x1.png', 'http://a/x1.png', '1.png', 5, 'abc')
+    m.drop_chapter(7)
+
+    # dropped chapters stay dropped after a restart
+    assert 7 not in Manifest(path).chapters
+    assert '7' not in Manifest(path).chapters
@@ -0,0 +1,54 @@
+import io
+import json
+import random
+import asyncio
+import pytest
+from mangodl.metrics import Metrics
+from mangodl.retry import RetryPolicy, RetryError, StatusError
+
+
+@pytest.fixture
+def metrics():
+    return Metrics(io.StringIO(), clock=lambda: 100.0)
+
+
+def test_prometheus_text(metrics):
+    metrics.inc('pages', result='downloaded')
+    metrics.inc('pages', 2, result='downloaded')
+    metrics.add('slots_waiting', 3, kind='images')
+    metrics.observe('ttfb', 0.2, host='a')
+    metrics.observe('ttfb', 7, host='a')
+    text = metrics.to_prometheus()
+    assert '# TYPE mangodl_pages_total counter' in text
+    assert 'mangodl_pages_total{result="downloaded"} 3' in text
+    assert 'mangodl_slots_waiting{kind="images"} 3' in text
+    # buckets are cumulative
+    assert 'mangodl_ttfb_seconds_bucket{host="a",le="0.25"} 1' in text
+    assert 'mangodl_ttfb_seconds_bucket{host="a",le="+Inf"} 2' in text
+    assert 'mangodl_ttfb_seconds_count{host="a"} 2' in text
+
+
+def test_json_lines(metrics):
+    metrics.inc('chapters', result='saved')
+    metrics.add('archives_pending', 1)
+    metrics.observe('archive', 1.5)
+    metrics.close()
+    lines = [json.loads(line) for line in metrics.stream.getvalue().splitlines()]
+    assert lines[0] == {'time': 100.0, 'type': 'counter', 'name': 'chapters',
+                        'labels': {'result': 'saved'}, 'value': 1}
+    assert lines[1]['type'] == 'timing' and lines[1]['value'] == 1.5
+    # gauges only show up once, at the end
+    assert lines[2]['type'] == 'gauge' and lines[2]['name'] == 'archives_pending'
+    assert len(lines) == 3
+
+
+def test_retries_counted(metrics):
+    policy = RetryPolicy(max_tries=2, base_delay=0, rng=random.Random(0), metrics=metrics)
+
+    async def fn():
+        raise StatusError(503)
+
+    with pytest.raises(RetryError):
+        asyncio.run(policy.call(fn))
+    assert metrics.counters[('retries', (('reason', '503'),))] == 1
+    assert metrics.counters[('retries_exhausted', (('reason', '503'),))] == 1
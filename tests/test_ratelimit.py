@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+from email.utils import formatdate
+from mangodl.ratelimit import TokenBucket, RateLimitedSession, parse_retry_after
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('120') == 120
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    # an HTTP date thirty seconds from now
+    assert parse_retry_after(formatdate(1030, usegmt=True), now=1000) == 30
+
+
+def test_bucket_waits_exactly_until_next_token(clock):
+    bucket = TokenBucket(rate=10, max_tokens=1, clock=clock)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1)
+    clock.now += 0.1
+    assert bucket.reserve() == 0
+
+
+def test_bucket_aimd(clock):
+    bucket = TokenBucket(rate=10, max_rate=11, clock=clock)
+    for _ in range(100):
+        bucket.on_response(200)
+    assert bucket.rate == 11  # capped
+
+    bucket.on_response(429)
+    assert bucket.rate == 5.5
+    # a second 429 from a request already in flight doesn't count
+    bucket.on_response(429)
+    assert bucket.rate == 5.5
+    clock.now += 1
+    bucket.on_response(429)
+    assert bucket.rate == 2.75
+
+
+def test_bucket_obeys_retry_after(clock):
+    bucket = TokenBucket(rate=10, adaptive=False, clock=clock)
+    bucket.on_response(429, retry_after='5')
+    assert bucket.rate == 10
+    assert bucket.reserve() == 5
+    clock.now += 5
+    assert bucket.reserve() == pytest.approx(0.1)
+
+
+def test_bucket_backs_off_on_rising_latency(clock):
+    bucket = TokenBucket(rate=10, clock=clock)
+    for _ in range(5):
+        bucket.on_response(200, latency=0.1)
+    rate = bucket.rate
+    for _ in range(10):
+        bucket.on_response(200, latency=1)
+    assert bucket.rate < rate
+
+
+def test_bucket_acquire_keeps_order():
+    bucket = TokenBucket(rate=200, max_tokens=1)
+    order = []
+
+    async def take(i):
+        await bucket.acquire()
+        order.append(i)
+
+    async def main():
+        await asyncio.gather(*(take(i) for i in range(5)))
+
+    asyncio.run(main())
+    assert order == list(range(5))
+
+
+def test_session_has_bucket_per_host():
+    session = RateLimitedSession(None, rate=5)
+    a = session.bucket_for('https://s1.mangadex.org/data/abc/1.png')
+    assert session.bucket_for('https://s1.mangadex.org/data/abc/2.png') is a
+    assert session.bucket_for('https://s2.mangadex.org/data/abc/1.png') is not a
+    assert a.rate == 5
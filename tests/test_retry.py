@@ -0,0 +1,69 @@
+import asyncio
+import random
+import pytest
+import aiohttp
+from mangodl.retry import RetryPolicy, RetryBudget, RetryError, StatusError
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def policy():
+    # no waiting around in tests
+    return RetryPolicy(max_tries=3, base_delay=0, rng=random.Random(0))
+
+
+def failing(errors, result='ok'):
+    """Returns a function which raises each of `errors` in turn, then returns `result`."""
+    errors = list(errors)
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return fn, calls
+
+
+def test_retry_until_success(policy):
+    fn, calls = failing([aiohttp.ServerDisconnectedError(), StatusError(503)])
+    assert run(policy.call(fn)) == 'ok'
+    assert len(calls) == 3
+
+
+def test_retry_gives_up_after_max_tries(policy):
+    fn, calls = failing([asyncio.TimeoutError()] * 5)
+    with pytest.raises(RetryError):
+        run(policy.call(fn))
+    assert len(calls) == 3
+
+
+def test_retry_skips_bad_status(policy):
+    # a missing page won't turn up by asking again
+    fn, calls = failing([StatusError(404)])
+    with pytest.raises(StatusError):
+        run(policy.call(fn))
+    assert len(calls) == 1
+
+
+def test_retry_budget_runs_out():
+    budget = RetryBudget(ratio=0, min_retries=2)
+    policy = RetryPolicy(max_tries=5, base_delay=0, budget=budget)
+    fn, calls = failing([StatusError(500)] * 5)
+    with pytest.raises(RetryError):
+        run(policy.call(fn))
+    assert len(calls) == 3
+    assert budget.retries == 2
+
+
+def test_retry_delay_grows_with_jitter():
+    policy = RetryPolicy(base_delay=1, max_delay=8, rng=random.Random(0))
+    for attempt in range(6):
+        cap = min(8, 2 ** attempt)
+        assert cap / 2 <= policy.delay(attempt) <= cap
+    # Retry-After wins if longer
+    assert policy.delay(0, retry_after=20) == 20
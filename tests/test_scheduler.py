@@ -0,0 +1,118 @@
+import asyncio
+import threading
+import time
+import zipfile
+import pytest
+from types import SimpleNamespace
+from mangodl.filesys import FileSys
+from mangodl.manga import Manga
+from tests.helpers import raw_ch
+from mangodl.scheduler import DownloadScheduler
+
+
+class FakeFileSys:
+    """Records which chapters went into each archive, and when."""
+
+    def __init__(self, fail_volume=None, delay=0):
+        self.fail_volume = fail_volume
+        self.delay = delay
+        self.archived = []
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.manifest = SimpleNamespace(close=lambda: None)
+
+    def archive_volume(self, chapters):
+        self.archived.append((time.monotonic(), sorted(ch.ch_num for ch in chapters)))
+        with self.lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        if chapters[0].vol_num == self.fail_volume:
+            raise OSError('disk full')
+        return [f'vol {chapters[0].vol_num}']
+
+
+def make_manga(downloads):
+    manga = Manga(1, {'title': 'T'}, [raw_ch(id, str(id), str((id - 1) // 3 + 1)) for id in range(9, 0, -1)])
+    manga.stage_chapters('gb', no_prompt=True)
+
+    async def download_chapter(client, record, fs, saver, progress=None, archive=None):
+        await asyncio.sleep(0.01 * int(record.number))  # chapters finish in order
+        if archive is not None:
+            for page in (2, 10, 1):  # pages arrive out of order
+                archive.add(int(record.number), f'{page}.png', b'page')
+        manga.downloaded.append(SimpleNamespace(id=record.id, ch_num=int(record.number),
+                                                vol_num=int(record.volume)))
+        downloads.append(time.monotonic())
+
+    manga.download_chapter = download_chapter
+    return manga
+
+
+def run(fs, archive_queue=16, direct=None):
+    downloads, events = [], []
+    scheduler = DownloadScheduler(30, archive_workers=2, archive_queue=archive_queue,
+                                  show_progress=False, on_progress=events.append)
+    scheduler.client = SimpleNamespace(health=SimpleNamespace(report=lambda: None))
+    manga = make_manga(downloads)
+    scheduler.add(manga, fs, False, 10, direct)
+    try:
+        scheduler.run()
+    finally:
+        scheduler.loop.close()
+        scheduler.archive_pool.shutdown()
+    return downloads, [event.item for event in events if event.kind == 'volume']
+
+
+def test_volumes_archived_while_downloading():
+    fs = FakeFileSys()
+    downloads, volumes = run(fs)
+    assert sorted(chs for _, chs in fs.archived) == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert sorted(volumes) == ['vol 1', 'vol 2', 'vol 3']
+    # the first volume didn't wait for the last chapter
+    assert min(t for t, _ in fs.archived) < max(downloads)
+
+
+def test_archive_workers_limit_volumes_at_once():
+    # slow archives pile up behind the two workers
+    fs = FakeFileSys(delay=0.2)
+    downloads, volumes = run(fs)
+    assert sorted(volumes) == ['vol 1', 'vol 2', 'vol 3']
+    assert fs.peak == 2
+
+
+def test_failed_volume_does_not_stall_pipeline():
+    # a full queue and a failing volume must not leave downloads waiting forever
+    fs = FakeFileSys(fail_volume=2)
+    with pytest.raises(OSError):
+        run(fs, archive_queue=1)
+    assert sorted(chs for _, chs in fs.archived) == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+
+
+def test_direct_to_volumes(tmp_path):
+    fs = FileSys('T', tmp_path)
+    fs.setup_folders(raw=False)
+    downloads, volumes = run(fs, direct='volume')
+    assert not fs.raw_path.exists()
+    assert sorted(volumes) == [fs.vols_path / f'T, Vol. {n}.cbz' for n in (1, 2, 3)]
+    assert [p.name for p in fs.vols_path.iterdir() if p.suffix == '.part'] == []
+    with zipfile.ZipFile(fs.vols_path / 'T, Vol. 2.cbz') as zf:
+        assert zf.namelist() == [f'{ch}/{page}.png' for ch in (4, 5, 6) for page in (1, 2, 10)]
+
+
+def test_streaming_archive_drop(tmp_path):
+    fs = FileSys('T', tmp_path)
+    fs.setup_folders(raw=False)
+    archive = fs.open_archive('Ch. 1', folders=False)
+    archive.add(1, '2.png', b'old')
+    archive.drop(1)
+    archive.add(1, '2.png', b'new')
+    archive.add(1, '1.png', bytearray(b'new'))
+    path = archive.finish()
+    with zipfile.ZipFile(path) as zf:
+        assert zf.namelist() == ['1.png', '2.png']
+        assert zf.read('2.png') == b'new'
+        assert zf.testzip() is None
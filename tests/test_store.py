@@ -0,0 +1,43 @@
+import hashlib
+import os
+
+import pytest
+from mangodl.store import PageStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = PageStore(tmp_path / 'store')
+    s.setup_folders()
+    return s
+
+
+def download(store, data):
+    # write a page into the store's temp folder, as Chapter.download does
+    tmp = store.new_temp_path()
+    tmp.write_bytes(data)
+    return tmp, hashlib.sha256(data).hexdigest()
+
+
+def test_store_dedups_identical_pages(tmp_path, store):
+    page_a = tmp_path / 'a.png'
+    page_b = tmp_path / 'b.png'
+
+    tmp, digest = download(store, b'same bytes')
+    assert not store.commit(tmp, digest, page_a)
+    tmp, digest = download(store, b'same bytes')
+    assert store.commit(tmp, digest, page_b)
+
+    assert page_b.read_bytes() == b'same bytes'
+    assert os.path.samefile(page_a, page_b)
+    assert os.listdir(store.tmp_path) == []
+
+
+def test_store_finds_digest_in_page_name(tmp_path, store):
+    tmp, digest = download(store, b'page')
+    store.commit(tmp, digest, tmp_path / '1.png')
+
+    assert store.find(f'x1-{digest}.png') == digest
+    # digest of something we don't have
+    assert store.find(f'x1-{"0" * 64}.png') is None
+    assert store.find('x1.png') is None
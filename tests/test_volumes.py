@@ -0,0 +1,120 @@
+import json
+import random
+import pytest
+from types import SimpleNamespace
+from mangodl.volumes import assign_volumes, save_volume_map, KnownVolumes, ByTimestamp
+
+
+def make_series(rng, n_chapters):
+    """
+    A weekly series: volumes of 3 to 12 chapters, some half chapters,
+    volume numbers missing from some chapters and from the newest ones.
+    """
+    chapters, ch_num, vol_num = [], 1, 1
+    while len(chapters) < n_chapters:
+        for _ in range(rng.randint(3, 12)):
+            chapters.append(SimpleNamespace(id=len(chapters), ch_num=ch_num, vol_num=vol_num))
+            if rng.random() < 0.05:
+                chapters.append(SimpleNamespace(id=len(chapters), ch_num=ch_num + 0.5, vol_num=vol_num))
+            ch_num += 1
+        vol_num += 1
+    tail = rng.randint(0, n_chapters // 4)
+    for i, ch in enumerate(chapters):
+        if i >= len(chapters) - tail or rng.random() < 0.3:
+            ch.vol_num = ''
+    return chapters
+
+
+def expected_volumes(chapters, known):
+    """By a sweep rather than a search - each chapter joins the highest tagged chapter at or below it."""
+    expected = {}
+    current = known[min((ch for ch in chapters if ch.id in known), key=lambda ch: ch.ch_num).id]
+    for ch in sorted(chapters, key=lambda ch: ch.ch_num):
+        current = known.get(ch.id, current)
+        expected[ch.id] = current
+    return expected
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_assign_volumes_properties(seed):
+    rng = random.Random(seed)
+    chapters = make_series(rng, rng.choice([50, 500, 3000]))
+    tagged = [SimpleNamespace(**vars(ch)) for ch in chapters if ch.vol_num != '']
+    known = {ch.id: ch.vol_num for ch in tagged}
+    first_tagged = min(ch.ch_num for ch in tagged)
+    last_tagged = max(ch.ch_num for ch in tagged)
+
+    expected = expected_volumes(chapters, known)
+
+    shuffled = [SimpleNamespace(**vars(ch)) for ch in chapters]
+    rng.shuffle(shuffled)
+    assign_volumes(chapters, 10)
+    assign_volumes(shuffled, 10)
+
+    by_id = {ch.id: ch.vol_num for ch in chapters}
+    # the order chapters come in doesn't matter
+    assert {ch.id: ch.vol_num for ch in shuffled} == by_id
+    for ch in chapters:
+        # everything has a volume, and volumes given by mangadex are kept
+        assert isinstance(ch.vol_num, int)
+        assert known.get(ch.id, ch.vol_num) == ch.vol_num
+        # orphans inside the known range join their neighbours
+        if first_tagged - 1 <= ch.ch_num <= last_tagged + 0.5:
+            assert ch.vol_num == expected[ch.id]
+    # volumes never go backwards
+    vols = [ch.vol_num for ch in sorted(chapters, key=lambda ch: ch.ch_num)]
+    assert vols == sorted(vols)
+
+
+def test_extrapolate_new_volumes():
+    # volumes 2 and 3 are known, and chapter 5 joins volume 2 - so new volumes get 6 chapters
+    chapters = [SimpleNamespace(id=n, ch_num=n, vol_num=2 + (n - 6) // 5 if 6 <= n <= 15 else '')
+                for n in range(1, 26)]
+    assign_volumes(chapters, 10)
+    assert [ch.vol_num for ch in chapters] == [1] * 4 + [2] * 6 + [3] * 5 + [4] * 10
+
+
+def test_from_scratch_in_chapter_order():
+    # the api lists chapters newest first
+    chapters = [SimpleNamespace(id=n, ch_num=n, vol_num='') for n in range(25, 0, -1)]
+    chapters.append(SimpleNamespace(id=0, ch_num='', vol_num=''))
+    assign_volumes(chapters, 10)
+    assert {ch.ch_num: ch.vol_num for ch in chapters if ch.ch_num} == \
+        {n: 1 if n <= 10 else 2 for n in range(1, 26)}
+
+
+def test_saved_map_keeps_volumes_stable(tmp_path):
+    # the first run guesses volumes for chapters 6 to 12
+    map_path = tmp_path / 'volumes.json'
+    first = [SimpleNamespace(id=n, ch_num=n, vol_num=1 if n <= 5 else '') for n in range(1, 13)]
+    assign_volumes(first, 10)
+    save_volume_map(map_path, first)
+
+    # by the next run there are more chapters, which would have changed the guesses
+    second = [SimpleNamespace(id=n, ch_num=n, vol_num=1 if n <= 5 else '') for n in range(1, 20)]
+    assign_volumes(second, 10, [KnownVolumes.from_file(map_path)])
+    assert [ch.vol_num for ch in second[:12]] == [ch.vol_num for ch in first]
+    assert {ch.vol_num for ch in second[12:]} == {max(ch.vol_num for ch in first) + 1}
+
+    save_volume_map(map_path, second)
+    assert len(json.loads(map_path.read_text())) == 19
+
+
+def test_mapping_file_overrides(tmp_path):
+    map_path = tmp_path / 'map.csv'
+    map_path.write_text('1,3\n2.0, 3\n')
+    chapters = [SimpleNamespace(id=n, ch_num=n, vol_num=1) for n in (1, 2, 3)]
+    assign_volumes(chapters, 10, [KnownVolumes.from_file(map_path, override=True)])
+    assert [ch.vol_num for ch in chapters] == [3, 3, 1]
+
+
+def test_by_timestamp():
+    day = 86400
+    # a volume every 90 days, then 6 chapters with no volume over the next 200 days
+    chapters = [SimpleNamespace(id=n, ch_num=n, vol_num=(n - 1) // 3 + 1) for n in range(1, 10)]
+    chapters += [SimpleNamespace(id=n, ch_num=n, vol_num='') for n in range(10, 16)]
+    timestamps = {str(n): ((n - 1) // 3) * 90 * day + (n - 1) % 3 * day for n in range(1, 10)}
+    timestamps.update({str(n): 180 * day + (n - 10) * 40 * day for n in range(10, 16)})
+    timestamps['13'] = 0  # uploaded late - stays with chapter 12
+    assign_volumes(chapters, 10, [ByTimestamp(timestamps)])
+    assert [ch.vol_num for ch in chapters[9:]] == [3, 3, 3, 3, 4, 5]
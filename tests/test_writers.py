@@ -0,0 +1,126 @@
+import re
+import struct
+import tarfile
+import zipfile
+import zlib
+import pytest
+from mangodl.writers import open_writer, image_info, FORMATS
+
+
+def png(width, height, color_type=2, bits=8, interlace=0, pixel=None):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    channels = {0: 1, 2: 3, 4: 2, 6: 4}[color_type]
+    pixel = pixel or b'\x80' * channels * (bits // 8)
+    # sub filtered rows - the filter has to survive splitting off the alpha channel
+    rows = b''.join(b'\x01' + pixel + b'\x00' * len(pixel) * (width - 1) for _ in range(height))
+    ihdr = struct.pack('>IIBBBBB', width, height, bits, color_type, 0, 0, interlace)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def jpeg(width, height, exif_size=0):
+    # enough of a jpeg to read its size - app segments, then the frame header
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00' + b'\x00' * 9
+    while exif_size > 0:
+        app0 += b'\xff\xe1' + struct.pack('>H', 65535) + b'\x00' * 65533
+        exif_size -= 65535
+    sof = b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + b'\x00' * 9
+    return b'\xff\xd8' + app0 + sof + b'\xff\xd9'
+
+
+@pytest.fixture
+def pages(tmp_path):
+    (tmp_path / 'a.png').write_bytes(png(4, 6))
+    (tmp_path / 'b.jpg').write_bytes(jpeg(40, 60))
+    return [('1/1.png', tmp_path / 'a.png'), ('1/2.jpg', tmp_path / 'b.jpg'), ('2/1.png', png(2, 2, 0))]
+
+
+def test_image_info():
+    assert image_info(png(4, 6))[:4] == ('png', 4, 6, 3)
+    assert image_info(jpeg(40, 60))[:4] == ('jpeg', 40, 60, 3)
+    # well past the first 64 KB
+    assert image_info(jpeg(40, 60, exif_size=200_000))[:4] == ('jpeg', 40, 60, 3)
+    assert image_info(jpeg(40, 60)[:20]) is None
+    assert image_info(png(4, 6, 6, bits=16))[:5] == ('png', 4, 6, 4, 16)
+    assert image_info(b'GIF89a') is None
+
+
+@pytest.mark.parametrize('out_format', FORMATS)
+def test_writers(tmp_path, pages, out_format):
+    with open_writer(out_format, tmp_path / 'Vol. 1', level=6) as writer:
+        for arcname, page in pages:
+            writer.add(arcname, page)
+    path = writer.path
+    assert not writer.tmp_path.exists()
+    names = [arcname for arcname, _ in pages]
+
+    if out_format == 'cbz':
+        with zipfile.ZipFile(path) as zf:
+            assert zf.namelist() == names
+            assert zf.read('1/1.png') == png(4, 6)
+            assert zf.getinfo('1/1.png').compress_type == zipfile.ZIP_DEFLATED
+    elif out_format == 'cbt':
+        with tarfile.open(path) as tf:
+            assert tf.getnames() == names
+    elif out_format == 'folder':
+        assert sorted(str(p.relative_to(path)) for p in path.rglob('*.*')) == names
+    elif out_format == 'epub':
+        with zipfile.ZipFile(path) as zf:
+            mimetype = zf.infolist()[0]
+            assert mimetype.filename == 'mimetype' and mimetype.compress_type == zipfile.ZIP_STORED
+            opf = zf.read('OEBPS/content.opf').decode()
+            assert re.findall(r'itemref idref="(\w+)"', opf) == ['p00001', 'p00002', 'p00003']
+            assert re.findall(r'>(Chapter \w+)<', zf.read('OEBPS/nav.xhtml').decode()) == ['Chapter 1', 'Chapter 2']
+    elif out_format == 'pdf':
+        data = path.read_bytes()
+        assert b'/Count 3' in data
+        # every entry in the cross-reference table points at its object
+        xref = int(data.rsplit(b'startxref\n', 1)[1].split()[0])
+        offsets = re.findall(rb'(\d{10}) 00000 n', data[xref:])
+        for obj_id, offset in enumerate(offsets, 1):
+            assert data[int(offset):].startswith(f'{obj_id} 0 obj'.encode())
+
+
+def pdf_streams(data):
+    # (dictionary, decompressed data) of each image in a pdf
+    images = []
+    for head, stream in re.findall(rb'<< (/Type /XObject.*?) >>\nstream\n(.*?)\nendstream', data, re.S):
+        images.append((head, zlib.decompress(stream)))
+    return images
+
+
+def test_pdf_masks_transparent_pages(tmp_path):
+    with open_writer('pdf', tmp_path / 'Vol. 1') as writer:
+        writer.add('1.png', png(3, 2, 6, pixel=b'\x10\x20\x30\x40'))
+        writer.add('2.png', png(3, 2, 4, bits=16, pixel=b'\x01\x02\x03\x04'))
+    data = writer.path.read_bytes()
+    assert data.startswith(b'%PDF-1.5') and b'/Count 2' in data
+
+    (mask, alpha), (rgb, color), (mask16, alpha16), (gray16, color16) = pdf_streams(data)
+    assert b'/SMask' in rgb and b'/Colors 3' in rgb and b'/Colors 1' in mask
+    # the filter type starts each row, followed by the channels of the row's first pixel
+    assert color == (b'\x01\x10\x20\x30' + b'\x00' * 6) * 2
+    assert alpha == (b'\x01\x40' + b'\x00' * 2) * 2
+    assert b'/BitsPerComponent 16' in gray16 and b'/DeviceGray' in gray16
+    assert color16 == (b'\x01\x01\x02' + b'\x00' * 4) * 2
+    assert alpha16 == (b'\x01\x03\x04' + b'\x00' * 4) * 2
+
+
+@pytest.mark.parametrize('page', [b'GIF89a', png(2, 2, interlace=1)])
+def test_pdf_refuses_pages_it_cannot_embed(tmp_path, page):
+    with pytest.raises(ValueError):
+        with open_writer('pdf', tmp_path / 'Vol. 1') as writer:
+            writer.add('1.png', png(2, 2))
+            writer.add('2.png', page)
+    assert not writer.path.exists() and not writer.tmp_path.exists()
+
+
+def test_abort_keeps_earlier_output(tmp_path, pages):
+    with open_writer('folder', tmp_path / 'Vol. 1') as writer:
+        writer.add(*pages[0])
+    with pytest.raises(OSError):
+        with open_writer('folder', tmp_path / 'Vol. 1') as writer:
+            writer.add('1/2.jpg', tmp_path / 'missing.jpg')
+    assert not writer.tmp_path.exists()
+    assert (writer.path / '1' / '1.png').exists()